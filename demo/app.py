@@ -5,8 +5,7 @@ import json
 from tqdm import tqdm
 import argparse
 import tester
-import uuid
-import shutil
+from query_engine import SoloQueryEngine
 
 app = Flask(__name__)
 app.template_folder = ''
@@ -16,6 +15,7 @@ table_dict = {}
 dataset = None
 example_questions = None
 index_obj = None
+query_engine = None
 
 @app.route('/', methods=('GET', 'POST'))
 def index():
@@ -34,59 +34,19 @@ def index():
                            dataset_name=dataset)
     return output
 
-def create_query_file(qry_data_dir, question):
-    file_name = 'fusion_query.jsonl'
-    data_file = os.path.join(qry_data_dir, file_name)
-    query_data = {
-        "id":0,
-        "question":question,
-        "table_id_lst":['N/A'],
-        "answers":["N/A"],
-        "ctxs": [{"title": "", "text": "This is a example passage."}]
-    }
-    with open(data_file, 'w') as f_o:
-        f_o.write(json.dumps(query_data) + '\n')
-
-def get_top_tables(out_dir):
-    data_file = os.path.join(out_dir, 'pred_epoch_0_None.jsonl')
-    with open(data_file) as f:
-        item = json.load(f)
-    out_table_lst = []
-    out_table_set = set()
-    tag_lst = item['tags']
-    for tag in tag_lst:
-        table_id = tag['table_id']
-        if table_id not in out_table_set:
-            out_table_set.add(table_id)
-            out_table_lst.append(table_id)
-            if len(out_table_lst) >= 5:
-                break
-    print(out_table_lst)
-    return out_table_lst
+@app.route('/cache_stats', methods=('GET',))
+def cache_stats():
+    return json.dumps(query_engine.get_cache_stats())
 
 def query(input_data):
-    #import pdb; pdb.set_trace()
     question = input_data['question']
-    qry_folder = 'demo_query_%s' % str(uuid.uuid4())
-    query_dir = os.path.join(data_dir, dataset, qry_folder)
-    test_args = create_test_args(qry_folder)
-    print("test_args: ", test_args)
-     
-    qry_data_dir = os.path.join(query_dir, 'test')
-    if not os.path.isdir(qry_data_dir):
-        os.makedirs(qry_data_dir)
-    create_query_file(qry_data_dir, question)
-    out_dir = tester.main(test_args, table_data=table_dict, index_obj=index_obj)
-    top_table_lst = get_top_tables(out_dir)
-    table_data_lst = [table_dict[table_id] for table_id in top_table_lst]
+    top_table_lst = query_engine.search(question, k=5)
+    print([a['table_id'] for a in top_table_lst])
+    table_data_lst = [table_dict[a['table_id']] for a in top_table_lst]
     rank = 0
     for table_data in table_data_lst:
         rank += 1
         table_data['search_rank'] = rank
-        
-    shutil.rmtree(query_dir, ignore_errors=True)
-    shutil.rmtree(out_dir, ignore_errors=True)
-     
     return table_data_lst
 
 def load_tables():
@@ -125,16 +85,10 @@ def get_args():
     args = parser.parse_args()
     return args 
 
-def create_test_args(query_dir):
-    test_args = argparse.Namespace(
-        work_dir=work_dir,
-        dataset=dataset,
-        query_dir=query_dir,
-        table_repre='rel_graph',
-        train_model_dir=None,
-        bnn=1,
-    )
-    return test_args
+def load_query_engine():
+    global query_engine
+    query_engine = SoloQueryEngine(work_dir, dataset, table_dict=table_dict, index_obj=index_obj)
+
 import sys
 def app_init():
     print('app_init')
@@ -152,6 +106,7 @@ def app_init():
     load_tables()
     load_example_questions()
     load_index(args)
+    load_query_engine()
     print(args)
 
 if __name__ == '__main__':
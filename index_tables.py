@@ -5,7 +5,12 @@ import glob
 from table2txt import table2graph
 import table_from_csv
 import generate_passage_embeddings as passage_encoder
+import gen_teacher_embeddings
 from src import ondisk_index
+from src import passage_store
+from src import line_index
+from src import train_sample
+from src import teacher_emb_store
 import shutil
 import json
 from trainer import read_config
@@ -15,6 +20,7 @@ StateGenTriples = 'gen_triples'
 StateEncode = 'encode'
 StateIndex = 'index'
 EmbFileTag = '_embeddings'
+Update_Pending_File = 'update_pending.json'
 
 def get_state_file(dataset):
     return 'index_state_%s.json' % dataset 
@@ -32,6 +38,22 @@ def read_state(state_file):
         }
     return state_info
 
+def reset_state(state_file):
+    state_info = {
+        StateImportCSV:False,
+        StateGenTriples:False,
+        StateEncode:False,
+        StateIndex:False
+    }
+    with open(state_file, 'w') as f_o:
+        f_o.write(json.dumps(state_info))
+    return state_info
+
+def is_in_progress(state_info):
+    if state_info[StateIndex]:
+        return False
+    return any([state_info[state_key] for state_key in state_info])
+
 def update_state(state_info, state_key, state, state_file):
     state_info[state_key] = state
     with open(state_file, 'w') as f_o:
@@ -52,7 +74,8 @@ def get_graph_args(work_dir, dataset, config):
                                     table_file='tables.jsonl',
                                     strategy='RelationGraph',
                                     table_chunk_size=config['table_chunk_size'],
-                                    table_import_batch=config['table_import_batch']
+                                    table_import_batch=config['table_import_batch'],
+                                    p_id_start=1
                                     )
     return graph_args
 
@@ -61,8 +84,10 @@ def get_encoder_args(model_path, config, show_progress=True):
                                       passages=None, 
                                       output_path=None,
                                       output_batch_size=500000,
-                                      shard_id=0,
-                                      num_shards=1,
+                                      shard_id=-1,
+                                      num_shards=config['encode_num_shards'],
+                                      num_tok_workers=config['encode_tok_workers'],
+                                      train_sample_size=config['train_sample_size'],
                                       per_gpu_batch_size=config['encode_batch_size'],
                                       passage_maxlength=200,
                                       model_path=model_path,
@@ -71,12 +96,14 @@ def get_encoder_args(model_path, config, show_progress=True):
                                      )
     return encoder_args
 
-def get_index_args(work_dir, dataset):
+def get_index_args(work_dir, dataset, config):
     emb_file = get_emb_file_pattern(work_dir, dataset)
     index_args = argparse.Namespace(work_dir=work_dir,
                                     dataset=dataset,
                                     experiment='rel_graph',
-                                    emb_file=emb_file
+                                    emb_file=emb_file,
+                                    trained_index=config['trained_index'],
+                                    index_plan=config['index_plan']
                                     )
     return index_args 
 
@@ -85,6 +112,14 @@ def exists_tables_csv(dataset_dir):
     csv_file_lst = glob.glob(csv_file_pattern, recursive=True)
     return len(csv_file_lst) > 0
 
+def get_triple_file(work_dir, dataset):
+    passage_dir = os.path.join(work_dir, 'open_table_discovery/table2txt/dataset', dataset, 'rel_graph')
+    return os.path.join(passage_dir, 'passages.jsonl')
+
+def get_encode_ckpt_dir(work_dir, dataset):
+    emb_dir = os.path.dirname(get_emb_file_pattern(work_dir, dataset))
+    return os.path.join(emb_dir, passage_encoder.Ckpt_Dir_Name)
+
 def get_emb_file_pattern(work_dir, dataset):
     emb_file = os.path.join(work_dir, 'open_table_discovery/table2txt/dataset', 
                             dataset, 'rel_graph', 'emb', '*%s*' % EmbFileTag)
@@ -93,11 +128,10 @@ def get_emb_file_pattern(work_dir, dataset):
 def confirm(args):
     dataset_dir = os.path.join(args.work_dir, 'data', args.dataset)
     tables_file = os.path.join(dataset_dir, 'tables/tables.jsonl')
-    passage_dir = os.path.join(args.work_dir, 'open_table_discovery/table2txt/dataset', 
-                                args.dataset, 'rel_graph')
-    passage_file = os.path.join(passage_dir, 'passages.jsonl') 
+    passage_file = get_triple_file(args.work_dir, args.dataset)
     emb_file = get_emb_file_pattern(args.work_dir, args.dataset) 
-    index_dir = os.path.join(args.work_dir, 'index/on_disk_index_%s_rel_graph' % args.dataset)     
+    encode_ckpt_dir = get_encode_ckpt_dir(args.work_dir, args.dataset)
+    index_dir = get_index_dir(args.work_dir, args.dataset)
  
     check_data_lst = [] 
     if (args.pipe_step is None) or (args.pipe_step == ''): 
@@ -115,8 +149,10 @@ def confirm(args):
         if passage_exists:
             check_data = {'name':'Triples', 'file_lst': [passage_file]}
             check_data_lst.append(check_data) 
-        if emb_exists:
+        if emb_exists or os.path.isdir(encode_ckpt_dir):
             check_data = {'name':'Triple embeddings', 'file_lst':emb_file_lst}
+            if os.path.isdir(encode_ckpt_dir):
+                check_data['dir'] = encode_ckpt_dir
             check_data_lst.append(check_data) 
     
     index_exists = os.path.exists(index_dir)
@@ -154,12 +190,170 @@ def get_check_data_desc(check_data_lst):
     desc += ')'
     return desc
 
+def get_index_dir(work_dir, dataset):
+    return os.path.join(work_dir, 'index/on_disk_index_%s_rel_graph' % dataset)
+
+def write_update_pending(pending_file, update_info):
+    tmp_file = pending_file + '.tmp'
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(update_info))
+    os.replace(tmp_file, pending_file)
+
+def rollback_update(update_info, store_dir, index_passage_file, teacher_store_dir):
+    """
+    Undo the appends of an interrupted update, the tombstones are kept since marking
+    the removed tables again is harmless. Vectors already written to the index are kept and not added again.
+    """
+    passage_store.truncate_store(store_dir, update_info['num_passages'])
+    if os.path.isfile(index_passage_file):
+        os.truncate(index_passage_file, update_info['passage_file_size'])
+        offset_file = line_index.get_offset_file(index_passage_file)
+        offset_size = (update_info['num_passage_lines'] + 1) * 8
+        if os.path.isfile(offset_file) and os.path.getsize(offset_file) >= offset_size:
+            os.truncate(offset_file, offset_size)
+    num_teacher_passages = update_info['num_teacher_passages']
+    if (num_teacher_passages is not None) and teacher_emb_store.exists_store(teacher_store_dir):
+        teacher_emb_store.truncate_store(teacher_store_dir, num_teacher_passages)
+
+def update_index(args, config):
+    """
+    Incremental mode, only the new, changed or deleted csv files under tables_csv are processed.
+    Triples and embeddings are generated for the new and changed tables and appended to the index
+    with new p_ids, and the triples of changed and deleted tables are tombstoned.
+    The sizes before the update are recorded in update_pending.json, if the update is interrupted,
+    the next run rolls the appends back and redoes the update with the triples and embeddings
+    kept from the first run. tables.jsonl and the manifest are updated last, so the changed csv
+    files are detected again until the index is updated.
+    """
+    index_dir = get_index_dir(args.work_dir, args.dataset)
+    index_file = os.path.join(index_dir, 'populated.index')
+    store_dir = passage_store.get_store_dir(index_dir)
+    if not (os.path.isfile(index_file) and passage_store.exists_store(store_dir)):
+        print('Index (%s) with a passage store does not exist, index the dataset first.' % index_dir)
+        return
+    
+    pending_file = os.path.join(index_dir, Update_Pending_File)
+    index_passage_file = os.path.join(index_dir, os.path.basename(get_triple_file(args.work_dir, args.dataset)))
+    teacher_store_dir = teacher_emb_store.get_store_dir(index_dir)
+    csv_args = get_csv_args(args.work_dir, args.dataset, config)
+    repairing = os.path.isfile(pending_file)
+    if repairing:
+        print('\nRepairing the interrupted update recorded in (%s)' % pending_file)
+        with open(pending_file) as f:
+            update_info = json.load(f)
+        rollback_update(update_info, store_dir, index_passage_file, teacher_store_dir)
+    else:
+        print('\nImporting changed tables')
+        msg_info = table_from_csv.import_changed(csv_args)
+        if not msg_info['state']:
+            print(msg_info['msg'])
+            return
+        passage_file_exists = os.path.isfile(index_passage_file)
+        num_teacher_passages = None
+        if teacher_emb_store.exists_store(teacher_store_dir):
+            num_teacher_passages = teacher_emb_store.get_num_passages(teacher_store_dir)
+        update_info = {
+            'delta_table_file':msg_info['delta_table_file'],
+            'num_tables':msg_info['num_tables'],
+            'removed_table_ids':msg_info['removed_table_ids'],
+            'manifest':msg_info['manifest'],
+            'num_passages':passage_store.get_num_passages(store_dir),
+            'num_vectors':ondisk_index.get_num_vectors(index_file),
+            'passage_file_size':os.path.getsize(index_passage_file) if passage_file_exists else 0,
+            'num_passage_lines':line_index.count_lines(index_passage_file),
+            'num_teacher_passages':num_teacher_passages
+        }
+        write_update_pending(pending_file, update_info)
+    delta_table_file = update_info['delta_table_file']
+    removed_table_ids = update_info['removed_table_ids']
+    num_tables = update_info['num_tables']
+    print('%d tables to add, %d tables to remove' % (num_tables, len(removed_table_ids)))
+    
+    if len(removed_table_ids) > 0:
+        num_removed = passage_store.tombstone_tables(store_dir, removed_table_ids)
+        print('%d triples removed' % num_removed)
+
+    delta_dir = update_info.get('delta_dir', None)
+    if num_tables > 0:
+        if delta_dir is not None:
+            # the triples of the first run are reused, regenerated ones would have other p_ids
+            if not os.path.isfile(update_info['triple_file']):
+                raise ValueError('(%s) of the interrupted update is missing, rebuild the index' %
+                                 update_info['triple_file'])
+            print('\nReusing the triples and embeddings in (%s)' % delta_dir)
+            triple_file = update_info['triple_file']
+            if update_info['p_id_start'] != passage_store.get_next_p_id(store_dir):
+                raise ValueError('triples in (%s) start from p_id (%d), the store continues from (%d)' %
+                                 (delta_dir, update_info['p_id_start'], passage_store.get_next_p_id(store_dir)))
+        else:
+            print('\nGenerating triples')
+            graph_args = get_graph_args(args.work_dir, args.dataset, config)
+            graph_args.table_file = os.path.basename(delta_table_file)
+            graph_args.experiment = 'rel_graph_delta'
+            graph_args.p_id_start = passage_store.get_next_p_id(store_dir)
+            delta_dir = os.path.join(args.work_dir, 'open_table_discovery/table2txt/dataset', 
+                                     args.dataset, graph_args.experiment)
+            if os.path.isdir(delta_dir):
+                shutil.rmtree(delta_dir)
+            msg_info = table2graph.main(graph_args)
+            if not msg_info['state']:
+                return
+            triple_file = msg_info['out_file']
+            print('\nEncoding triples')
+            encode_triples(args.work_dir, triple_file, config)
+            # from here on, the index may get these vectors, so a repair must use the same triples
+            update_info['delta_dir'] = delta_dir
+            update_info['triple_file'] = triple_file
+            update_info['p_id_start'] = graph_args.p_id_start
+            update_info['num_triples'] = msg_info['num_triples']
+            write_update_pending(pending_file, update_info)
+
+        print('\nUpdating index')
+        passage_store.append_store(triple_file, store_dir)
+        emb_file_pattern = os.path.join(delta_dir, 'emb', '*%s*' % EmbFileTag)
+        num_vectors = ondisk_index.get_num_vectors(index_file) if repairing else update_info['num_vectors']
+        if num_vectors > update_info['num_vectors']:
+            # the index file was replaced before the interruption
+            num_added = num_vectors - update_info['num_vectors']
+            if num_added != update_info['num_triples']:
+                raise ValueError('index has %d new vectors, %d triples expected' %
+                                 (num_added, update_info['num_triples']))
+            print('%d vectors already in the index' % num_added)
+        else:
+            num_added = ondisk_index.add_data(index_file, emb_file_pattern)
+        with line_index.LineOffsetFile(index_passage_file, 'a') as f_o:
+            with open(triple_file) as f:
+                for line in f:
+                    f_o.write(line)
+        if config['teacher_emb_dtype'] is not None:
+            print('\nEncoding teacher embeddings')
+            encode_teacher_embs(args.work_dir, index_passage_file, index_dir, config, append=True)
+        print('%d triples added' % num_added)
+    
+    table_from_csv.update_tables(csv_args, removed_table_ids, delta_table_file, update_info['manifest'])
+    if (delta_dir is not None) and os.path.isdir(delta_dir):
+        shutil.rmtree(delta_dir)
+    os.remove(delta_table_file)
+    os.remove(pending_file)
+    print('\nIndexing done')
+
 def main():
     args = get_args()
+    if args.incremental:
+        update_index(args, read_config())
+        return
     pipe_sate_file = get_state_file(args.dataset)
     pipe_state_info = read_state(pipe_sate_file)
-    if not confirm(args):
-        return
+    resuming = (not args.pipe_step) and is_in_progress(pipe_state_info)
+    if resuming:
+        # the finished steps are skipped, encoding and indexing continue from their checkpoints
+        print('Resuming the unfinished indexing of (%s), remove %s to start over' % (args.dataset, pipe_sate_file))
+        args.tables_csv_exists = exists_tables_csv(os.path.join(args.work_dir, 'data', args.dataset))
+    else:
+        if not confirm(args):
+            return
+        if not args.pipe_step:
+            pipe_state_info = reset_state(pipe_sate_file)
     config = read_config()
     if (args.pipe_step is not None) and (args.pipe_step != ''):
         if args.pipe_step != 'emb_to_index':
@@ -170,7 +364,7 @@ def main():
             create_index(pipe_state_info, pipe_sate_file, args, pipe_triple_file)
             return
              
-    if args.tables_csv_exists:
+    if args.tables_csv_exists and (not pipe_state_info[StateImportCSV]):
         import_table_msg = '\nImporting tables'
         if config['table_sample_rows'] is not None:
             import_table_msg += '(Sample rows)'
@@ -184,20 +378,41 @@ def main():
         else:
             update_state(pipe_state_info, StateImportCSV, True, pipe_sate_file)
     
-    print('\nGenerating triples')
-    graph_args = get_graph_args(args.work_dir, args.dataset, config)
-    msg_info = table2graph.main(graph_args)
-    graph_ok = msg_info['state']
-    if not graph_ok:
-        update_state(pipe_state_info, StateGenTriples, False, pipe_sate_file)
-        return
-    else:
+    triple_file = get_triple_file(args.work_dir, args.dataset)
+    if config['stream_encode'] and (not pipe_state_info[StateEncode]):
+        print('\nGenerating and encoding triples')
+        msg_info = gen_encode_triples(args.work_dir, args.dataset, config)
+        if not msg_info['state']:
+            update_state(pipe_state_info, StateGenTriples, False, pipe_sate_file)
+            return
         update_state(pipe_state_info, StateGenTriples, True, pipe_sate_file)
-    num_triples = msg_info['num_triples'] 
-    triple_file = msg_info['out_file']
-    print('\nEncoding triples')
-    encode_triples(args.work_dir, triple_file, config)
-    update_state(pipe_state_info, StateEncode, True, pipe_sate_file)
+        update_state(pipe_state_info, StateEncode, True, pipe_sate_file)
+
+    if not pipe_state_info[StateGenTriples]:
+        # triples from an interrupted run are incomplete
+        remove_file_lst = [triple_file, line_index.get_offset_file(triple_file)]
+        for remove_file in remove_file_lst:
+            if os.path.isfile(remove_file):
+                os.remove(remove_file)
+        print('\nGenerating triples')
+        graph_args = get_graph_args(args.work_dir, args.dataset, config)
+        msg_info = table2graph.main(graph_args)
+        graph_ok = msg_info['state']
+        if not graph_ok:
+            update_state(pipe_state_info, StateGenTriples, False, pipe_sate_file)
+            return
+        else:
+            update_state(pipe_state_info, StateGenTriples, True, pipe_sate_file)
+        triple_file = msg_info['out_file']
+    
+    if not pipe_state_info[StateEncode]:
+        print('\nEncoding triples')
+        msg_info = encode_triples(args.work_dir, triple_file, config)
+        if not msg_info['state']:
+            update_state(pipe_state_info, StateEncode, False, pipe_sate_file)
+            print(msg_info['msg'])
+            return
+        update_state(pipe_state_info, StateEncode, True, pipe_sate_file)
     
     #Creating index  
     create_index(pipe_state_info, pipe_sate_file, args, triple_file) 
@@ -205,28 +420,50 @@ def main():
 def create_index(pipe_state_info, pipe_sate_file, args, triple_file):
     emb_file_pattern = get_emb_file_pattern(args.work_dir, args.dataset) 
     out_emb_file_lst = glob.glob(emb_file_pattern) 
+    index_dir = get_index_dir(args.work_dir, args.dataset)
     
-    if len(out_emb_file_lst) == 0:
-        raise ValueError('There is no triple embedding files')
-    
-    print('\nCreating index')
-    index_args = get_index_args(args.work_dir, args.dataset)
-    msg_info = ondisk_index.main(index_args)
-    if pipe_state_info is not None:
+    index_file = os.path.join(index_dir, 'populated.index')
+    if os.path.isfile(index_file) and (ondisk_index.read_ckpt(index_dir) is None):
+        # resumed after the index was populated
+        print('\nIndex (%s) is already populated' % index_dir)
+    else:
+        if len(out_emb_file_lst) == 0:
+            raise ValueError('There is no triple embedding files')
+        
+        print('\nCreating index')
+        index_args = get_index_args(args.work_dir, args.dataset, read_config())
+        msg_info = ondisk_index.main(index_args)
         if not msg_info['state']:
-            update_state(pipe_state_info, StateIndex, False, pipe_sate_file)
+            if pipe_state_info is not None:
+                update_state(pipe_state_info, StateIndex, False, pipe_sate_file)
             print(msg_info['msg'])
-        else:
-            update_state(pipe_state_info, StateIndex, True, pipe_sate_file)
+            return
 
-    index_dir = msg_info['index_dir']
     assert(os.path.isdir(index_dir))
-    shutil.move(triple_file, index_dir)
+    if os.path.isfile(triple_file):
+        shutil.move(triple_file, index_dir)
+    triple_offset_file = line_index.get_offset_file(triple_file)
+    if os.path.isfile(triple_offset_file):
+        shutil.move(triple_offset_file, index_dir)
+    index_passage_file = os.path.join(index_dir, os.path.basename(triple_file))
+    passage_store.build_store(index_passage_file, passage_store.get_store_dir(index_dir))
+    config = read_config()
+    if config['teacher_emb_dtype'] is not None:
+        print('\nEncoding teacher embeddings')
+        encode_teacher_embs(args.work_dir, index_passage_file, index_dir, config)
     
     #y_or_n = input('Delete embedding file %s (y/n)' % emb_file_pattern)
     #if y_or_n == 'y':
     for out_emb_file in out_emb_file_lst:
         os.remove(out_emb_file)
+    encode_ckpt_dir = get_encode_ckpt_dir(args.work_dir, args.dataset)
+    if os.path.isdir(encode_ckpt_dir):
+        shutil.rmtree(encode_ckpt_dir)
+    sample_dir = os.path.join(os.path.dirname(emb_file_pattern), train_sample.Sample_Dir_Name)
+    if os.path.isdir(sample_dir):
+        shutil.rmtree(sample_dir)
+    if pipe_state_info is not None:
+        update_state(pipe_state_info, StateIndex, True, pipe_sate_file)
     
     print('\nIndexing done')
      
@@ -243,13 +480,55 @@ def encode_triples(work_dir, graph_file, config):
     if not os.path.isdir(emb_dir):
         os.makedirs(emb_dir)
     encoder_args.output_path = os.path.join(emb_dir, base_name + EmbFileTag)
-    passage_encoder.main(encoder_args, is_main=False) 
+    msg_info = passage_encoder.main(encoder_args, is_main=False) 
+    return msg_info
+
+def encode_teacher_embs(work_dir, passage_file, index_dir, config, append=False):
+    teacher_args = argparse.Namespace(passages=passage_file,
+                                      store_dir=teacher_emb_store.get_store_dir(index_dir),
+                                      model_path=os.path.join(work_dir, 'models/tqa_retriever'),
+                                      emb_dtype=config['teacher_emb_dtype'],
+                                      append=append,
+                                      batch_size=10000,
+                                      no_fp16=False,
+                                      show_progress=True,
+                                      device='cuda')
+    return gen_teacher_embeddings.main(teacher_args)
+
+def gen_encode_triples(work_dir, dataset, config):
+    """
+    Streaming mode, the triples are tokenized by the triple generation workers and
+    encoded as they are generated, passages.jsonl and the embeddings are written side by side.
+    """
+    # there is no checkpoint in this mode, so the outputs of an interrupted run are removed
+    triple_file = get_triple_file(work_dir, dataset)
+    emb_file_pattern = get_emb_file_pattern(work_dir, dataset)
+    remove_file_lst = [triple_file, line_index.get_offset_file(triple_file)] + glob.glob(emb_file_pattern)
+    for remove_file in remove_file_lst:
+        if os.path.isfile(remove_file):
+            os.remove(remove_file)
+    
+    encoder_model = os.path.join(work_dir, 'models/student_tqa_retriever_step_29500')
+    encoder_args = get_encoder_args(encoder_model, config, show_progress=False)
+    encoder_args.passages = triple_file
+    emb_dir = os.path.dirname(emb_file_pattern)
+    encoder_args.output_path = os.path.join(emb_dir, os.path.basename(triple_file) + EmbFileTag)
+    stream_encoder = passage_encoder.StreamEncoder(encoder_args)
+    
+    graph_args = get_graph_args(work_dir, dataset, config)
+    msg_info = table2graph.main(graph_args, stream_encoder=stream_encoder)
+    if not msg_info['state']:
+        return msg_info
+    stream_encoder.close()
+    return msg_info
 
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--work_dir', type=str, required=True)
     parser.add_argument('--dataset', type=str, required=True)
     parser.add_argument('--pipe_step', type=str)
+    parser.add_argument('--incremental', type=int, default=0, 
+                        help='1 to only add/remove the new, changed or deleted csv files to an existing index')
     args = parser.parse_args()
     return args
 
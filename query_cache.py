@@ -0,0 +1,84 @@
+import os
+import glob
+import time
+import copy
+from collections import OrderedDict
+
+def normalize_question(question):
+    return ' '.join(question.lower().split())
+
+def get_files_version(file_pattern_lst):
+    """
+    The version of a set of files is the (path, mtime, size) of all the files matched,
+    it changes when any file is added, removed or rewritten.
+    """
+    version = []
+    for file_pattern in file_pattern_lst:
+        for data_file in sorted(glob.glob(file_pattern)):
+            stat = os.stat(data_file)
+            version.append((data_file, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+class ResultCache:
+    """
+    LRU cache of the search results keyed by the normalized question,
+    an entry expires after ttl seconds (0 for no expiry) and the least recently used entry
+    is evicted when there are more than max_size entries.
+    All entries are dropped when the version of the watched files (index, models) changes,
+    the files are checked at most once every check_interval seconds.
+    """
+    def __init__(self, max_size, ttl, watch_pattern_lst, check_interval=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.watch_pattern_lst = watch_pattern_lst
+        self.check_interval = check_interval
+        self.version = get_files_version(watch_pattern_lst)
+        self.version_time = time.time()
+        self.result_dict = OrderedDict()
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_expired = 0
+        self.num_invalidated = 0
+
+    def check_version(self):
+        now = time.time()
+        if now - self.version_time < self.check_interval:
+            return
+        self.version_time = now
+        version = get_files_version(self.watch_pattern_lst)
+        if version != self.version:
+            self.version = version
+            self.num_invalidated += 1
+            self.result_dict.clear()
+
+    def get(self, key):
+        self.check_version()
+        item = self.result_dict.get(key, None)
+        if item is not None and self.ttl > 0 and (time.time() - item[0] > self.ttl):
+            del self.result_dict[key]
+            self.num_expired += 1
+            item = None
+        if item is None:
+            self.num_misses += 1
+            return None
+        self.result_dict.move_to_end(key)
+        self.num_hits += 1
+        return copy.deepcopy(item[1])
+
+    def put(self, key, result):
+        self.result_dict[key] = (time.time(), copy.deepcopy(result))
+        self.result_dict.move_to_end(key)
+        while len(self.result_dict) > self.max_size:
+            self.result_dict.popitem(last=False)
+
+    def get_stats(self):
+        num_lookups = self.num_hits + self.num_misses
+        stats = {
+            'size':len(self.result_dict),
+            'hits':self.num_hits,
+            'misses':self.num_misses,
+            'expired':self.num_expired,
+            'invalidated':self.num_invalidated,
+            'hit_rate':(self.num_hits / num_lookups) if num_lookups > 0 else 0
+        }
+        return stats
@@ -0,0 +1,260 @@
+import os
+import argparse
+import time
+import queue
+import threading
+import numpy as np
+import torch
+import transformers
+import src.data
+import src.model
+import src.emb_cache
+import passage_ondisk_retrieval as retriever
+import finetune_table_retr as model_tester
+from trainer import read_config, read_tables
+from table2txt.retr_utils import process_dev
+import tester
+import query_cache
+
+class FusionBatcher:
+    """
+    Micro-batching of the FiD and relevance model scoring for concurrent questions.
+    A worker thread collects the submitted questions for up to max_wait seconds or until
+    max_batch_size questions arrive, scores them with one call of score_func and 
+    hands each result back to the thread waiting for it.
+    """
+    def __init__(self, score_func, max_batch_size, max_wait):
+        self.score_func = score_func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.request_queue = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, query_item):
+        request = {'query_item':query_item, 'done':threading.Event(), 'result':None, 'error':None}
+        self.request_queue.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+
+    def collect(self):
+        request_lst = [self.request_queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(request_lst) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request_lst.append(self.request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return request_lst
+
+    def run(self):
+        while True:
+            request_lst = self.collect()
+            try:
+                result_lst = self.score_func([a['query_item'] for a in request_lst])
+                for request, result in zip(request_lst, result_lst):
+                    request['result'] = result
+            except Exception as err:
+                for request in request_lst:
+                    request['error'] = err
+            for request in request_lst:
+                request['done'].set()
+
+class SoloQueryEngine:
+    """
+    A long-lived query engine for the online stage.
+    The tokenizers, the student/teacher retrievers, FiDT5, the relevance model and
+    the index are loaded once, and each question is answered in memory
+    without writing query, retrieval or prediction files.
+    search can be called from concurrent threads, the retrieval of the questions is serialized
+    and their FiD scoring is micro-batched, or serialized when fusion_batch_size <= 1
+    (the cross-attention hooks keep the scores on the shared FiD model).
+    """
+    def __init__(self, work_dir, dataset, table_dict=None, index_obj=None,
+                 train_model_dir=None, bnn=1, cuda=0):
+        self.work_dir = work_dir
+        self.dataset = dataset
+        self.config = read_config()
+        if table_dict is None:
+            table_dict = read_tables(work_dir, dataset)
+        self.table_dict = table_dict
+        self.opt = self.get_opt(train_model_dir, bnn, cuda)
+
+        index_args = argparse.Namespace(table_repre='rel_graph')
+        if index_obj is None:
+            index_obj = tester.get_index_obj(work_dir, dataset, index_args)
+        self.index = index_obj
+        self.load_models()
+        self.num_questions = 0
+        self.result_cache = self.create_result_cache(train_model_dir)
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock()
+        self.fusion_batcher = None
+        fusion_batch_size = int(self.config['fusion_batch_size'])
+        if fusion_batch_size > 1:
+            self.fusion_batcher = FusionBatcher(self.rank_batch, fusion_batch_size,
+                                                float(self.config['fusion_batch_wait_ms']) / 1000)
+
+    def create_result_cache(self, train_model_dir):
+        cache_size = int(self.config['query_cache_size'])
+        if cache_size <= 0:
+            return None
+        index_dir = os.path.join(self.work_dir, 'index/on_disk_index_%s_rel_graph' % self.dataset)
+        if train_model_dir is None:
+            model_pattern = os.path.join(self.work_dir, 'models', self.dataset, '*.pt')
+        else:
+            model_pattern = self.opt.fusion_retr_model
+        watch_pattern_lst = [os.path.join(index_dir, '*'), os.path.join(index_dir, '*', '*'), model_pattern]
+        return query_cache.ResultCache(cache_size, float(self.config['query_cache_ttl']), watch_pattern_lst,
+                                       check_interval=float(self.config['query_cache_check_interval']))
+
+    def get_cache_stats(self):
+        if self.result_cache is None:
+            return None
+        return self.result_cache.get_stats()
+
+    def get_opt(self, train_model_dir, bnn, cuda):
+        config = self.config
+        if train_model_dir is None:
+            file_pattern = os.path.join(self.work_dir, 'models', self.dataset, '*.pt')
+            retr_model_file = tester.get_model_file(file_pattern)
+        else:
+            retr_model_file = tester.get_train_best_model(train_model_dir)
+        opt = argparse.Namespace(
+            student_model_path=os.path.join(self.work_dir, 'models/student_tqa_retriever_step_29500'),
+            teacher_model_path=os.path.join(self.work_dir, 'models/tqa_retriever'),
+            model_path=os.path.join(self.work_dir, 'models/tqa_reader_base'),
+            fusion_retr_model=retr_model_file,
+            prior_model=None,
+            bnn=bnn,
+            n_docs=int(config['retr_top_n']),
+            min_tables=int(config['min_tables']),
+            max_retr=int(config['max_retr']),
+            n_probe=int(config['n_probe']),
+            min_probe=int(config['min_probe']),
+            retr_time_budget=float(config['retr_time_budget']),
+            collapse_tables=int(config['collapse_tables']),
+            collapse_per_table=int(config['collapse_per_table']),
+            teacher_cache_mb=float(config['teacher_cache_mb']),
+            question_maxlength=int(config['question_maxlength']),
+            n_context=int(config['rel_num_test']),
+            text_maxlength=int(config['text_maxlength']),
+            bnn_num_eval_sample=6,
+            no_fp16=False,
+            device=model_tester.get_device(cuda)
+        )
+        return opt
+
+    def load_models(self):
+        opt = self.opt
+        self.bert_tokenizer = transformers.BertTokenizerFast.from_pretrained('bert-base-uncased')
+        self.t5_tokenizer = transformers.T5Tokenizer.from_pretrained('t5-base', return_dict=False)
+        self.question_collator = src.data.Collator(opt.question_maxlength, self.bert_tokenizer)
+        self.fusion_collator = src.data.Collator(opt.text_maxlength, self.t5_tokenizer)
+
+        self.student_model = retriever.get_model(True, opt.student_model_path, opt.no_fp16)
+        self.teacher_model = retriever.get_model(False, opt.teacher_model_path, opt.no_fp16)
+        self.passage_collator = src.data.TextCollator(self.bert_tokenizer,
+                                                      self.teacher_model.config.passage_maxlength)
+
+        self.fusion_model = src.model.FiDT5.from_pretrained(opt.model_path)
+        self.fusion_model = self.fusion_model.to(opt.device)
+        self.fusion_model.eval()
+        self.fusion_model.overwrite_forward_crossattention()
+        self.fusion_model.reset_score_storage()
+
+        self.retr_model = model_tester.get_retr_model(opt)
+        self.retr_model.eval()
+        # teacher embeddings of the passages seen in earlier questions
+        self.teacher_emb_cache = src.emb_cache.create_cache(opt.teacher_cache_mb)
+
+    def create_query_item(self, question):
+        self.num_questions += 1
+        query_item = {
+            'id':self.num_questions,
+            'question':question,
+            'table_id_lst':['N/A'],
+            'answers':['N/A'],
+            'ctxs':[]
+        }
+        return query_item
+
+    def retrieve(self, query_item, time_budget=None):
+        opt = self.opt
+        question_dataset = src.data.Dataset([query_item], ignore_context=True)
+        (_, _, _, question_ids, question_mask, _) = self.question_collator([question_dataset[0]])
+        retriever.retrieve_question(opt, self.index, query_item, question_ids, question_mask,
+                                    self.student_model, self.teacher_model, self.passage_collator,
+                                    time_budget=time_budget, emb_cache=self.teacher_emb_cache)
+        process_dev([query_item], opt.n_context, self.table_dict, 'rel_graph', opt.min_tables)
+
+    def rank_batch(self, query_item_lst):
+        """
+        Score the passages of the questions by FiD and the relevance model, the questions with
+        the same number of passages are scored in one batch.
+        Return a list of (item_data, scores), one per question.
+        """
+        opt = self.opt
+        group_dict = {}
+        for idx, query_item in enumerate(query_item_lst):
+            num_passages = min(len(query_item['ctxs']), opt.n_context)
+            if num_passages not in group_dict:
+                group_dict[num_passages] = []
+            group_dict[num_passages].append(idx)
+        
+        result_lst = [None] * len(query_item_lst)
+        for idx_lst in group_dict.values():
+            fusion_dataset = src.data.Dataset([query_item_lst[idx] for idx in idx_lst], 
+                                              opt.n_context, sort_by_score=False)
+            fusion_batch = self.fusion_collator([fusion_dataset[offset] for offset in range(len(idx_lst))])
+            with torch.no_grad():
+                batch_data, retr_scores = model_tester.predict_batch(opt, self.fusion_model, self.retr_model,
+                                                                     fusion_dataset, fusion_batch,
+                                                                     num_samples=opt.bnn_num_eval_sample)
+            for offset, idx in enumerate(idx_lst):
+                result_lst[idx] = (batch_data[offset], retr_scores[offset].data.cpu().numpy())
+        return result_lst
+
+    def rank(self, query_item):
+        if self.fusion_batcher is not None:
+            return self.fusion_batcher.submit(query_item)
+        with self.model_lock:
+            return self.rank_batch([query_item])[0]
+
+    def search(self, question, k=5, time_budget=None):
+        """
+        Return the top k tables for the question as a list of dicts with table_id and score,
+        the score of a table is the score of its best passage.
+        time_budget (seconds) limits the adaptive probing of the index.
+        The results are cached by the normalized question, results under a time budget are not cached.
+        """
+        cache_key = None
+        with self.lock:
+            if self.result_cache is not None:
+                cache_key = (query_cache.normalize_question(question), k)
+                out_table_lst = self.result_cache.get(cache_key)
+                if out_table_lst is not None:
+                    return out_table_lst
+            query_item = self.create_query_item(question)
+            self.retrieve(query_item, time_budget=time_budget)
+        item_data, scores = self.rank(query_item)
+        sorted_idxes = np.argsort(-scores)
+        tag_lst = item_data['tags']
+        out_table_lst = []
+        out_table_set = set()
+        for idx in sorted_idxes:
+            table_id = tag_lst[idx]['table_id']
+            if table_id not in out_table_set:
+                out_table_set.add(table_id)
+                out_table_lst.append({'table_id':table_id, 'score':float(scores[idx])})
+                if len(out_table_lst) >= k:
+                    break
+        if (cache_key is not None) and (time_budget is None):
+            with self.lock:
+                self.result_cache.put(cache_key, out_table_lst)
+        return out_table_lst
@@ -26,13 +26,16 @@ from src.general_retr_bnn_loss import FusionGeneralRetrBNNLoss
 import torch.optim as optim
 import time
 from src.retr_utils import MetricRecorder, get_top_metrics
+from src import fid_feature_store
 import logging
 import torch.nn.functional as F
 import glob
 import datetime
+import shutil
 
 
 logging.basicConfig(level=logging.ERROR)
+logger = logging.getLogger(__name__)
 
 Num_Answers = 1
 global_steps = 0
@@ -221,21 +224,29 @@ def bnn_predict_2(model, batch_data, fusion_scores, fusion_states, passage_masks
     return retr_scores
 
 def bnn_predict(model, batch_data, fusion_scores, fusion_states, passage_masks, num_samples=0):
-    log_prob_lst = [] 
-    for sample_idx in range(num_samples):
-        retr_scores = model(batch_data, fusion_scores, fusion_states, passage_masks, sample=True)
-        retr_log_probs = F.logsigmoid(torch.stack(retr_scores)).unsqueeze(0)
-        log_prob_lst.append(retr_log_probs)
-    
-    retr_scores = model(batch_data, fusion_scores, fusion_states, passage_masks, sample=False)
-    retr_log_probs = F.logsigmoid(torch.stack(retr_scores)).unsqueeze(0)
-    log_prob_lst.append(retr_log_probs)
-    
-    sample_log_probs = torch.cat(log_prob_lst, dim=0)
+    # num_samples sampled weights and the mean weights in one batched pass
+    sample_scores = model.batch_sample_forward(batch_data, fusion_states, passage_masks, 
+                                               num_samples, include_mean=True)
+    sample_log_probs = F.logsigmoid(sample_scores)
     bnn_scores = sample_log_probs.mean(dim=0)
-     
     return bnn_scores 
 
+def predict_batch(opt, model, retr_model, dataset, fusion_batch, num_samples=0, feature_store=None):
+    """
+    Score the passages of a collated batch by FiD cross-attention and the relevance model.
+    Both models are expected to be in eval mode.
+    With feature_store, fusion_batch is a list of item indexes and the FiD features are read from the store.
+    """
+    scores, score_states, examples, context_mask = get_batch_score_info(opt, model, fusion_batch, 
+                                                                        dataset, feature_store)
+    batch_data = get_batch_data(examples)
+    if not opt.bnn:
+        retr_scores = retr_model(batch_data, scores, score_states, context_mask)    
+    else:
+        retr_scores = bnn_predict(retr_model, batch_data, scores, score_states, 
+                                  context_mask, num_samples=num_samples)
+    return batch_data, retr_scores
+
 def evaluate_train(opt, model, retr_model, dataset, fusion_batch):
     acc_lst = []
     model.eval()
@@ -261,7 +272,7 @@ def evaluate_train(opt, model, retr_model, dataset, fusion_batch):
     return acc_lst
 
 def evaluate(epoc, model, retr_model, dataset, dataloader, tokenizer, opt, 
-             model_tag=None, out_dir=None, model_file=None, num_samples=0):
+             model_tag=None, out_dir=None, model_file=None, num_samples=0, feature_store=None):
     #logger.info('Start evaluation')
     model.eval()
     retr_model.eval()
@@ -279,21 +290,17 @@ def evaluate(epoc, model, retr_model, dataset, dataloader, tokenizer, opt,
     model.overwrite_forward_crossattention()
     model.reset_score_storage()
     with torch.no_grad():
-        num_batch = len(dataloader)
+        batch_lst = get_batch_lst(dataset, dataloader, opt.per_gpu_eval_batch_size, feature_store)
+        num_batch = len(batch_lst)
         if opt.sql_batch_no is not None:
             bar_desc = 'data %d epoch %d evaluation' % (opt.sql_batch_no, epoc)
         else:
             bar_desc = 'epoch %d evaluation' % epoc
-        for itr, fusion_batch in tqdm(enumerate(dataloader), total=num_batch, desc=bar_desc):
+        for itr, fusion_batch in tqdm(enumerate(batch_lst), total=num_batch, desc=bar_desc):
             t1 = time.time()
 
-            scores, score_states, examples, context_mask = get_score_info(model, fusion_batch, dataset)
-            batch_data = get_batch_data(examples)
-            if not opt.bnn:
-                retr_scores = retr_model(batch_data, scores, score_states, context_mask)    
-            else:
-                retr_scores = bnn_predict(retr_model, batch_data, scores, score_states, 
-                                          context_mask, num_samples=num_samples)
+            batch_data, retr_scores = predict_batch(opt, model, retr_model, dataset, fusion_batch, 
+                                                    num_samples=num_samples, feature_store=feature_store)
             batch_answers = get_batch_answers(batch_data)
              
             t2 = time.time()
@@ -421,7 +428,8 @@ def train(model, retr_model,
           train_dataset, collator,
           eval_dataset, eval_dataloader, 
           tokenizer, 
-          opt, coreset_method=None, train_data_dict=None):
+          opt, coreset_method=None, train_data_dict=None, 
+          train_features=None, eval_features=None):
 
     loss_fn = get_loss_fn(opt)
     learing_rate = 1e-3
@@ -431,15 +439,17 @@ def train(model, retr_model,
     global_steps = 0
     total_time = .0
         
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(
-        train_dataset,
-        sampler=train_sampler,
-        batch_size=opt.per_gpu_batch_size,
-        drop_last=False,
-        #num_workers=10,
-        collate_fn=collator
-    )
+    train_dataloader = None
+    if train_features is None:
+        train_sampler = RandomSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset,
+            sampler=train_sampler,
+            batch_size=opt.per_gpu_batch_size,
+            drop_last=False,
+            #num_workers=10,
+            collate_fn=collator
+        )
     model.eval()
     if hasattr(model, "module"):
         model = model.module
@@ -447,7 +457,7 @@ def train(model, retr_model,
     model.overwrite_forward_crossattention()
     model.reset_score_storage() 
     assert(Num_Answers == 1) 
-    num_batch = len(train_dataloader)
+    num_batch = len(get_batch_lst(train_dataset, train_dataloader, opt.per_gpu_batch_size, train_features))
     
     checkpoint_steps = num_batch
     #epoch_ckp_num = int(num_batch / checkpoint_steps)
@@ -466,10 +476,13 @@ def train(model, retr_model,
     for epoc in tqdm(range(opt.max_epoch), desc=epoc_bar_desc):
         metric_rec = MetricRecorder([1, 3, 5])
         bar_desc = 'data %d epoch %d train' % (opt.sql_batch_no, epoc)
-        for itr, fusion_batch in tqdm(enumerate(train_dataloader), total=num_batch, desc=bar_desc):
+        batch_lst = get_batch_lst(train_dataset, train_dataloader, opt.per_gpu_batch_size, 
+                                  train_features, shuffle=True)
+        for itr, fusion_batch in tqdm(enumerate(batch_lst), total=num_batch, desc=bar_desc):
             t1 = time.time()
             
-            scores, score_states, examples, context_mask = get_score_info(model, fusion_batch, train_dataset)
+            scores, score_states, examples, context_mask = get_batch_score_info(opt, model, fusion_batch, 
+                                                                                train_dataset, train_features)
             batch_data = get_batch_data(examples)
             opts = {}
             assert(retr_model.training)
@@ -508,7 +521,7 @@ def train(model, retr_model,
                     evaluate(epoc, model, retr_model,
                              eval_dataset, eval_dataloader,
                              tokenizer, opt, model_tag=model_tag, out_dir=out_dir, 
-                             model_file=checkpoint_model_file)
+                             model_file=checkpoint_model_file, feature_store=eval_features)
                 
                 if should_stop_train(opt, coreset_method=coreset_method):
                     break
@@ -573,24 +586,105 @@ def get_batch_data(fusion_examples):
 def get_score_info(model, batch_data, dataset):
     with torch.no_grad():
         (index_info, _, _, context_ids, context_mask, _) = batch_data
-        model.reset_score_storage()
-        outputs = model.generate(
-            input_ids=context_ids.cuda(),
-            attention_mask=context_mask.cuda(),
-            max_length=50,
-            num_beams=Num_Answers,
-            num_return_sequences=Num_Answers
-        )
-        crossattention_scores, score_states = model.get_crossattention_scores(context_mask.cuda())
+        crossattention_scores, score_states = model.score_passages(context_ids.cuda(), context_mask.cuda())
         num_passages = crossattention_scores.shape[1]
         batch_examples = []
         batch_idxes = index_info['index'] 
-        for k, _ in enumerate(outputs):
+        for k in range(len(context_ids)):
             example = dataset.data[batch_idxes[k]]
             example['ctxs'] = example['ctxs'][:num_passages]
             batch_examples.append(example)
     context_mask = context_mask.to(crossattention_scores.device)
     return crossattention_scores, score_states, batch_examples, context_mask
+
+def get_feature_score_info(feature_store, item_idxes, dataset, device):
+    """
+    The same as get_score_info with the FiD features read from the feature store.
+    """
+    batch_examples = [dataset.data[a] for a in item_idxes]
+    scores, answer_states, passage_states, passage_masks = feature_store.get_batch([a['id'] for a in batch_examples])
+    bsz, num_passages, num_tokens, emb_size = passage_states.shape
+    for example in batch_examples:
+        example['ctxs'] = example['ctxs'][:num_passages]
+    score_states = {
+        'answer_states':torch.from_numpy(answer_states).to(device).view(bsz, 1, 1, emb_size),
+        'query_passage_states':torch.from_numpy(passage_states).to(device).view(bsz, 1, -1, emb_size)
+    }
+    scores = torch.from_numpy(scores).to(device)
+    context_mask = torch.from_numpy(passage_masks).to(device)
+    return scores, score_states, batch_examples, context_mask
+
+def get_batch_score_info(opt, model, batch, dataset, feature_store):
+    if feature_store is None:
+        return get_score_info(model, batch, dataset)
+    return get_feature_score_info(feature_store, batch, dataset, opt.device)
+
+def get_batch_lst(dataset, dataloader, batch_size, feature_store, shuffle=False):
+    """
+    The collated batches of the dataloader, or batches of item indexes when the features are in the store.
+    """
+    if feature_store is None:
+        return dataloader
+    num_items = len(dataset)
+    item_idxes = torch.randperm(num_items).tolist() if shuffle else list(range(num_items))
+    return [item_idxes[pos:(pos + batch_size)] for pos in range(0, num_items, batch_size)]
+
+def get_feature_source(opt, data_file):
+    stat = os.stat(data_file)
+    source_info = {
+        'data_file':os.path.abspath(data_file),
+        'data_mtime':stat.st_mtime_ns,
+        'data_size':stat.st_size,
+        'model_path':os.path.abspath(opt.model_path),
+        'n_context':opt.n_context,
+        'text_maxlength':opt.text_maxlength
+    }
+    return source_info
+
+def extract_features(opt, model, dataset, collator, data_file):
+    """
+    Run FiD once over the examples of data_file and write the last-layer states and cross-attention scores
+    to the feature store next to it. A store for the same data, reader and settings is reused.
+    """
+    store_dir = fid_feature_store.get_store_dir(data_file)
+    source_info = get_feature_source(opt, data_file)
+    if fid_feature_store.is_valid_store(store_dir, source_info):
+        logger.info('using FiD features (%s)' % store_dir)
+        return fid_feature_store.FidFeatureStore(store_dir)
+
+    dataloader = DataLoader(
+        dataset,
+        sampler=SequentialSampler(dataset),
+        batch_size=opt.per_gpu_eval_batch_size,
+        num_workers=0,
+        collate_fn=collator
+    )
+    # upper bound, each example keeps the tokens up to its longest passage
+    max_store_gb = len(dataset) * opt.n_context * opt.text_maxlength * model.config.d_model * 2 / (1024 ** 3)
+    str_info = 'extracting FiD features to (%s), up to %.1f GB' % (store_dir, max_store_gb)
+    logger.info(str_info)
+    print(str_info)
+    model.eval()
+    model.overwrite_forward_crossattention()
+    model.reset_score_storage()
+    writer = fid_feature_store.FidFeatureStoreWriter(store_dir, source_info)
+    for fusion_batch in tqdm(dataloader, total=len(dataloader), desc='extract FiD features'):
+        scores, score_states, examples, context_mask = get_score_info(model, fusion_batch, dataset)
+        bsz, num_passages, num_tokens = context_mask.size()
+        scores = scores.float().cpu().numpy()
+        answer_states = score_states['answer_states'][:, -1, -1].float().cpu().numpy()
+        passage_states = score_states['query_passage_states'][:, -1].float().cpu().numpy()
+        passage_states = passage_states.reshape(bsz, num_passages, num_tokens, -1)
+        passage_masks = context_mask.cpu().numpy()
+        for idx, example in enumerate(examples):
+            # the tokens after the longest passage of the example are padding in every passage
+            item_tokens = max(int(passage_masks[idx].sum(axis=1).max()), 1)
+            writer.add(example['id'], scores[idx], answer_states[idx], 
+                       passage_states[idx, :, :item_tokens], passage_masks[idx, :, :item_tokens])
+    writer.close()
+    model.reset_score_storage()
+    logger.info('FiD features written to (%s)' % store_dir)
+    return fid_feature_store.FidFeatureStore(store_dir)
     
 def set_logger(opt):
     global logger
@@ -678,6 +772,12 @@ def main(opt, coreset_method=None):
     model = model_class.from_pretrained(opt.model_path)
     model = model.to(opt.device)
 
+    # the coreset statistics run FiD on the collated batches, so the features are not used with a coreset method
+    use_features = getattr(opt, 'fid_feature_cache', 0) and (not opt.multi_model_eval) and (coreset_method is None)
+    eval_features = None
+    if use_features and (eval_dataset is not None):
+        eval_features = extract_features(opt, model, eval_dataset, collator_function, opt.eval_data)
+
     if opt.do_train:
         train_examples = src.data.load_data(
             opt.train_data,
@@ -685,6 +785,9 @@ def main(opt, coreset_method=None):
             world_size=opt.world_size,
         )
         train_dataset = src.data.Dataset(train_examples, opt.n_context, sort_by_score=False)
+        train_features = None
+        if use_features:
+            train_features = extract_features(opt, model, train_dataset, collator_function, opt.train_data)
 
         #import pdb; pdb.set_trace()        
         train_data_dict = {}
@@ -694,7 +797,11 @@ def main(opt, coreset_method=None):
         best_metric = train(model, retr_model, 
                             train_dataset, collator_function,
                             eval_dataset, eval_dataloader, 
-                            tokenizer, opt, coreset_method=coreset_method, train_data_dict=train_data_dict)
+                            tokenizer, opt, coreset_method=coreset_method, train_data_dict=train_data_dict,
+                            train_features=train_features, eval_features=eval_features)
+        if train_features is not None:
+            # the train data of an iteration is not used again
+            shutil.rmtree(train_features.store_dir)
 
         msg_info = {
             'state':True,
@@ -706,7 +813,8 @@ def main(opt, coreset_method=None):
         if not opt.multi_model_eval:
             evaluate(0, model, retr_model,
                     eval_dataset, eval_dataloader,
-                    tokenizer, opt, out_dir=out_dir, num_samples=opt.bnn_num_eval_sample)
+                    tokenizer, opt, out_dir=out_dir, num_samples=opt.bnn_num_eval_sample,
+                    feature_store=eval_features)
             msg_info = {
                 'state':True,
                 'out_dir':out_dir
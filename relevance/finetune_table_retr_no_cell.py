@@ -576,18 +576,10 @@ def get_batch_data(fusion_examples):
 def get_score_info(model, batch_data, dataset):
     with torch.no_grad():
         (idx, _, _, context_ids, context_mask, _) = batch_data
-        model.reset_score_storage()
-        outputs = model.generate(
-            input_ids=context_ids.cuda(),
-            attention_mask=context_mask.cuda(),
-            max_length=50,
-            num_beams=Num_Answers,
-            num_return_sequences=Num_Answers
-        )
-        crossattention_scores, score_states = model.get_crossattention_scores(context_mask.cuda())
+        crossattention_scores, score_states = model.score_passages(context_ids.cuda(), context_mask.cuda())
         num_passages = crossattention_scores.shape[1]
         batch_examples = [] 
-        for k, _ in enumerate(outputs):
+        for k in range(len(context_ids)):
             example = dataset.data[idx[k]]
             example['ctxs'] = example['ctxs'][:num_passages]
             batch_examples.append(example)
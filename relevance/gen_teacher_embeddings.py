@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import transformers
+from tqdm import tqdm
+
+import src.data
+import passage_ondisk_retrieval as retriever
+from src import teacher_emb_store
+from src import line_index
+
+def encode_batch(opt, model, collator, ctx_lst, writer):
+    input_passages = [retriever.get_annotated_passage(ctx) for ctx in ctx_lst]
+    p_ids = [ctx['id'] for ctx in ctx_lst]
+    emb_lst = [a.float().cpu().numpy() for a in retriever.embed_passages(opt, model, collator, input_passages)]
+    offset = 0
+    for embs in emb_lst:
+        writer.add(p_ids[offset:(offset + len(embs))], embs)
+        offset += len(embs)
+
+def read_passages(passage_file, next_p_id):
+    # p_ids are contiguous in the file, so the first passage not in the store is found by its line offset
+    start_line = 0
+    if next_p_id is not None:
+        with open(passage_file) as f:
+            first_p_id = int(json.loads(f.readline())['p_id'])
+        start_line = max(next_p_id - first_p_id, 0)
+    for line in line_index.read_lines(passage_file, start_line=start_line):
+        yield json.loads(line)
+
+def main(opt):
+    """
+    Encode the passages with the teacher retriever into the teacher embedding store,
+    with append, only the passages after the last one in the store are encoded.
+    """
+    append = opt.append and teacher_emb_store.exists_store(opt.store_dir)
+    writer = teacher_emb_store.TeacherEmbStoreWriter(opt.store_dir, opt.emb_dtype, append=append)
+    next_p_id = writer.get_next_p_id()
+
+    model = retriever.get_model(False, opt.model_path, opt.no_fp16)
+    tokenizer = transformers.BertTokenizerFast.from_pretrained('bert-base-uncased')
+    collator = src.data.TextCollator(tokenizer, model.config.passage_maxlength)
+
+    ctx_lst = []
+    for item in tqdm(read_passages(opt.passages, next_p_id), disable=not opt.show_progress):
+        ctx_lst.append({'id':int(item['p_id']), 'text':item['passage'], 'title':''})
+        if len(ctx_lst) >= opt.batch_size:
+            encode_batch(opt, model, collator, ctx_lst, writer)
+            ctx_lst = []
+    if len(ctx_lst) > 0:
+        encode_batch(opt, model, collator, ctx_lst, writer)
+    writer.close()
+
+    model.cpu()
+    msg_info = {
+        'state':True,
+        'num_passages':writer.num_passages
+    }
+    return msg_info
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--passages', type=str, required=True, help='passages.jsonl in the index directory')
+    parser.add_argument('--store_dir', type=str, help='directory of the teacher embedding store')
+    parser.add_argument('--model_path', type=str, required=True, help='path to the teacher retriever')
+    parser.add_argument('--emb_dtype', type=str, default='float16', choices=teacher_emb_store.Emb_Dtypes)
+    parser.add_argument('--append', action='store_true', help='only encode the passages not in the store')
+    parser.add_argument('--batch_size', type=int, default=10000, help='number of passages read in one batch')
+    parser.add_argument('--no_fp16', action='store_true', help='inference in fp32')
+    parser.add_argument('--show_progress', type=int, default=1)
+    args = parser.parse_args()
+    if args.store_dir is None:
+        index_dir = os.path.dirname(os.path.abspath(args.passages))
+        args.store_dir = teacher_emb_store.get_store_dir(index_dir)
+    args.device = 'cuda'
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    main(args)
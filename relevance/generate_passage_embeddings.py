@@ -22,6 +22,9 @@ import src.slurm
 import sys
 from tqdm import tqdm
 import src.student_retriever
+from src import emb_shard
+from src import line_index
+from src import train_sample
 import queue
 import threading
 import glob
@@ -30,97 +33,246 @@ csv.field_size_limit(sys.maxsize)
 #logger = logging.getLogger(__name__)
 import time
 import json
+import traceback
 
 logger = None
 
-queue_token_tensor = queue.Queue(3)
-queue_output = queue.Queue(3)
 queue_output_stat = queue.Queue()
 opt = None
 g_title_prefix='title:'
 g_passage_prefix='context:'
-
-def tok_worker(start_idx, end_idx):
-    tokenizer = transformers.BertTokenizerFast.from_pretrained('bert-base-uncased')
-    collator = src.data.TextCollator(tokenizer, opt.passage_maxlength)
-    batch_passages = []
-    for idx, line in enumerate(src.util.read_passage(opt.passages)):
-        if idx < start_idx:
+Ckpt_Dir_Name = 'encode_ckpt'
+Ckpt_Meta_File = 'meta.json'
+
+def get_ckpt_dir(output_path):
+    return os.path.join(os.path.dirname(output_path), Ckpt_Dir_Name, os.path.basename(output_path))
+
+def write_json(data, out_file):
+    # write to a temp file first so that a crash never leaves a half written checkpoint
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(data))
+    os.replace(tmp_file, out_file)
+
+class ShardCheckpoint:
+    """
+    Encoding progress of a shard. For each tokenizer range, the byte position up to which
+    the passages are in finished parts, parts are recorded in part order once they are written.
+    """
+    def __init__(self, ckpt_dir, shard_id):
+        self.ckpt_file = os.path.join(ckpt_dir, 'shard_%d.json' % shard_id)
+        self.lock = threading.Lock()
+        self.pending_parts = {}
+        self.state = None
+        if os.path.isfile(self.ckpt_file):
+            with open(self.ckpt_file) as f:
+                self.state = json.load(f)
+
+    def exists(self):
+        return self.state is not None
+
+    def create(self, tok_ranges):
+        self.state = {
+            'tok_ranges':tok_ranges,
+            'parts':[],
+            'done':False
+        }
+        write_json(self.state, self.ckpt_file)
+
+    def get_tok_ranges(self):
+        tok_ranges = self.state['tok_ranges']
+        parts = self.state['parts']
+        if len(parts) == 0:
+            return tok_ranges
+        tok_pos = parts[-1]['tok_pos']
+        return [(tok_pos[idx], tok_ranges[idx][1]) for idx in range(len(tok_ranges))]
+
+    def get_num_parts(self):
+        return len(self.state['parts'])
+
+    def get_part_files(self):
+        return [part_info['out_file'] for part_info in self.state['parts']]
+
+    def add_part(self, part_info):
+        with self.lock:
+            parts = self.state['parts']
+            self.pending_parts[part_info['part_idx']] = part_info
+            while len(parts) in self.pending_parts:
+                parts.append(self.pending_parts.pop(len(parts)))
+            write_json(self.state, self.ckpt_file)
+
+    def set_done(self):
+        self.state['done'] = True
+        write_json(self.state, self.ckpt_file)
+
+def get_line_ranges(path, start_pos, end_pos, num_parts):
+    """
+    Split the byte range [start_pos, end_pos) of a jsonl file into num_parts ranges,
+    each range starts at the beginning of a line.
+    """
+    if line_index.exists_offsets(path):
+        return get_offset_ranges(path, start_pos, end_pos, num_parts)
+    bounds = [start_pos]
+    with open(path, 'rb') as f:
+        for part_idx in range(1, num_parts):
+            pos = start_pos + (end_pos - start_pos) * part_idx // num_parts
+            pos = max(pos, bounds[-1])
+            if pos > start_pos:
+                f.seek(pos - 1)
+                f.readline()
+                pos = min(f.tell(), end_pos)
+            bounds.append(pos)
+    bounds.append(end_pos)
+    range_lst = [(bounds[idx], bounds[idx + 1]) for idx in range(num_parts)]
+    return range_lst
+
+def get_offset_ranges(path, start_pos, end_pos, num_parts):
+    offsets = line_index.load_offsets(path)
+    bounds = [start_pos]
+    for part_idx in range(1, num_parts):
+        pos = start_pos + (end_pos - start_pos) * part_idx // num_parts
+        line_idx = np.searchsorted(offsets, pos)
+        pos = min(max(int(offsets[line_idx]), bounds[-1]), end_pos)
+        bounds.append(pos)
+    bounds.append(end_pos)
+    range_lst = [(bounds[idx], bounds[idx + 1]) for idx in range(num_parts)]
+    return range_lst
+
+def read_passage_range(path, start_pos, end_pos):
+    """
+    Yield each line in the byte range with the byte position after it.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start_pos)
+        pos = start_pos
+        while pos < end_pos:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode('utf-8'), pos
+
+def tok_worker(passages, w_idx, start_pos, end_pos, passage_maxlength, batch_size, token_queue):
+    try:
+        tokenizer = transformers.BertTokenizerFast.from_pretrained('bert-base-uncased')
+        collator = src.data.TextCollator(tokenizer, passage_maxlength)
+        batch_passages = []
+        batch_end_pos = start_pos
+        for line, line_end_pos in read_passage_range(passages, start_pos, end_pos):
+            if len(batch_passages) == batch_size:
+                token_queue.put((w_idx, batch_end_pos, collator(batch_passages)))
+                batch_passages = [] 
+                
+            passage_info = src.util.get_passage_info(line)
+            annoated_passage_info = src.data.TextDataset.annoate_passage(passage_info, g_title_prefix, g_passage_prefix)
+            batch_passages.append(annoated_passage_info)    
+            batch_end_pos = line_end_pos
+         
+        if len(batch_passages) > 0:
+            token_queue.put((w_idx, batch_end_pos, collator(batch_passages)))
+    except Exception:
+        # an item without end position is the error of the worker, raised by the encoder
+        token_queue.put((w_idx, None, traceback.format_exc()))
+        raise
+    # tell the encoder this worker is done
+    token_queue.put(None)
+
+
+def start_tok_workers(tok_ranges):
+    """
+    Tokenize the byte ranges of the shard, one process per range.
+    """
+    mp_context = torch.multiprocessing.get_context('spawn')
+    token_queue = mp_context.Queue(3 * len(tok_ranges))
+    worker_lst = []
+    for w_idx, (part_start, part_end) in enumerate(tok_ranges):
+        worker_args = (opt.passages, w_idx, part_start, part_end, opt.passage_maxlength,
+                       opt.per_gpu_batch_size, token_queue, )
+        worker = mp_context.Process(target=tok_worker, args=worker_args, daemon=True)
+        worker.start()
+        worker_lst.append(worker)
+    return token_queue, worker_lst
+
+def get_token_batch(token_queue, worker_lst, timeout=60):
+    """
+    Wait for the next tokenized batch, raise if a worker failed or was killed
+    before sending its end sentinel.
+    """
+    while True:
+        try:
+            batch_item = token_queue.get(timeout=timeout)
+        except queue.Empty:
+            for w_idx, worker in enumerate(worker_lst):
+                if (worker.exitcode is not None) and (worker.exitcode != 0):
+                    raise RuntimeError('tokenizer worker %d exited with code %d' % (w_idx, worker.exitcode))
             continue
-        elif idx >= end_idx:
-            break
-        if len(batch_passages) == opt.per_gpu_batch_size:
-            batch_data = collator(batch_passages)
-            updated_data = [batch_data[0], batch_data[1].to(opt.device), batch_data[2].to(opt.device)]
-            queue_token_tensor.put(updated_data)
-            batch_passages = [] 
-            
-        passage_info = src.util.get_passage_info(line)
-        annoated_passage_info = src.data.TextDataset.annoate_passage(passage_info, g_title_prefix, g_passage_prefix)
-        batch_passages.append(annoated_passage_info)    
-     
-    if len(batch_passages) > 0:
-        batch_data = collator(batch_passages)
-        updated_data = [batch_data[0], batch_data[1].to(opt.device), batch_data[2].to(opt.device)]
-        queue_token_tensor.put(updated_data)
-        batch_passages = [] 
-
-
-def start_tok_threading():
-    num_rows = g_passage_count
-    num_workers = 1
-    part_size = num_rows // num_workers
-
-    start_idx = 0
-    for w_idx in range(num_workers):
-        if w_idx < (num_workers - 1):
-            end_idx = start_idx + part_size
-        else:
-            end_idx = num_rows
-        threading.Thread(target=tok_worker, args=(start_idx, end_idx, )).start()
-        start_idx = end_idx
+        if (batch_item is not None) and (batch_item[1] is None):
+            raise RuntimeError('tokenizer worker %d failed\n%s' % (batch_item[0], batch_item[2]))
+        return batch_item
 
 
-def output_worker(part_idx):
-    data = queue_output.get()
+def output_worker(part_idx, data, ckpt):
     id_lst = data[0]
     emb_lst = data[1]
-    out_file = opt.output_path + "_part_" + str(part_idx)
-    with open(out_file, mode="wb") as f_o:
-        for offset, emb in enumerate(emb_lst):
-            out_data = [id_lst[offset], emb]
-            pickle.dump(out_data, f_o)
+    out_file = opt.shard_output_path + "_part_" + str(part_idx)
+    part_ids = [p_id for batch_ids in id_lst for p_id in batch_ids]
+    part_embs = np.concatenate(emb_lst, axis=0)
+    emb_shard.write_shard(out_file, part_ids, part_embs)
+    part_info = {
+        'part_idx':part_idx,
+        'out_file':out_file,
+        'num_passages':data[2],
+        'tok_pos':data[3]
+    }
+    ckpt.add_part(part_info)
 
     queue_output_stat.put([part_idx, data[2], out_file])
 
 
-def start_output_threading(results, part_idx):
-    queue_output.put(results)
-    threading.Thread(target=output_worker, args=(part_idx, )).start()
-
-def embed_passages(model, retriever):
-    start_tok_threading()
-
-    num_passages = g_passage_count
+def start_output_threading(results, part_idx, ckpt):
+    threading.Thread(target=output_worker, args=(part_idx, results, ckpt, )).start()
+
+def embed_batch(model, retriever, text_ids, text_mask):
+    with torch.no_grad():
+        embeddings = model.embed_text(
+            text_ids=text_ids.to(opt.device), 
+            text_mask=text_mask.to(opt.device), 
+            apply_mask=retriever.config.apply_passage_mask,
+            extract_cls=retriever.config.extract_cls,
+        )
+    return embeddings.cpu().numpy()
+
+def get_sample_name(shard_id):
+    return os.path.basename(opt.output_path) + '_shard_' + str(shard_id)
+
+def remove_samples(output_path):
+    sample_pattern = os.path.join(train_sample.get_sample_dir(output_path), os.path.basename(output_path) + '_*')
+    for sample_file in glob.glob(sample_pattern):
+        os.remove(sample_file)
+
+def embed_passages(model, retriever, ckpt, sample):
+    tok_ranges = ckpt.get_tok_ranges()
+    tok_pos = [start_pos for start_pos, _ in tok_ranges]
+    token_queue, tok_worker_lst = start_tok_workers(tok_ranges)
+    num_done_workers = 0
     total = 0
-    output_part_idx = 0
-    output_data = [[], [], 0]
+    output_part_idx = ckpt.get_num_parts()
+    num_start_parts = output_part_idx
+    output_data = [[], [], 0, None]
 
     t1 = time.time()    
     while True:
-        batch_data = queue_token_tensor.get() 
-        #t2 = time.time()
+        batch_item = get_token_batch(token_queue, tok_worker_lst)
+        if batch_item is None:
+            num_done_workers += 1
+            if num_done_workers == len(tok_ranges):
+                break
+            continue
+        w_idx, batch_end_pos, batch_data = batch_item
+        tok_pos[w_idx] = batch_end_pos
         ids, text_ids, text_mask = batch_data
-        with torch.no_grad():
-            embeddings = model.embed_text(
-                text_ids=text_ids, 
-                text_mask=text_mask, 
-                apply_mask=retriever.config.apply_passage_mask,
-                extract_cls=retriever.config.extract_cls,
-            )
-        embeddings = embeddings.cpu().numpy()
-        #t3 = time.time()
-        #print('embed t3-t2 = ', t3-t2)
+        embeddings = embed_batch(model, retriever, text_ids, text_mask)
+        sample.add(embeddings)
         output_data[0].append(ids)
         output_data[1].append(embeddings)
         output_data[2] += len(ids)
@@ -128,26 +280,28 @@ def embed_passages(model, retriever):
         total += len(ids)
         
         if total % (2 * opt.per_gpu_batch_size) == 0:
-            logger.info('Encoded passages %d', total)
+            logger.info('Shard %d encoded passages %d', opt.shard_id, total)
         
         if output_data[2] >= opt.output_batch_size:
-            start_output_threading(output_data, output_part_idx)
+            output_data[3] = list(tok_pos)
+            sample.save()
+            start_output_threading(output_data, output_part_idx, ckpt)
             output_part_idx += 1
-            output_data = [[], [], 0]
-        
-        if total == num_passages:
-            break
+            output_data = [[], [], 0, None]
     
     if output_data[2] > 0:
-        start_output_threading(output_data, output_part_idx)
+        output_data[3] = list(tok_pos)
+        start_output_threading(output_data, output_part_idx, ckpt)
         output_part_idx += 1
-        output_data = [[], [], 0]
+        output_data = [[], [], 0, None]
     t2 = time.time()
     print('encode time ', t2-t1) 
-    return output_part_idx 
+    return output_part_idx - num_start_parts
 
 
 def show_output_stat(num_output_parts):
+    if num_output_parts == 0:
+        return
     num_part = 0
     output_size = 0
     while True:
@@ -163,36 +317,24 @@ def show_output_stat(num_output_parts):
     logger.info("Total passages processed %d.", output_size)
 
  
-def main(args, is_main):
-    global opt
-    opt = args
-    assert opt.is_student is not None
-    assert opt.output_path is not None
-    src.slurm.init_distributed_mode(opt)
-    assert opt.world_size == 1
-
-    global logger
-    output_dir = os.path.dirname(opt.output_path)
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-
-    log_file = os.path.join(output_dir, 'log.txt')
-    logger = src.util.init_logger(is_main, opt.is_distributed, log_file)
-    logger.setLevel(logging.INFO)
-
-    out_files = glob.glob(opt.output_path + '*') 
-    if len(out_files) > 0:
-        msg_txt = '(%s*) already exists' % opt.output_path
-        logger.info(msg_txt)
-        msg_info = {
-            'state':False,
-            'msg':msg_txt
-        }
-        return msg_info
-    output_dir = os.path.dirname(opt.output_path)
-    if not os.path.isdir(output_dir):
-        os.makedirs(output_dir) 
-
+def get_num_shards(args):
+    if args.num_shards > 0:
+        return args.num_shards
+    # one shard per gpu by default
+    return max(torch.cuda.device_count(), 1)
+
+def get_shard_output_path(args, shard_id):
+    if args.num_shards == 1:
+        return args.output_path
+    return args.output_path + '_shard_' + str(shard_id)
+
+def get_shard_device(shard_id):
+    num_gpus = torch.cuda.device_count()
+    if num_gpus == 0:
+        return torch.device('cpu')
+    return torch.device('cuda', shard_id % num_gpus)
+
+def load_model(opt):
     if opt.is_student:
         model_class = src.student_retriever.StudentRetriever
     else:
@@ -209,18 +351,238 @@ def main(args, is_main):
     else:
         model = retriever.ctx_encoder
      
-     
     model.eval()
     model = model.to(opt.device)
     if not opt.no_fp16:
         model = model.half()
-    
-    global g_passage_count
-    g_passage_count = src.util.count_passages(args.passages)
+    return model, retriever
+
+def get_text_tokenizer():
+    return transformers.BertTokenizerFast.from_pretrained('bert-base-uncased')
+
+def tokenize_passages(tokenizer, passage_lst, passage_maxlength):
+    """
+    Tokenize raw triple texts the same way as TextCollator, numpy arrays are returned
+    so that they can be sent cheaply between processes.
+    """
+    text_lst = []
+    for passage in passage_lst:
+        _, text = src.data.TextDataset.annoate_passage((None, passage, ''), g_title_prefix, g_passage_prefix)
+        text_lst.append(text)
+    encoded_batch = tokenizer.batch_encode_plus(
+        text_lst,
+        pad_to_max_length=True,
+        return_tensors="np",
+        max_length=passage_maxlength,
+        truncation=True
+    )
+    return encoded_batch['input_ids'], encoded_batch['attention_mask']
+
+class StreamEncoder:
+    """
+    Encode passages which are tokenized by the producer, e.g. the triple generation workers,
+    so they are encoded as they are generated instead of being read back from the passage file.
+    Embeddings are written to <output_path>_part_<n> as in main.
+    """
+    def __init__(self, args):
+        global opt
+        opt = args
+        opt.shard_id = 0
+        opt.shard_output_path = opt.output_path
+        opt.device = get_shard_device(0)
+        
+        global logger
+        output_dir = os.path.dirname(opt.output_path)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        log_file = os.path.join(output_dir, 'log.txt')
+        logger = src.util.init_logger(True, False, log_file)
+        logger.setLevel(logging.INFO)
+        
+        out_files = glob.glob(opt.output_path + '*')
+        if len(out_files) > 0:
+            raise ValueError('(%s*) already exists' % opt.output_path)
+        remove_samples(opt.output_path)
+        self.sample = train_sample.ReservoirSample(train_sample.get_sample_dir(opt.output_path),
+                                                   get_sample_name(0), opt.train_sample_size)
+        self.model, self.retriever = load_model(opt)
+        self.passage_maxlength = opt.passage_maxlength
+        self.buffer = [[], [], [], 0]
+        self.output_data = [[], [], 0]
+        self.part_idx = 0
+        self.total = 0
+
+    def add(self, p_ids, text_ids, text_mask):
+        self.buffer[0].append(np.asarray(p_ids, dtype=np.int64))
+        self.buffer[1].append(text_ids)
+        self.buffer[2].append(text_mask)
+        self.buffer[3] += len(p_ids)
+        if self.buffer[3] >= opt.per_gpu_batch_size:
+            self.encode_buffer(flush=False)
+
+    def encode_buffer(self, flush):
+        if self.buffer[3] == 0:
+            return
+        all_p_ids = np.concatenate(self.buffer[0])
+        all_text_ids = np.concatenate(self.buffer[1])
+        all_text_mask = np.concatenate(self.buffer[2])
+        batch_size = opt.per_gpu_batch_size
+        pos = 0
+        while (len(all_p_ids) - pos >= batch_size) or (flush and pos < len(all_p_ids)):
+            end_pos = pos + batch_size
+            text_ids = torch.from_numpy(all_text_ids[pos:end_pos])
+            text_mask = torch.from_numpy(all_text_mask[pos:end_pos]).bool()
+            embeddings = embed_batch(self.model, self.retriever, text_ids, text_mask)
+            self.sample.add(embeddings)
+            self.output_data[0].append(all_p_ids[pos:end_pos])
+            self.output_data[1].append(embeddings)
+            self.output_data[2] += len(embeddings)
+            self.total += len(embeddings)
+            pos = end_pos
+            if self.output_data[2] >= opt.output_batch_size:
+                self.write_part()
+        self.buffer = [[all_p_ids[pos:]], [all_text_ids[pos:]], [all_text_mask[pos:]], len(all_p_ids[pos:])]
+
+    def write_part(self):
+        if self.output_data[2] == 0:
+            return
+        out_file = opt.shard_output_path + "_part_" + str(self.part_idx)
+        part_ids = np.concatenate(self.output_data[0])
+        part_embs = np.concatenate(self.output_data[1], axis=0)
+        emb_shard.write_shard(out_file, part_ids, part_embs)
+        logger.info("Passages part %d processed %d. Written to %s", self.part_idx, self.output_data[2], out_file)
+        self.part_idx += 1
+        self.output_data = [[], [], 0]
+
+    def close(self):
+        self.encode_buffer(flush=True)
+        self.write_part()
+        self.sample.save()
+        logger.info("Total passages processed %d.", self.total)
+        msg_info = {
+            'state':True,
+            'out_file':str(opt.output_path)
+        }
+        return msg_info
 
+def encode_shard(shard_id, args, is_main):
+    """
+    Encode the byte range of the passage file assigned to the shard,
+    the embeddings are written to the shard's own parts.
+    """
+    global opt
+    opt = args
+    opt.shard_id = shard_id
+    opt.shard_output_path = get_shard_output_path(opt, shard_id)
+    opt.device = get_shard_device(shard_id)
+
+    global logger
+    output_dir = os.path.dirname(opt.output_path)
+    log_file = os.path.join(output_dir, 'log.txt')
+    logger = src.util.init_logger(is_main and (shard_id == 0), False, log_file)
+    logger.setLevel(logging.INFO)
 
-    num_output_parts = embed_passages(model, retriever)
+    ckpt = ShardCheckpoint(get_ckpt_dir(opt.output_path), shard_id)
+    if ckpt.exists():
+        if ckpt.state['done']:
+            logger.info('Shard %d is already encoded', shard_id)
+            return
+        resume_shard(ckpt)
+    else:
+        start_pos, end_pos = opt.shard_ranges[shard_id]
+        tok_ranges = get_line_ranges(opt.passages, start_pos, end_pos, opt.num_tok_workers)
+        ckpt.create(tok_ranges)
+
+    # the training sample of the shard, the index is trained on the samples of all shards
+    sample_size = (opt.train_sample_size + opt.num_shards - 1) // opt.num_shards
+    sample = train_sample.ReservoirSample(train_sample.get_sample_dir(opt.output_path),
+                                          get_sample_name(shard_id), sample_size, seed=shard_id)
+    model, retriever = load_model(opt)
+    num_output_parts = embed_passages(model, retriever, ckpt, sample)
     show_output_stat(num_output_parts)
+    sample.save()
+    ckpt.set_done()
+
+def resume_shard(ckpt):
+    """
+    Remove the part files of the shard which were not recorded in the checkpoint,
+    the encoding restarts after the last recorded part.
+    """
+    part_file_set = set(ckpt.get_part_files())
+    for part_file in glob.glob(opt.shard_output_path + '_part_*'):
+        if part_file not in part_file_set:
+            os.remove(part_file)
+    logger.info('Shard %d resumed after %d parts', opt.shard_id, ckpt.get_num_parts())
+
+def main(args, is_main):
+    global opt
+    opt = args
+    assert opt.is_student is not None
+    assert opt.output_path is not None
+    src.slurm.init_distributed_mode(opt)
+    opt.num_shards = get_num_shards(opt)
+
+    global logger
+    output_dir = os.path.dirname(opt.output_path)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    log_file = os.path.join(output_dir, 'log.txt')
+    logger = src.util.init_logger(is_main, opt.is_distributed, log_file)
+    logger.setLevel(logging.INFO)
+
+    ckpt_dir = get_ckpt_dir(opt.output_path)
+    ckpt_meta_file = os.path.join(ckpt_dir, Ckpt_Meta_File)
+    if os.path.isfile(ckpt_meta_file):
+        # resume the shards from their checkpoints
+        with open(ckpt_meta_file) as f:
+            ckpt_meta = json.load(f)
+        if ckpt_meta['num_shards'] != opt.num_shards:
+            msg_txt = 'Checkpoint (%s) was created with %d shards, not %d' % (
+                       ckpt_dir, ckpt_meta['num_shards'], opt.num_shards)
+            logger.info(msg_txt)
+            msg_info = {
+                'state':False,
+                'msg':msg_txt
+            }
+            return msg_info
+        logger.info('Resuming from checkpoint (%s)', ckpt_dir)
+    else:
+        if opt.shard_id < 0:
+            out_file_pattern = opt.output_path + '*'
+        else:
+            out_file_pattern = get_shard_output_path(opt, opt.shard_id) + '_part_*'
+        out_files = glob.glob(out_file_pattern) 
+        if len(out_files) > 0:
+            msg_txt = '(%s) already exists' % out_file_pattern
+            logger.info(msg_txt)
+            msg_info = {
+                'state':False,
+                'msg':msg_txt
+            }
+            return msg_info
+        if not os.path.isdir(ckpt_dir):
+            os.makedirs(ckpt_dir)
+        remove_samples(opt.output_path)
+        file_size = os.path.getsize(opt.passages)
+        ckpt_meta = {
+            'num_shards':opt.num_shards,
+            'shard_ranges':get_line_ranges(opt.passages, 0, file_size, opt.num_shards)
+        }
+        write_json(ckpt_meta, ckpt_meta_file)
+    opt.shard_ranges = ckpt_meta['shard_ranges']
+
+    t1 = time.time()
+    if opt.shard_id >= 0:
+        # only encode the given shard, other shards are run by other jobs
+        encode_shard(opt.shard_id, opt, is_main)
+    elif opt.num_shards == 1:
+        encode_shard(0, opt, is_main)
+    else:
+        logger.info('Encoding with %d shards', opt.num_shards)
+        torch.multiprocessing.spawn(encode_shard, args=(opt, is_main), nprocs=opt.num_shards)
+    t2 = time.time()
+    print('encode time ', t2-t1) 
 
     msg_info = {
         'state':True,
@@ -234,8 +596,10 @@ if __name__ == '__main__':
     parser.add_argument('--show_progress', type=int, default=True)
     parser.add_argument('--passages', type=str, default=None, help='Path to passages (.jsonl file)')
     parser.add_argument('--output_path', type=str, help='file prefix to store embeddings')
-    parser.add_argument('--shard_id', type=int, default=0, help="Id of the current shard")
-    parser.add_argument('--num_shards', type=int, default=1, help="Total number of shards")
+    parser.add_argument('--shard_id', type=int, default=-1, help="Id of the shard to encode, -1 to encode all shards")
+    parser.add_argument('--num_shards', type=int, default=1, help="Total number of shards, 0 for one shard per gpu")
+    parser.add_argument('--num_tok_workers', type=int, default=2, help="Number of tokenizer processes per shard")
+    parser.add_argument('--train_sample_size', type=int, default=0, help="Number of embeddings sampled to train the index, 0 for no sample")
     parser.add_argument('--per_gpu_batch_size', type=int, default=32, help="Batch size to encode passages")
     parser.add_argument('--output_batch_size', type=int, default=5000000, help="Batch size to output embeddings")
     parser.add_argument('--passage_maxlength', type=int, help="Maximum number of tokens in a passage")
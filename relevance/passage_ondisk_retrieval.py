@@ -22,6 +22,7 @@ import src.slurm
 import src.util
 import src.model
 import src.data
+import src.emb_cache
 
 from src.ondisk_index import OndiskIndexer
 from torch.utils.data import DataLoader
@@ -32,38 +33,88 @@ logger = logging.getLogger(__name__)
 g_title_prefix='title:'
 g_passage_prefix='context:'
 
-def retrieve_data(opt, index, data, student_model, teacher_model, tokenizer, f_o):
-    batch_size = 1
+def encode_questions(opt, student_model, question_ids, question_mask):
+    out_emb = student_model.question_encoder.embed_text(
+        text_ids=question_ids.to(opt.device).view(-1, question_ids.size(-1)), 
+        text_mask=question_mask.to(opt.device).view(-1, question_ids.size(-1)), 
+        apply_mask=student_model.config.apply_question_mask,
+        extract_cls=student_model.config.extract_cls,
+    )
+    query_emb = out_emb.cpu().numpy()
+    return query_emb
+
+def set_item_ctxs(data_item, item_result):
+    ctxs_num = len(item_result)
+    data_item['ctxs'] =[
+        {
+            'id': int(item_result[c]['p_id']),
+            'title': '',
+            'text': item_result[c]['passage'],
+            'score': float(item_result[c]['score']),
+            'tag':item_result[c]['tag']
+        } for c in range(ctxs_num)
+    ]
+
+def search_index(opt, index, query_emb, time_budget=None):
+    """
+    Probe n_probe lists per question, or adaptively from min_probe up to n_probe lists
+    if min_probe < n_probe. time_budget (seconds) only applies to the adaptive search.
+    If collapse_tables > 0, the hits are collapsed into the best collapse_per_table triples 
+    of the best collapse_tables tables.
+    """
+    if opt.collapse_tables > 0:
+        return index.table_search(query_emb, top_tables=opt.collapse_tables, per_table=opt.collapse_per_table,
+                                  n_probe=opt.n_probe, max_retr=opt.max_retr)
+    if opt.min_probe < opt.n_probe:
+        if time_budget is None and opt.retr_time_budget > 0:
+            time_budget = opt.retr_time_budget
+        return index.adaptive_search(query_emb, top_n=opt.n_docs, min_tables=opt.min_tables, 
+                                     max_retr=opt.max_retr, min_probe=opt.min_probe, 
+                                     max_probe=opt.n_probe, time_budget=time_budget)
+    return index.batch_search(query_emb, top_n=opt.n_docs, n_probe=opt.n_probe, 
+                              min_tables=opt.min_tables, max_retr=opt.max_retr)
+
+def retrieve_question(opt, index, data_item, question_ids, question_mask, 
+                      student_model, teacher_model, passage_collator, time_budget=None, emb_cache=None):
+    """
+    Retrieve and teacher-rerank the triples of one question in memory, 
+    the ctxs of data_item are replaced by the reranked triples.
+    """
+    with torch.no_grad():
+        query_emb = encode_questions(opt, student_model, question_ids, question_mask)
+    batch_p_ids, batch_scores, _ = search_index(opt, index, query_emb, time_budget=time_budget)
+    assert(1 == len(batch_p_ids))
+    item_result = index.get_passages(batch_p_ids[0], batch_scores[0])
+    set_item_ctxs(data_item, item_result)
+    teacher_rerank(opt, teacher_model, passage_collator, question_ids, question_mask, data_item,
+                   emb_store=index.teacher_emb_store, emb_cache=emb_cache)
+    return data_item
+
+def trim_question(question_ids, question_mask, b_idx):
+    # keep the question at its own length, so the embedding does not depend on batch padding
+    q_len = int(question_mask[b_idx].sum())
+    return question_ids[b_idx:(b_idx+1), :, :q_len], question_mask[b_idx:(b_idx+1), :, :q_len]
+
+def retrieve_data(opt, index, data, student_model, teacher_model, tokenizer, f_o, emb_cache=None):
+    batch_size = opt.retr_batch_size
     dataset = src.data.Dataset(data, ignore_context=True)
     collator = src.data.Collator(opt.question_maxlength, tokenizer)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=1, collate_fn=collator)
     passage_collator = src.data.TextCollator(tokenizer, teacher_model.config.passage_maxlength)
-    with torch.no_grad():
-        for batch in tqdm(dataloader):
-            (index_info, _, _, question_ids, question_mask, _) = batch
-            out_emb = student_model.question_encoder.embed_text(
-                text_ids=question_ids.to(opt.device).view(-1, question_ids.size(-1)), 
-                text_mask=question_mask.to(opt.device).view(-1, question_ids.size(-1)), 
-                apply_mask=student_model.config.apply_question_mask,
-                extract_cls=student_model.config.extract_cls,
-            )
-            query_emb = out_emb.cpu().numpy()
-            result_lst = index.search(query_emb, top_n=opt.n_docs, n_probe=512, 
-                                      min_tables=opt.min_tables, max_retr=opt.max_retr)
-            assert(1 == len(result_lst))
-            item_result = result_lst[0]
-            data_item = data[index_info['index'][0]]
-            ctxs_num = len(item_result)
-            data_item['ctxs'] =[
-                {
-                    'id': int(item_result[c]['p_id']),
-                    'title': '',
-                    'text': item_result[c]['passage'],
-                    'score': float(item_result[c]['score']),
-                    'tag':item_result[c]['tag']
-                } for c in range(ctxs_num)
-            ]
-            teacher_rerank(opt, teacher_model, passage_collator, question_ids, question_mask, data_item)       
+    for batch in tqdm(dataloader):
+        (index_info, _, _, question_ids, question_mask, _) = batch
+        batch_questions = [trim_question(question_ids, question_mask, b_idx) for b_idx in range(len(question_ids))]
+        with torch.no_grad():
+            emb_lst = [encode_questions(opt, student_model, a[0], a[1]) for a in batch_questions]
+        query_emb = np.vstack(emb_lst)
+        batch_p_ids, batch_scores, _ = search_index(opt, index, query_emb)
+        for b_idx, item_idx in enumerate(index_info['index']):
+            data_item = data[item_idx]
+            item_result = index.get_passages(batch_p_ids[b_idx], batch_scores[b_idx])
+            set_item_ctxs(data_item, item_result)
+            item_question_ids, item_question_mask = batch_questions[b_idx]
+            teacher_rerank(opt, teacher_model, passage_collator, item_question_ids, item_question_mask, data_item,
+                           emb_store=index.teacher_emb_store, emb_cache=emb_cache)
             f_o.write(json.dumps(data_item) + '\n') 
 
 def group_table_passages(item):
@@ -79,15 +130,14 @@ def group_table_passages(item):
 
     return table_lst, table_dict 
 
-def sort_passages(opt, model, question_emb, collator, input_ctx_lst):
-    input_passages = []
-    for ctx in input_ctx_lst:
-        passage_info = [ctx['id'], ctx['text'], ctx['title']]
-        annoated_passage_info = src.data.TextDataset.annoate_passage(passage_info, g_title_prefix, g_passage_prefix)
-        input_passages.append(annoated_passage_info)
+def get_annotated_passage(ctx):
+    passage_info = [ctx['id'], ctx['text'], ctx['title']]
+    return src.data.TextDataset.annoate_passage(passage_info, g_title_prefix, g_passage_prefix)
 
-    batch_size = 1000
-    score_lst = []
+def embed_passages(opt, model, collator, input_passages, batch_size=1000):
+    """
+    Yield the teacher embeddings of the annotated passages batch by batch.
+    """
     for start_pos in range(0, len(input_passages), batch_size):
         batch_passages = input_passages[start_pos:(start_pos + batch_size)]
         _, text_ids, text_mask = collator(batch_passages)
@@ -98,16 +148,48 @@ def sort_passages(opt, model, question_emb, collator, input_ctx_lst):
                     apply_mask=model.config.apply_passage_mask,
                     extract_cls=model.config.extract_cls,
                 )  
+        yield passage_embeddings
+
+def sort_passages(opt, model, question_emb, collator, input_ctx_lst, emb_store=None, emb_cache=None):
+    """
+    The passages in the teacher embedding store or the embedding cache are scored with one matmul,
+    the others are encoded on the fly and put into the cache.
+    """
+    device = question_emb.device
+    all_scores = torch.zeros(len(input_ctx_lst), dtype=torch.float32, device=device)
+    p_id_lst = [ctx['id'] for ctx in input_ctx_lst]
+    encode_idxes = np.arange(len(input_ctx_lst))
+    with torch.no_grad():
+        for emb_source in [emb_store, emb_cache]:
+            if (emb_source is None) or (len(encode_idxes) == 0):
+                continue
+            found_pos, found_embs = emb_source.get_embs([p_id_lst[idx] for idx in encode_idxes])
+            if len(found_embs) > 0:
+                found_embs = torch.from_numpy(found_embs).to(device=device, dtype=question_emb.dtype)
+                found_idxes = torch.from_numpy(encode_idxes[found_pos]).to(device)
+                all_scores[found_idxes] = model.calc_score(question_emb, found_embs).view(-1).float()
+            encode_idxes = encode_idxes[~found_pos]
+
+        input_passages = [get_annotated_passage(input_ctx_lst[idx]) for idx in encode_idxes]
+        score_lst = []
+        offset = 0
+        for passage_embeddings in embed_passages(opt, model, collator, input_passages):
             batch_scores = model.calc_score(question_emb, passage_embeddings).view(-1)
             score_lst.append(batch_scores) 
+            if emb_cache is not None:
+                batch_p_ids = [p_id_lst[idx] for idx in encode_idxes[offset:(offset + len(passage_embeddings))]]
+                emb_cache.put(batch_p_ids, passage_embeddings.cpu().numpy())
+            offset += len(passage_embeddings)
+        if len(score_lst) > 0:
+            all_scores[torch.from_numpy(encode_idxes).to(device)] = torch.cat(score_lst).float()
     
-    all_scores = torch.cat(score_lst) 
     sorted_idxes = torch.argsort(-all_scores)
     sorted_idx_lst = sorted_idxes.cpu().numpy()
     return sorted_idx_lst
 
 
-def teacher_rerank(opt, model, passage_collator, question_ids, question_mask, data_item):
+def teacher_rerank(opt, model, passage_collator, question_ids, question_mask, data_item, 
+                   emb_store=None, emb_cache=None):
     with torch.no_grad():
         question_emb = model.embed_text(
             text_ids=question_ids.to(opt.device).view(-1, question_ids.size(-1)), 
@@ -117,7 +199,8 @@ def teacher_rerank(opt, model, passage_collator, question_ids, question_mask, da
         )
    
     ctx_lst = data_item['ctxs']
-    sorted_ctx_idxes = sort_passages(opt, model, question_emb, passage_collator, ctx_lst)
+    sorted_ctx_idxes = sort_passages(opt, model, question_emb, passage_collator, ctx_lst, 
+                                     emb_store=emb_store, emb_cache=emb_cache)
     sorted_ctx_lst = [ctx_lst[idx] for idx in sorted_ctx_idxes]
     data_item['ctxs'] = sorted_ctx_lst
 
@@ -154,7 +237,10 @@ def main(opt, index_obj=None):
     output_path.parent.mkdir(parents=True, exist_ok=True)
      
     with open(args.output_path, 'w') as f_o:
-        retrieve_data(opt, index, data, student_model, teacher_model, tokenizer, f_o)
+        emb_cache = src.emb_cache.create_cache(opt.teacher_cache_mb)
+        retrieve_data(opt, index, data, student_model, teacher_model, tokenizer, f_o, emb_cache=emb_cache)
+    if emb_cache is not None:
+        logger.info('teacher embedding cache %s' % str(emb_cache.get_stats()))
 
     student_model = student_model.cpu()
     teacher_model = teacher_model.cpu()
@@ -182,6 +268,17 @@ if __name__ == '__main__':
     parser.add_argument('--question_maxlength', type=int, default=50, help="Maximum number of tokens in a question")
     parser.add_argument('--min_tables', type=int, default=5) 
     parser.add_argument('--max_retr', type=int, default=10000, help='maximum number of vectors to retrieve')
+    parser.add_argument('--n_probe', type=int, default=512, help='maximum number of lists to probe per question')
+    parser.add_argument('--min_probe', type=int, default=512, 
+                        help='probe adaptively from min_probe lists if less than n_probe')
+    parser.add_argument('--retr_time_budget', type=float, default=0, 
+                        help='seconds to stop probing more lists in adaptive search, 0 for no limit')
+    parser.add_argument('--collapse_tables', type=int, default=0, 
+                        help='number of tables to collapse the hits into, 0 to return the raw hits')
+    parser.add_argument('--collapse_per_table', type=int, default=30, help='maximum triples kept per table')
+    parser.add_argument('--teacher_cache_mb', type=float, default=1024, 
+                        help='size of the teacher embedding cache in MB, 0 for no cache')
+    parser.add_argument('--retr_batch_size', type=int, default=64, help='number of questions searched in one batch')
 
     args = parser.parse_args()
     main(args)
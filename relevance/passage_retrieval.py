@@ -23,6 +23,7 @@ import src.model
 import src.student_retriever
 import src.data
 import src.index
+from src import emb_shard
 from tqdm import tqdm
 from torch.utils.data import DataLoader
 
@@ -52,7 +53,12 @@ def embed_questions(opt, data, model, tokenizer):
             yield out_emb
 
 
-def load_passage_emb(emb_file):
+def load_passage_emb(emb_file, chunk_size=100000):
+    if emb_shard.is_shard(emb_file):
+        p_ids, p_embs = emb_shard.open_shard(emb_file)
+        for pos in range(0, len(p_ids), chunk_size):
+            yield (list(p_ids[pos:(pos+chunk_size)]), np.array(p_embs[pos:(pos+chunk_size)]))
+        return
     with open(emb_file, 'rb') as f:
         while True:
             try:
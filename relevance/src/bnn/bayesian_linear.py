@@ -15,8 +15,10 @@ class Gaussian(object):
     def sigma(self):
         return torch.log1p(torch.exp(self.rho))
     
-    def sample(self):
-        epsilon = self.normal.sample(self.rho.size()).to(self.sigma.device)
+    def sample(self, num_samples=None):
+        # with num_samples, the samples are stacked in a new leading dimension
+        size = self.rho.size() if num_samples is None else (num_samples,) + self.rho.size()
+        epsilon = self.normal.sample(size).to(self.sigma.device)
         return self.mu + self.sigma * epsilon
     
     def log_prob(self, input_x):
@@ -69,7 +71,11 @@ class BayesianLinear(nn.Module):
         self.weight_prior = GaussianPrior(weight_mu_prior, weight_sigma_prior)
         self.bias_prior = GaussianPrior(bias_mu_prior, bias_sigma_prior)
 
-    def forward(self, input_x, sample=False, calculate_log_probs=False):
+    def forward(self, input_x, sample=False, calculate_log_probs=False, 
+                num_samples=None, include_mean=False, sampled_input=False):
+        if num_samples is not None:
+            return self.sample_forward(input_x, num_samples, include_mean=include_mean,
+                                       calculate_log_probs=calculate_log_probs, sampled_input=sampled_input)
         if self.training or sample:
             weight = self.weight.sample()
             bias = self.bias.sample()
@@ -84,4 +90,31 @@ class BayesianLinear(nn.Module):
 
         return F.linear(input_x, weight, bias)
 
-
+    def sample_forward(self, input_x, num_samples, include_mean=False, calculate_log_probs=False, sampled_input=False):
+        """
+        Evaluate num_samples weight samples at once (and the mean weights as the last one if include_mean),
+        the output has a leading sample dimension. With sampled_input, input_x already has the sample 
+        dimension, otherwise input_x is shared by all the samples.
+        The log probs are the means over the samples.
+        """
+        weight = self.weight.sample(num_samples)
+        bias = self.bias.sample(num_samples)
+        if (self.training or calculate_log_probs) and num_samples > 0:
+            self.log_prior = (self.weight_prior.log_prob(weight) + self.bias_prior.log_prob(bias)) / num_samples
+            self.log_variational_posterior = (self.weight.log_prob(weight) + self.bias.log_prob(bias)) / num_samples
+        else:
+            self.log_prior, self.log_variational_posterior = 0, 0
+        if include_mean:
+            weight = torch.cat([weight, self.weight.mu.unsqueeze(0)], dim=0)
+            bias = torch.cat([bias, self.bias.mu.unsqueeze(0)], dim=0)
+        
+        S = weight.size(0)
+        if sampled_input:
+            assert(input_x.size(0) == S)
+            out_shape = input_x.shape[:-1] + (self.out_features,)
+            input_x = input_x.reshape(S, -1, self.in_features)
+        else:
+            out_shape = (S,) + input_x.shape[:-1] + (self.out_features,)
+            input_x = input_x.reshape(1, -1, self.in_features).expand(S, -1, -1)
+        output = torch.baddbmm(bias.unsqueeze(1), input_x, weight.transpose(1, 2))
+        return output.view(out_shape)
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import numpy as np
+
+class EmbCache:
+    """
+    In-memory LRU cache of passage embeddings keyed by p_id, bounded by max_bytes.
+    The embeddings are kept as float16 rows. It has the same get_embs as the teacher embedding store.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.emb_dict = OrderedDict()
+        self.num_bytes = 0
+        self.dim = 0
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evicted = 0
+
+    def __len__(self):
+        return len(self.emb_dict)
+
+    def get_embs(self, p_ids):
+        """
+        Return a mask of the p_ids found in the cache and their float32 embeddings.
+        """
+        found_pos = np.zeros(len(p_ids), dtype=bool)
+        emb_lst = []
+        for idx, p_id in enumerate(p_ids):
+            emb = self.emb_dict.get(p_id, None)
+            if emb is not None:
+                self.emb_dict.move_to_end(p_id)
+                found_pos[idx] = True
+                emb_lst.append(emb)
+        num_found = len(emb_lst)
+        self.num_hits += num_found
+        self.num_misses += len(p_ids) - num_found
+        if num_found == 0:
+            return found_pos, np.zeros((0, self.dim), dtype=np.float32)
+        return found_pos, np.vstack(emb_lst).astype(np.float32)
+
+    def put(self, p_ids, embs):
+        embs = embs.astype(np.float16)
+        self.dim = embs.shape[1]
+        for p_id, emb in zip(p_ids, embs):
+            if p_id in self.emb_dict:
+                self.emb_dict.move_to_end(p_id)
+                continue
+            self.emb_dict[p_id] = emb.copy()
+            self.num_bytes += emb.nbytes
+        while self.num_bytes > self.max_bytes and len(self.emb_dict) > 0:
+            _, emb = self.emb_dict.popitem(last=False)
+            self.num_bytes -= emb.nbytes
+            self.num_evicted += 1
+
+    def get_stats(self):
+        num_lookups = self.num_hits + self.num_misses
+        stats = {
+            'size':len(self.emb_dict),
+            'bytes':self.num_bytes,
+            'hits':self.num_hits,
+            'misses':self.num_misses,
+            'evicted':self.num_evicted,
+            'hit_rate':(self.num_hits / num_lookups) if num_lookups > 0 else 0
+        }
+        return stats
+
+def create_cache(cache_mb):
+    if cache_mb <= 0:
+        return None
+    return EmbCache(int(cache_mb * 1024 * 1024))
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Shard layout: a fixed 32 byte header (magic, count, dim, dtype code),
+# then count int64 passage ids, then a contiguous count x dim embedding matrix.
+Shard_Magic = b'SOLOEMB1'
+Header_Size = 32
+Dtype_Codes = {
+    0:np.dtype(np.float32),
+    1:np.dtype(np.float16),
+}
+
+def get_dtype_code(dtype):
+    for code in Dtype_Codes:
+        if Dtype_Codes[code] == np.dtype(dtype):
+            return code
+    raise ValueError('embedding dtype (%s) not supported' % str(dtype))
+
+def is_shard(emb_file):
+    with open(emb_file, 'rb') as f:
+        magic = f.read(len(Shard_Magic))
+    return magic == Shard_Magic
+
+def write_shard(out_file, ids, embs):
+    ids = np.ascontiguousarray(ids, dtype=np.int64)
+    embs = np.ascontiguousarray(embs)
+    count, dim = embs.shape
+    assert(len(ids) == count)
+    header = np.array([count, dim, get_dtype_code(embs.dtype)], dtype=np.int64)
+    with open(out_file, 'wb') as f_o:
+        f_o.write(Shard_Magic)
+        f_o.write(header.tobytes())
+        f_o.write(ids.tobytes())
+        f_o.write(embs.tobytes())
+
+def read_header(emb_file):
+    with open(emb_file, 'rb') as f:
+        header_data = f.read(Header_Size)
+    if header_data[:len(Shard_Magic)] != Shard_Magic:
+        raise ValueError('(%s) is not an embedding shard' % emb_file)
+    count, dim, dtype_code = np.frombuffer(header_data[len(Shard_Magic):], dtype=np.int64)
+    return int(count), int(dim), Dtype_Codes[int(dtype_code)]
+
+def open_shard(emb_file):
+    """
+    Memory-map the ids and embeddings of a shard, nothing is read until rows are accessed.
+    """
+    count, dim, dtype = read_header(emb_file)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, dim), dtype=dtype)
+    ids = np.memmap(emb_file, dtype=np.int64, mode='r', offset=Header_Size, shape=(count,))
+    emb_offset = Header_Size + count * np.dtype(np.int64).itemsize
+    embs = np.memmap(emb_file, dtype=dtype, mode='r', offset=emb_offset, shape=(count, dim))
+    return ids, embs
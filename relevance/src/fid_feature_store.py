@@ -0,0 +1,142 @@
+import os
+import json
+import numpy as np
+
+# Last-layer FiD features of the examples in a data file, computed once and read by the relevance model
+# in every epoch. The passage states of an example are (n_passages * n_tokens) float16 rows, where n_tokens is
+# the longest passage of the example, the masks are uint8 and the cross-attention scores float32.
+Store_Suffix = '.fid_features'
+Meta_File = 'meta.json'
+Passage_State_File = 'passage_states.bin'
+Answer_State_File = 'answer_states.bin'
+Mask_File = 'masks.bin'
+Score_File = 'scores.bin'
+
+def get_store_dir(data_file):
+    return data_file + Store_Suffix
+
+def is_valid_store(store_dir, source_info):
+    """
+    The store can be reused if it was completed for the same data file, reader and settings.
+    """
+    meta_file = os.path.join(store_dir, Meta_File)
+    if not os.path.isfile(meta_file):
+        return False
+    with open(meta_file) as f:
+        meta_info = json.load(f)
+    return meta_info['source'] == source_info
+
+class FidFeatureStoreWriter:
+    """
+    Write the features example by example, meta.json is only written by close,
+    so an interrupted extraction is not taken as a valid store.
+    """
+    def __init__(self, store_dir, source_info):
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        meta_file = os.path.join(store_dir, Meta_File)
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        self.store_dir = store_dir
+        self.source_info = source_info
+        self.item_dict = {}
+        self.emb_size = None
+        self.num_passages = 0
+        self.num_rows = 0
+        self.f_passage = open(os.path.join(store_dir, Passage_State_File), 'wb')
+        self.f_answer = open(os.path.join(store_dir, Answer_State_File), 'wb')
+        self.f_mask = open(os.path.join(store_dir, Mask_File), 'wb')
+        self.f_score = open(os.path.join(store_dir, Score_File), 'wb')
+
+    def add(self, qid, scores, answer_state, passage_states, passage_mask):
+        """
+        scores (n_passages,), answer_state (emb_size,), passage_states (n_passages, n_tokens, emb_size)
+        and passage_mask (n_passages, n_tokens) of one example.
+        """
+        n_passages, n_tokens, emb_size = passage_states.shape
+        if self.emb_size is None:
+            self.emb_size = emb_size
+        assert(emb_size == self.emb_size)
+        self.f_passage.write(passage_states.astype(np.float16).tobytes())
+        self.f_answer.write(answer_state.astype(np.float16).tobytes())
+        self.f_mask.write(passage_mask.astype(np.uint8).tobytes())
+        self.f_score.write(scores.astype(np.float32).tobytes())
+        self.item_dict[str(qid)] = [len(self.item_dict), self.num_passages, self.num_rows, n_passages, n_tokens]
+        self.num_passages += n_passages
+        self.num_rows += n_passages * n_tokens
+
+    def close(self):
+        for f_o in [self.f_passage, self.f_answer, self.f_mask, self.f_score]:
+            f_o.close()
+        meta_info = {
+            'source':self.source_info,
+            'emb_size':self.emb_size,
+            'num_items':len(self.item_dict),
+            'num_passages':self.num_passages,
+            'num_rows':self.num_rows,
+            'items':self.item_dict
+        }
+        tmp_file = os.path.join(self.store_dir, Meta_File + '.tmp')
+        with open(tmp_file, 'w') as f_o:
+            f_o.write(json.dumps(meta_info))
+        os.replace(tmp_file, os.path.join(self.store_dir, Meta_File))
+
+class FidFeatureStore:
+    """
+    Read-only view of the features, memory-mapped and looked up by qid.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, Meta_File)) as f:
+            meta_info = json.load(f)
+        self.emb_size = meta_info['emb_size']
+        self.item_dict = meta_info['items']
+        self.passage_states = None
+        if meta_info['num_items'] > 0:
+            self.passage_states = self.open_data(Passage_State_File, np.float16, (meta_info['num_rows'], self.emb_size))
+            self.answer_states = self.open_data(Answer_State_File, np.float16, (meta_info['num_items'], self.emb_size))
+            self.masks = self.open_data(Mask_File, np.uint8, (meta_info['num_rows'],))
+            self.scores = self.open_data(Score_File, np.float32, (meta_info['num_passages'],))
+
+    def open_data(self, file_name, dtype, shape):
+        return np.memmap(os.path.join(self.store_dir, file_name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self):
+        return len(self.item_dict)
+
+    def __contains__(self, qid):
+        return str(qid) in self.item_dict
+
+    def get_item(self, qid):
+        row, passage_offset, row_offset, n_passages, n_tokens = self.item_dict[str(qid)]
+        num_rows = n_passages * n_tokens
+        scores = self.scores[passage_offset:(passage_offset + n_passages)]
+        answer_state = self.answer_states[row]
+        passage_states = self.passage_states[row_offset:(row_offset + num_rows)].reshape(n_passages, n_tokens, -1)
+        passage_mask = self.masks[row_offset:(row_offset + num_rows)].reshape(n_passages, n_tokens)
+        return scores, answer_state, passage_states, passage_mask
+
+    def get_batch(self, qid_lst):
+        """
+        Return the float32 features of the examples, the passages are padded to the longest in the batch.
+        scores (bsz, n_passages), answer_states (bsz, emb_size),
+        passage_states (bsz, n_passages, n_tokens, emb_size) and passage_masks (bsz, n_passages, n_tokens).
+        """
+        item_lst = [self.get_item(qid) for qid in qid_lst]
+        n_passages = item_lst[0][0].shape[0]
+        for item in item_lst:
+            if item[0].shape[0] != n_passages:
+                raise ValueError('examples in a batch must have the same number of passages')
+        bsz = len(item_lst)
+        n_tokens = max([item[3].shape[1] for item in item_lst])
+        scores = np.zeros((bsz, n_passages), dtype=np.float32)
+        answer_states = np.zeros((bsz, self.emb_size), dtype=np.float32)
+        passage_states = np.zeros((bsz, n_passages, n_tokens, self.emb_size), dtype=np.float32)
+        passage_masks = np.zeros((bsz, n_passages, n_tokens), dtype=bool)
+        for idx, (item_scores, answer_state, item_states, item_mask) in enumerate(item_lst):
+            item_tokens = item_mask.shape[1]
+            scores[idx] = item_scores
+            answer_states[idx] = answer_state
+            passage_states[idx, :, :item_tokens] = item_states
+            passage_masks[idx, :, :item_tokens] = item_mask
+        return scores, answer_states, passage_states, passage_masks
@@ -0,0 +1,140 @@
+import os
+import argparse
+import numpy as np
+
+# The sidecar of a jsonl file is <data_file>.offsets, an int64 array of N + 1 byte offsets,
+# line i is data[offsets[i]:offsets[i+1]] and offsets[N] is the size of the data file.
+Offset_Ext = '.offsets'
+Flush_Size = 1000000
+
+def get_offset_file(data_file):
+    return data_file + Offset_Ext
+
+def exists_offsets(data_file):
+    offset_file = get_offset_file(data_file)
+    if not (os.path.isfile(data_file) and os.path.isfile(offset_file)):
+        return False
+    size = os.path.getsize(offset_file)
+    if size == 0 or size % 8 != 0:
+        return False
+    # the sidecar is stale if the data file was changed without it
+    with open(offset_file, 'rb') as f:
+        f.seek(size - 8)
+        last_offset = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+    return last_offset == os.path.getsize(data_file)
+
+class LineOffsetFile:
+    """
+    A text file writer which records the byte offset of each line into the sidecar,
+    used in place of open(data_file, 'w') so that the offsets come from the same pass.
+    """
+    def __init__(self, data_file, mode='w'):
+        assert mode in ['w', 'a']
+        if mode == 'a' and os.path.isfile(data_file) and (not exists_offsets(data_file)):
+            build_offsets(data_file)
+        self.data_file = data_file
+        self.f_data = open(data_file, mode + 'b')
+        self.f_offset = open(get_offset_file(data_file), mode + 'b')
+        self.pos = self.f_data.tell()
+        self.last_offset = self.pos
+        self.offset_buffer = []
+        if self.f_offset.tell() == 0:
+            self.offset_buffer.append(self.pos)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.f_data.write(data)
+        line_end = data.find(b'\n')
+        while line_end >= 0:
+            self.last_offset = self.pos + line_end + 1
+            self.offset_buffer.append(self.last_offset)
+            line_end = data.find(b'\n', line_end + 1)
+        self.pos += len(data)
+        if len(self.offset_buffer) >= Flush_Size:
+            self.flush_offsets()
+
+    def flush_offsets(self):
+        if len(self.offset_buffer) > 0:
+            self.f_offset.write(np.array(self.offset_buffer, dtype=np.int64).tobytes())
+            self.offset_buffer = []
+
+    def close(self):
+        # a last line without newline still counts as a line
+        if self.pos != self.last_offset:
+            self.offset_buffer.append(self.pos)
+        self.flush_offsets()
+        self.f_data.close()
+        self.f_offset.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def build_offsets(data_file):
+    """
+    Scan an existing jsonl file once and write its sidecar.
+    """
+    with open(data_file, 'rb') as f_data, open(get_offset_file(data_file), 'wb') as f_offset:
+        pos = 0
+        offset_buffer = [pos]
+        for line in f_data:
+            pos += len(line)
+            offset_buffer.append(pos)
+            if len(offset_buffer) >= Flush_Size:
+                f_offset.write(np.array(offset_buffer, dtype=np.int64).tobytes())
+                offset_buffer = []
+        if len(offset_buffer) > 0:
+            f_offset.write(np.array(offset_buffer, dtype=np.int64).tobytes())
+
+def load_offsets(data_file, build=True):
+    """
+    Memory-map the sidecar of the data file, the sidecar is (re)built if missing or stale.
+    """
+    if not exists_offsets(data_file):
+        if not build:
+            return None
+        build_offsets(data_file)
+    return np.memmap(get_offset_file(data_file), dtype=np.int64, mode='r')
+
+def count_lines(data_file):
+    if not os.path.exists(data_file):
+        return 0
+    if exists_offsets(data_file):
+        return os.path.getsize(get_offset_file(data_file)) // 8 - 1
+    count = 0
+    with open(data_file, 'rb') as f:
+        for _ in f:
+            count += 1
+    return count
+
+def read_lines(data_file, start_line=0, end_line=None):
+    """
+    Yield the lines [start_line, end_line) by seeking to the byte offset of start_line.
+    """
+    offsets = load_offsets(data_file)
+    num_lines = len(offsets) - 1
+    if end_line is None or end_line > num_lines:
+        end_line = num_lines
+    if start_line >= end_line:
+        return
+    end_pos = int(offsets[end_line])
+    with open(data_file, 'rb') as f:
+        f.seek(int(offsets[start_line]))
+        pos = int(offsets[start_line])
+        while pos < end_pos:
+            line = f.readline()
+            pos += len(line)
+            yield line.decode('utf-8')
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_file', type=str, required=True, help='jsonl file to build the line offsets for')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    build_offsets(args.data_file)
+    print('%d lines in (%s)' % (count_lines(args.data_file), args.data_file))
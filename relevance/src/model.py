@@ -12,6 +12,8 @@ from torch import nn
 from torch.nn import CrossEntropyLoss
 import numpy as np
 
+Passage_Chunk_Size = 64
+
 class FiDT5(transformers.T5ForConditionalGeneration):
     def __init__(self, config):
         super().__init__(config)
@@ -57,6 +59,66 @@ class FiDT5(transformers.T5ForConditionalGeneration):
             opt_info = opt_info
         )
 
+    def score_passages(self, input_ids, attention_mask, passage_chunk_size=Passage_Chunk_Size):
+        """
+        Run the encoder and a single decoder step from the decoder start token.
+        The cross-attention scores are only stored on the first decoded token,
+        so this gives the same scores as generate without decoding the answer.
+        To save memory, the passages are encoded passage_chunk_size at a time, the attention hook
+        reduces the scores to per-passage sums and only the last layer's passage states are kept.
+        Return the same as get_crossattention_scores, with one layer of query_passage_states.
+        """
+        self.reset_score_storage()
+        bsz = input_ids.size(0)
+        self.encoder.n_passages = input_ids.size(1)
+        input_ids = input_ids.view(bsz, -1)
+        flat_mask = attention_mask.view(bsz, -1)
+        self.encoder.passage_chunk_size = passage_chunk_size
+        try:
+            encoder_outputs = self.encoder(input_ids=input_ids, attention_mask=flat_mask)
+        finally:
+            # forward and generate must not be chunked after an error here, e.g. an OOM
+            self.encoder.passage_chunk_size = None
+        for mod in self.decoder.block:
+            mod.layer[1].EncDecAttention.score_token_mask = attention_mask
+        decoder_input_ids = torch.full((bsz, 1), self.config.decoder_start_token_id, 
+                                       dtype=torch.long, device=input_ids.device)
+        self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_outputs[0],
+            encoder_attention_mask=flat_mask,
+            use_cache=False
+        )
+        return self.get_passage_scores(attention_mask)
+
+    def get_passage_scores(self, context_mask):
+        """
+        The same aggregation as get_crossattention_scores from the per-passage sums 
+        stored by the attention hook in score_passages.
+        """
+        scores = []
+        answer_states = []
+        for mod in self.decoder.block:
+            scores.append(mod.layer[1].EncDecAttention.score_storage)
+            score_answer_state = mod.layer[1].EncDecAttention.score_input_1
+            bsz, num_answers, emb_size = score_answer_state.size()
+            answer_states.append(score_answer_state.view(bsz, 1, num_answers, emb_size))
+        answer_states = torch.cat(answer_states, dim=1)
+        # the passage states (encoder output) are the same for all layers
+        last_attn = self.decoder.block[-1].layer[1].EncDecAttention
+        bsz, num_tokens, emb_size = last_attn.score_input_2.size()
+        query_passage_states = last_attn.score_input_2.view(bsz, 1, num_tokens, emb_size)
+        score_input_states = {
+            'answer_states':answer_states,
+            'query_passage_states':query_passage_states
+        }
+        n_layers = len(scores)
+        n_heads = last_attn.n_heads
+        scores = torch.stack(scores, dim=0).sum(dim=0)
+        ntokens = context_mask.sum(dim=[2]) * n_layers * n_heads
+        scores = scores / ntokens
+        return scores, score_input_states
+
     def wrap_encoder(self, use_checkpoint=False):
         """
         Wrap T5 encoder to obtain a Fusion-in-Decoder model.
@@ -94,6 +156,7 @@ class FiDT5(transformers.T5ForConditionalGeneration):
         """
         for mod in self.decoder.block:
             mod.layer[1].EncDecAttention.score_storage = None
+            mod.layer[1].EncDecAttention.score_token_mask = None
 
     def get_crossattention_scores(self, context_mask):
         """
@@ -158,6 +221,7 @@ class EncoderWrapper(torch.nn.Module):
         super().__init__()
 
         self.encoder = encoder
+        self.passage_chunk_size = None
         apply_checkpoint_wrapper(self.encoder, use_checkpoint)
 
     def forward(self, input_ids=None, attention_mask=None, **kwargs,):
@@ -166,7 +230,17 @@ class EncoderWrapper(torch.nn.Module):
         passage_length = total_length // self.n_passages
         input_ids = input_ids.view(bsz*self.n_passages, passage_length)
         attention_mask = attention_mask.view(bsz*self.n_passages, passage_length)
-        outputs = self.encoder(input_ids, attention_mask, **kwargs)
+        chunk_size = self.passage_chunk_size
+        if (chunk_size is None) or (len(input_ids) <= chunk_size):
+            outputs = self.encoder(input_ids, attention_mask, **kwargs)
+        else:
+            # only the last hidden states are kept when encoding in chunks
+            chunk_output_lst = []
+            for pos in range(0, len(input_ids), chunk_size):
+                chunk_outputs = self.encoder(input_ids[pos:(pos+chunk_size)], 
+                                             attention_mask[pos:(pos+chunk_size)], **kwargs)
+                chunk_output_lst.append(chunk_outputs[0])
+            outputs = (torch.cat(chunk_output_lst, dim=0), )
         outputs = (outputs[0].view(bsz, self.n_passages*passage_length, -1), ) + outputs[1:]
         return outputs
 
@@ -255,7 +329,13 @@ def cross_attention_forward(
     scores += position_bias
 
     if self.score_storage is None:
-        self.score_storage = scores
+        if self.score_token_mask is None:
+            self.score_storage = scores
+        else:
+            # per-passage sums over heads, query and the passage tokens
+            _, n_passages, passage_length = self.score_token_mask.size()
+            token_scores = scores.sum(dim=[1, 2]).view(bsz, n_passages, passage_length)
+            self.score_storage = token_scores.masked_fill(~self.score_token_mask, 0.).sum(dim=-1)
         self.score_input_1 = input
         self.score_input_2 = kv
 
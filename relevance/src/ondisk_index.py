@@ -11,11 +11,33 @@ import argparse
 import glob
 import math
 import time
+import shutil
+from src import passage_store
+from src import emb_shard
+from src import train_sample
+from src import teacher_emb_store
+
+Index_Ckpt_File = 'index_ckpt.json'
+Index_Plan_File = 'index_plan.json'
+Train_Per_List = 256
+Min_Train_Size = 4096 * 1024
+Max_Train_Size = 262144 * 64
 
 class OndiskIndexer:
     def __init__(self, index_file, passage_file):
         self.index = faiss.read_index(index_file, faiss.IO_FLAG_ONDISK_SAME_DIR)
-        self.passage_dict = self.load_passages(passage_file)
+        self.index_ivf = faiss.extract_index_ivf(self.index)
+        self.passage_store = None
+        self.passage_dict = None
+        store_dir = passage_store.get_store_dir(os.path.dirname(index_file))
+        if passage_store.exists_store(store_dir):
+            self.passage_store = passage_store.PassageStore(store_dir)
+        else:
+            self.passage_dict = self.load_passages(passage_file)
+        self.teacher_emb_store = None
+        teacher_store_dir = teacher_emb_store.get_store_dir(os.path.dirname(index_file))
+        if teacher_emb_store.exists_store(teacher_store_dir):
+            self.teacher_emb_store = teacher_emb_store.TeacherEmbStore(teacher_store_dir)
    
     def load_passages(self, passage_file):
         passage_dict = {} 
@@ -26,52 +48,283 @@ class OndiskIndexer:
                 passage_dict[int(p_id)] = item 
         return passage_dict
     
-    def search(self, query, top_n=100, n_probe=128, min_tables=5, max_retr=1000):
-        result = []
-        N = len(query)
-        for idx in range(0, N):
-            pos = idx + 1
-            batch_query = query[idx:pos]
-            satified=False
-            num_retr = top_n
-            item_passage_lst = []
-            while (not satified):
-                item_passage_lst = self.one_query_search(batch_query, top_n=num_retr, n_probe=n_probe)
-                table_lst = [a['tag']['table_id'] for a in item_passage_lst]
-                table_set = set(table_lst)
-                if (num_retr < max_retr) and  (len(table_set) < min_tables) :
-                    num_retr = max_retr
-                else:
-                    satified = True 
+    def get_passage_info(self, p_id):
+        if self.passage_store is not None:
+            return self.passage_store.get_passage(p_id)
+        return self.passage_dict[int(p_id)]
 
-            result.append(item_passage_lst)
-        return result
-         
-    def one_query_search(self, query, top_n=100, n_probe=128):
-        assert(len(query) == 1)
-        self.index.nprobe = n_probe
-        batch_dists, batch_p_ids = self.index.search(query, top_n)
-        item_result = []
+    def get_table_ids(self, p_ids):
+        if self.passage_store is not None:
+            return self.passage_store.get_table_ids(p_ids)
+        table_id_lst = [self.passage_dict[int(p_id)]['tag']['table_id'] for p_id in p_ids]
+        return np.array(table_id_lst, dtype=object)
 
-        p_id_lst = batch_p_ids[0]
-        p_dist_lst = batch_dists[0]
-        for idx, p_id in enumerate(p_id_lst):
-            if p_id == -1: #faiss may return -1 if there are not enough elements in an nlist
-                continue
-            passage_info = self.passage_dict[int(p_id)]
+    def get_table_codes(self, p_ids):
+        # int table codes, only comparable within one call without the passage store
+        if self.passage_store is not None:
+            return self.passage_store.get_table_codes(p_ids)
+        _, table_codes = np.unique(self.get_table_ids(p_ids), return_inverse=True)
+        return table_codes.reshape(-1)
+
+    def get_passages(self, p_ids, scores):
+        item_result = []
+        for idx, p_id in enumerate(p_ids):
+            passage_info = self.get_passage_info(p_id)
             out_item = {
                 'p_id':p_id,
                 'passage':passage_info['passage'],
-                'score':p_dist_lst[idx],
+                'score':scores[idx],
                 'tag':passage_info['tag']
             }
             item_result.append(out_item)
         return item_result
 
+    def search(self, query, top_n=100, n_probe=128, min_tables=5, max_retr=1000):
+        batch_p_ids, batch_scores, _ = self.batch_search(query, top_n=top_n, n_probe=n_probe, 
+                                                         min_tables=min_tables, max_retr=max_retr)
+        result = []
+        for p_ids, scores in zip(batch_p_ids, batch_scores):
+            item_passage_lst = self.get_passages(p_ids, scores)
+            result.append(item_passage_lst)
+        return result
+
+    def set_n_probe(self, n_probe):
+        self.index_ivf.nprobe = n_probe
+        quantizer = faiss.downcast_index(self.index_ivf.quantizer)
+        if isinstance(quantizer, faiss.IndexHNSW):
+            # the hnsw quantizer has to return at least n_probe lists
+            quantizer.hnsw.efSearch = max(2 * n_probe, 16)
+
+    def batch_search(self, query, top_n=100, n_probe=128, min_tables=5, max_retr=1000):
+        """
+        Search all questions in one faiss call. The questions with less than min_tables
+        distinct tables are searched again with max_retr in a second batch.
+        Return a list of (p_ids, scores, table_ids) arrays, one item per question.
+        """
+        self.set_n_probe(n_probe)
+        batch_p_ids, batch_scores, batch_table_ids = self.collect_hits(query, top_n)
+        if top_n < max_retr:
+            retry_rows = [row for row, table_ids in enumerate(batch_table_ids) 
+                          if len(np.unique(table_ids)) < min_tables]
+            if len(retry_rows) > 0:
+                retry_p_ids, retry_scores, retry_table_ids = self.collect_hits(query[retry_rows], max_retr)
+                for offset, row in enumerate(retry_rows):
+                    batch_p_ids[row] = retry_p_ids[offset]
+                    batch_scores[row] = retry_scores[offset]
+                    batch_table_ids[row] = retry_table_ids[offset]
+        return batch_p_ids, batch_scores, batch_table_ids
+    
+    def table_search(self, query, top_tables=50, per_table=30, n_probe=128, max_retr=10000):
+        """
+        Search with the hits collapsed by table, a question gets the best per_table hits
+        of each of its top_tables best tables. The questions with less than top_tables tables
+        are searched again with k growing geometrically up to max_retr.
+        Return the same as batch_search.
+        """
+        self.set_n_probe(n_probe)
+        num_questions = len(query)
+        out_hits = [None] * num_questions
+        active_rows = np.arange(num_questions)
+        retr_k = min(top_tables * per_table, max_retr)
+        while True:
+            batch_p_ids, batch_scores, batch_table_ids = self.collect_hits(query[active_rows], retr_k)
+            keep_pos = []
+            for offset, row in enumerate(active_rows):
+                p_ids, scores, table_ids, num_tables = self.collapse_hits(batch_p_ids[offset], batch_scores[offset],
+                                                                          batch_table_ids[offset], 
+                                                                          top_tables, per_table)
+                out_hits[row] = (p_ids, scores, table_ids)
+                keep_pos.append(num_tables < top_tables)
+            active_rows = active_rows[np.array(keep_pos, dtype=bool)]
+            if len(active_rows) == 0 or retr_k >= max_retr:
+                break
+            retr_k = min(4 * retr_k, max_retr)
+
+        batch_p_ids = [item[0] for item in out_hits]
+        batch_scores = [item[1] for item in out_hits]
+        batch_table_ids = [item[2] for item in out_hits]
+        return batch_p_ids, batch_scores, batch_table_ids
+
+    def collapse_hits(self, p_ids, scores, table_ids, top_tables, per_table):
+        """
+        Keep the first per_table hits of each of the first top_tables tables,
+        the hits are in score order so a table ranks by its best hit.
+        Return the kept hits and the number of distinct tables in all the hits.
+        """
+        if len(p_ids) == 0:
+            return p_ids, scores, table_ids, 0
+        table_codes = self.get_table_codes(p_ids)
+        _, first_pos, group_idxes = np.unique(table_codes, return_index=True, return_inverse=True)
+        group_idxes = group_idxes.reshape(-1)
+        # rank of each hit within its table
+        order = np.argsort(group_idxes, kind='stable')
+        sorted_groups = group_idxes[order]
+        hit_ranks = np.empty(len(p_ids), dtype=np.int64)
+        hit_ranks[order] = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups)
+        # rank of each table by its first (best) hit
+        table_ranks = np.empty(len(first_pos), dtype=np.int64)
+        table_ranks[np.argsort(first_pos)] = np.arange(len(first_pos))
+        keep_pos = (hit_ranks < per_table) & (table_ranks[group_idxes] < top_tables)
+        return p_ids[keep_pos], scores[keep_pos], table_ids[keep_pos], len(first_pos)
+
+    def collect_hits(self, query, top_n):
+        batch_dists, batch_p_ids = self.index.search(query, top_n)
+        return self.get_hits(batch_dists, batch_p_ids)
+
+    def get_hits(self, batch_dists, batch_p_ids):
+        out_p_ids = []
+        out_scores = []
+        out_table_ids = []
+        for row in range(len(batch_p_ids)):
+            #faiss may return -1 if there are not enough elements in an nlist
+            valid_pos = batch_p_ids[row] != -1
+            if self.passage_store is not None:
+                #skip the triples of removed tables
+                valid_pos[valid_pos] = self.passage_store.is_live(batch_p_ids[row][valid_pos])
+            p_ids = batch_p_ids[row][valid_pos]
+            out_p_ids.append(p_ids)
+            out_scores.append(batch_dists[row][valid_pos])
+            out_table_ids.append(self.get_table_ids(p_ids))
+        return out_p_ids, out_scores, out_table_ids
+
+    def get_ivf_query(self, query):
+        # apply the pre-transforms (e.g. OPQ) in front of the ivf index
+        if isinstance(self.index, faiss.IndexPreTransform):
+            for t_idx in range(self.index.chain.size()):
+                vector_transform = faiss.downcast_VectorTransform(self.index.chain.at(t_idx))
+                query = vector_transform.apply(query)
+        return np.ascontiguousarray(query, dtype=np.float32)
+
+    def search_lists(self, ivf_query, k, list_dists, list_ids):
+        # search_preassigned scans exactly nprobe lists per question
+        self.index_ivf.nprobe = list_ids.shape[1]
+        return self.index_ivf.search_preassigned(ivf_query, k, np.ascontiguousarray(list_ids),
+                                                 np.ascontiguousarray(list_dists))
+
+    def merge_hits(self, dists_1, p_ids_1, dists_2, p_ids_2, top_n):
+        all_dists = np.hstack([dists_1, dists_2])
+        all_p_ids = np.hstack([p_ids_1, p_ids_2])
+        if self.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            order = np.argsort(-all_dists, axis=1)[:, :top_n]
+        else:
+            order = np.argsort(all_dists, axis=1)[:, :top_n]
+        return np.take_along_axis(all_dists, order, axis=1), np.take_along_axis(all_p_ids, order, axis=1)
+
+    def adaptive_search(self, query, top_n=100, min_tables=5, max_retr=1000, 
+                        min_probe=32, max_probe=512, time_budget=None):
+        """
+        Probe the lists closest to the questions in geometric steps (min_probe, 2 * min_probe, ... max_probe),
+        each step only scans the lists not scanned yet and merges the hits with the ones already fetched.
+        A question stops when a step leaves the prefix of its hits up to the first hit of the min_tables-th table
+        unchanged, the questions still short of tables after max_probe lists are searched again with k growing
+        geometrically up to max_retr.
+        No new step is started after time_budget seconds.
+        Return the same as batch_search.
+        """
+        t1 = time.time()
+        num_questions = len(query)
+        ivf_query = self.get_ivf_query(query)
+        max_probe = min(max_probe, self.index_ivf.nlist)
+        self.set_n_probe(max_probe)
+        list_dists, list_ids = self.index_ivf.quantizer.search(ivf_query, max_probe)
+
+        hit_dists = None
+        hit_p_ids = None
+        active_rows = np.arange(num_questions)
+        done_probe = 0
+        n_probe = min(min_probe, max_probe)
+        out_hits = [None] * num_questions
+        prefix_dict = {}
+        while True:
+            step_dists, step_p_ids = self.search_lists(ivf_query[active_rows], top_n, 
+                                                       list_dists[active_rows, done_probe:n_probe],
+                                                       list_ids[active_rows, done_probe:n_probe])
+            if hit_dists is None:
+                hit_dists, hit_p_ids = step_dists, step_p_ids
+            else:
+                hit_dists, hit_p_ids = self.merge_hits(hit_dists, hit_p_ids, step_dists, step_p_ids, top_n)
+            done_probe = n_probe
+            
+            step_hits = self.get_hits(hit_dists, hit_p_ids)
+            stop = (n_probe >= max_probe) or ((time_budget is not None) and (time.time() - t1 >= time_budget))
+            keep_pos = []
+            for offset, row in enumerate(active_rows):
+                out_hits[row] = (step_hits[0][offset], step_hits[1][offset], step_hits[2][offset])
+                prefix = get_table_prefix(step_hits[0][offset], step_hits[2][offset], min_tables)
+                last_prefix = prefix_dict.get(row, None)
+                keep_pos.append((prefix is None) or (last_prefix is None) or (not np.array_equal(prefix, last_prefix)))
+                prefix_dict[row] = prefix
+            keep_pos = np.array(keep_pos, dtype=bool)
+            if stop or (not keep_pos.any()):
+                break
+            active_rows = active_rows[keep_pos]
+            hit_dists = hit_dists[keep_pos]
+            hit_p_ids = hit_p_ids[keep_pos]
+            n_probe = min(2 * n_probe, max_probe)
+
+        active_rows = np.array([row for row in active_rows if prefix_dict[row] is None], dtype=np.int64)
+        retr_k = top_n
+        while (len(active_rows) > 0) and (retr_k < max_retr):
+            if (time_budget is not None) and (time.time() - t1 >= time_budget):
+                break
+            retr_k = min(4 * retr_k, max_retr)
+            retr_dists, retr_p_ids = self.search_lists(ivf_query[active_rows], retr_k, 
+                                                       list_dists[active_rows, :done_probe],
+                                                       list_ids[active_rows, :done_probe])
+            retr_hits = self.get_hits(retr_dists, retr_p_ids)
+            keep_pos = []
+            for offset, row in enumerate(active_rows):
+                out_hits[row] = (retr_hits[0][offset], retr_hits[1][offset], retr_hits[2][offset])
+                keep_pos.append(len(np.unique(retr_hits[2][offset])) < min_tables)
+            active_rows = active_rows[np.array(keep_pos, dtype=bool)]
+        
+        batch_p_ids = [item[0] for item in out_hits]
+        batch_scores = [item[1] for item in out_hits]
+        batch_table_ids = [item[2] for item in out_hits]
+        return batch_p_ids, batch_scores, batch_table_ids
+
 # end of class OndiskIndexer 
 
+def get_table_prefix(p_ids, table_ids, min_tables):
+    # the hits up to the first hit of the min_tables-th table, None if the hits have less tables
+    if min_tables <= 0:
+        return p_ids[:0]
+    _, first_pos = np.unique(table_ids, return_index=True)
+    if len(first_pos) < min_tables:
+        return None
+    end_pos = np.sort(first_pos)[min_tables - 1] + 1
+    return p_ids[:end_pos]
+
+def get_ckpt_file(index_out_dir):
+    return os.path.join(index_out_dir, Index_Ckpt_File)
+
+def read_ckpt(index_out_dir):
+    ckpt_file = get_ckpt_file(index_out_dir)
+    if not os.path.isfile(ckpt_file):
+        return None
+    with open(ckpt_file) as f:
+        ckpt_info = json.load(f)
+    return ckpt_info
+
+def write_ckpt(index_out_dir, ckpt_info):
+    ckpt_file = get_ckpt_file(index_out_dir)
+    tmp_file = ckpt_file + '.tmp'
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(ckpt_info))
+    os.replace(tmp_file, ckpt_file)
+
 def index_data(index_file, data_file, index_out_dir, block_size=5000000):
+    """
+    Populate the trained index block by block, each finished block is recorded in the checkpoint
+    so that a restarted run skips it.
+    """
     print('start indexing passages')
+    ckpt_info = read_ckpt(index_out_dir)
+    if ckpt_info is None:
+        ckpt_info = {'blocks':[]}
+    done_block_set = set(ckpt_info['blocks'])
+    if len(done_block_set) > 0:
+        print('%d blocks already indexed' % len(done_block_set))
     bno = 0
     block_fnames = []
     emb_file_lst = glob.glob(data_file)
@@ -82,17 +335,21 @@ def index_data(index_file, data_file, index_out_dir, block_size=5000000):
         N = len(p_ids)
         print('creating block indexes')
         for idx in range(0, N, block_size):
+            block_file_name = os.path.join(index_out_dir, 'block_%d.index' % bno)
+            block_fnames.append(block_file_name)
+            bno += 1
+            if block_file_name in done_block_set:
+                continue
             index = faiss.read_index(index_file)
             index_ivf = faiss.extract_index_ivf(index)
             index_ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
             pos = idx + block_size
             block_p_ids = np.int64(np.array(p_ids[idx:pos]))
-            block_p_embs = p_embs[idx:pos]
+            block_p_embs = np.array(p_embs[idx:pos], dtype=np.float32)
             index.add_with_ids(block_p_embs, block_p_ids)
-            block_file_name = os.path.join(index_out_dir, 'block_%d.index' % bno)
             faiss.write_index(index, block_file_name)
-            block_fnames.append(block_file_name)
-            bno += 1
+            ckpt_info['blocks'].append(block_file_name)
+            write_ckpt(index_out_dir, ckpt_info)
    
     merged_file_name = os.path.join(index_out_dir, 'merged_index.ivfdata')
     print('merging block indexes')
@@ -103,67 +360,172 @@ def index_data(index_file, data_file, index_out_dir, block_size=5000000):
     print('writing to [%s]' % out_index_file)
     faiss.write_index(index, out_index_file)
    
-    #remove the empty trained index and the block files
+    #the index is complete, then remove the checkpoint, the empty trained index and the block files
+    os.remove(get_ckpt_file(index_out_dir))
     os.remove(index_file)
     for block_file_name in block_fnames:
         os.remove(block_file_name)
 
-def get_index_options(num_vecs):
+def add_data(index_file, data_file, block_size=5000000):
+    """
+    Append new vectors to a populated on-disk index in place, the ids must not be in the index.
+    """
+    print('adding passages to [%s]' % index_file)
+    index = faiss.read_index(index_file, faiss.IO_FLAG_ONDISK_SAME_DIR)
+    emb_file_lst = glob.glob(data_file)
+    emb_file_lst.sort()
+    num_added = 0
+    for emb_file in emb_file_lst:
+        print('loading file [%s]' % emb_file)
+        p_ids, p_embs = load_emb(emb_file)
+        N = len(p_ids)
+        for idx in range(0, N, block_size):
+            pos = idx + block_size
+            block_p_ids = np.int64(np.array(p_ids[idx:pos]))
+            block_p_embs = np.array(p_embs[idx:pos], dtype=np.float32)
+            index.add_with_ids(block_p_embs, block_p_ids)
+            num_added += len(block_p_ids)
+    # the index file is replaced as a whole, so it has either all or none of the new vectors
+    tmp_index_file = index_file + '.tmp'
+    faiss.write_index(index, tmp_index_file)
+    os.replace(tmp_index_file, index_file)
+    return num_added
+
+def get_num_vectors(index_file):
+    index = faiss.read_index(index_file, faiss.IO_FLAG_ONDISK_SAME_DIR)
+    return index.ntotal
+
+def get_default_nlist(num_vecs):
     unit = 1e6 
     if num_vecs < unit:
-        num_clusters = int(num_vecs / 50)
-        num_clusters = min(num_clusters, num_vecs)
-        num_train = 50 * num_clusters
-        num_train = min(num_train, num_vecs)
-        factory_string = 'IVF%s,Flat' % num_clusters
+        return max(int(num_vecs / 50), 1)
+    elif num_vecs < 10 * unit:
+        return 16384
+    elif num_vecs < 100 * unit:
+        return 65536
     else:
-        num_clusters = 4096
-        factory_string = 'IVF%s,PQ384' % num_clusters
-        num_train = num_clusters * 1024
-        num_train = min(num_train, num_vecs)
-    return (factory_string, num_train)
-    
-    '''
-    unit = 1e6 
-    if num_vecs < unit:
-        num_clusters = int(16 * math.sqrt(num_vecs))
-        num_clusters = min(num_clusters, num_vecs)
-        num_train = 256 * num_clusters
-        num_train = min(num_train, num_vecs)
-        factory_string = 'IVF%s,Flat' % num_clusters
-
-    elif (num_vecs >= unit) and (num_vecs < 10 * unit):
-       num_clusters = 65536
-       num_train = min(60 * num_clusters, num_vecs)
-       factory_string = 'IVF%s_HNSW32,Flat' % num_clusters
+        return 262144
+
+def get_code_size(encoding, dim):
+    # bytes per vector in the inverted lists, the 8 byte id included
+    if encoding == 'flat':
+        return 4 * dim + 8
+    elif encoding == 'sq8':
+        return dim + 8
+    else:
+        return get_pq_m(encoding) + 8
+
+def get_pq_m(encoding):
+    if encoding.startswith('opq'):
+        return int(encoding[len('opq'):])
+    elif encoding.startswith('pq'):
+        return int(encoding[len('pq'):])
+    raise ValueError('encoding (%s) not supported' % encoding)
+
+def choose_encoding(num_vecs, dim, memory_gb):
+    """
+    Without a memory budget, Flat under 1M vectors and PQ with dim/2 bytes above.
+    With a budget, the most accurate encoding whose inverted lists fit in it.
+    """
+    if not memory_gb:
+        if num_vecs < 1e6:
+            return 'flat'
+        return 'pq%d' % (dim // 2)
+    candidate_lst = ['flat', 'sq8']
+    for pq_m in [dim // 2, dim // 4, dim // 8, dim // 16]:
+        if pq_m > 0 and dim % pq_m == 0:
+            candidate_lst.append('opq%d' % pq_m)
+    budget = memory_gb * (1024 ** 3)
+    for encoding in candidate_lst:
+        if num_vecs * get_code_size(encoding, dim) <= budget:
+            return encoding
+    return candidate_lst[-1]
+
+def get_factory_string(nlist, quantizer, encoding, dim):
+    coarse_str = 'IVF%d' % nlist
+    if quantizer == 'hnsw':
+        coarse_str += '_HNSW32'
+    if encoding == 'flat':
+        return coarse_str + ',Flat'
+    elif encoding == 'sq8':
+        return coarse_str + ',SQ8'
+    pq_m = get_pq_m(encoding)
+    if dim % pq_m != 0:
+        raise ValueError('PQ%d does not divide the dimension %d' % (pq_m, dim))
+    if encoding.startswith('opq'):
+        return 'OPQ%d,%s,PQ%d' % (pq_m, coarse_str, pq_m)
+    return '%s,PQ%d' % (coarse_str, pq_m)
+
+def get_index_plan(num_vecs, dim, plan_config=None):
+    """
+    Choose nlist, the coarse quantizer (flat or hnsw), the encoding (flat, sq8, pq<m>, opq<m>) and
+    the training size from the number of vectors, items set in plan_config (index_plan in
+    system.config) override the automatic choice.
+    """
+    if plan_config is None:
+        plan_config = {}
+    nlist = plan_config.get('nlist', 0)
+    if not nlist:
+        nlist = get_default_nlist(num_vecs)
+    nlist = min(nlist, num_vecs)
+
+    quantizer = plan_config.get('quantizer', 'auto')
+    if quantizer == 'auto':
+        # a flat coarse quantizer is slow to search with many lists
+        quantizer = 'hnsw' if nlist >= 65536 else 'flat'
     
-    elif (num_vecs >= 10 * unit) and (num_vecs < 100 * unit):
-       num_clusters = 262144
-       num_train = min(60 * num_clusters, num_vecs)
-       factory_string = 'IVF%s_HNSW32,Flat' % num_clusters
-        
-    elif (num_vecs >= 100 * unit) and (num_vecs < 1000 * unit):
-       num_clusters = 1048576
-       num_train = min(60 * num_clusters, num_vecs)
-       factory_string = 'IVF%s_HNSW32,Flat' % num_clusters
+    encoding = plan_config.get('encoding', 'auto')
+    if encoding == 'auto':
+        encoding = choose_encoding(num_vecs, dim, plan_config.get('memory_gb', 0))
     
+    train_per_list = plan_config.get('train_per_list', 0)
+    if train_per_list:
+        num_train = nlist * train_per_list
     else:
-        raise ValueError('Not supported right now') 
+        # faiss recommends 64 to 256 training vectors per list, but never less than the 4096 * 1024 
+        # vectors of the fixed IVF4096 options, capped to bound the training memory
+        num_train = nlist * Train_Per_List
+        num_train = max(min(num_train, Max_Train_Size), Min_Train_Size)
+    num_train = min(num_train, num_vecs)
 
-    print('factory_string=%s, num_train=%d' % (factory_string, num_train))     
-    return factory_string, num_train
-    '''
+    index_plan = {
+        'num_vecs':num_vecs,
+        'dim':dim,
+        'nlist':nlist,
+        'quantizer':quantizer,
+        'encoding':encoding,
+        'num_train':num_train,
+        'list_size_gb':num_vecs * get_code_size(encoding, dim) / (1024 ** 3),
+        'factory_string':get_factory_string(nlist, quantizer, encoding, dim)
+    }
+    return index_plan
+
+def write_index_plan(index_dir, index_plan):
+    with open(os.path.join(index_dir, Index_Plan_File), 'w') as f_o:
+        f_o.write(json.dumps(index_plan, indent=4))
+
+def get_emb_dim(emb_file):
+    _, p_embs = load_emb(emb_file)
+    return p_embs.shape[1]
 
 def get_num_vecs(emb_file_lst):
     print('collecting the number of vectors')
     num_vecs = 0
     for emb_file in emb_file_lst:
-        _, p_embs = load_emb(emb_file)
-        num_part_vecs = len(p_embs)
+        if emb_shard.is_shard(emb_file):
+            num_part_vecs, _, _ = emb_shard.read_header(emb_file)
+        else:
+            _, p_embs = load_emb(emb_file)
+            num_part_vecs = len(p_embs)
         num_vecs += num_part_vecs
     return num_vecs
 
 def load_emb(emb_file):
+    if emb_shard.is_shard(emb_file):
+        return emb_shard.open_shard(emb_file)
+    return load_pickled_emb(emb_file)
+
+def load_pickled_emb(emb_file):
     p_id_lst = []
     p_emb_lst = []
     with open(emb_file, 'rb') as f:
@@ -178,8 +540,49 @@ def load_emb(emb_file):
     all_p_emb = np.concatenate(p_emb_lst, axis=0)
     return all_p_id, all_p_emb 
 
+def sample_train_rows(p_embs, num_sample):
+    # a strided view keeps the sample spread over the file and only touches the sampled rows
+    N = len(p_embs)
+    if num_sample <= 0:
+        return p_embs[:0]
+    step = max(N // num_sample, 1)
+    start = random.randrange(step)
+    return p_embs[start::step][:num_sample]
+
+def get_train_embs(emb_file_lst, num_train, num_vecs):
+    train_emb_lst = []
+    for emb_file in emb_file_lst:
+        _, p_embs = load_emb(emb_file)
+        N = p_embs.shape[0]
+
+        num_train_in_file = int(num_train * (N / num_vecs))
+        num_sample_train = min(N, num_train_in_file)
+        
+        #print('num_sample_train=', num_sample_train)
+        train_emb = np.array(sample_train_rows(p_embs, num_sample_train), dtype=np.float32)
+        train_emb_lst.append(train_emb)
+    return np.vstack(train_emb_lst)
+
+def get_reservoir_train_embs(sample_lst, num_train):
+    # each reservoir contributes in proportion to the number of vectors it was sampled from
+    num_seen_total = sum([num_seen for _, num_seen in sample_lst])
+    train_emb_lst = []
+    for sample_embs, num_seen in sample_lst:
+        num_sample_train = min(len(sample_embs), int(num_train * (num_seen / num_seen_total)))
+        train_emb = np.array(sample_train_rows(sample_embs, num_sample_train), dtype=np.float32)
+        train_emb_lst.append(train_emb)
+    return np.vstack(train_emb_lst)
+
+def check_trained_index(index_file, emb_file_lst):
+    index = faiss.read_index(index_file)
+    dim = get_emb_dim(emb_file_lst[0])
+    if index.d != dim:
+        raise ValueError('trained index (%s) has dimension %d, embeddings have %d' % (index_file, index.d, dim))
+    if not index.is_trained:
+        raise ValueError('index (%s) is not trained' % index_file)
+
 # create an empty index and train it
-def create_train(data_file, index_file):
+def create_train(data_file, index_file, sample_dir=None, plan_config=None):
     if os.path.exists(index_file):
         print('index file [%s] already exists' % index_file)
         return 
@@ -189,24 +592,21 @@ def create_train(data_file, index_file):
 
     num_vecs = get_num_vecs(emb_file_lst)
     #print('num_vecs=%d' % num_vecs)
-    factory_string, num_train = get_index_options(num_vecs)
+    index_plan = get_index_plan(num_vecs, get_emb_dim(emb_file_lst[0]), plan_config)
+    write_index_plan(os.path.dirname(index_file), index_plan)
+    factory_string = index_plan['factory_string']
+    num_train = index_plan['num_train']
     print('factory_string=%s, num_train=%d' % (factory_string, num_train))     
 
-    train_emb_lst = []
-    for emb_file in emb_file_lst:
-        _, p_embs = load_emb(emb_file)
-        N = p_embs.shape[0]
-        rows = list(np.arange(0, N))
-
-        num_train_in_file = int(num_train * (N / num_vecs))
-        num_sample_train = min(len(rows), num_train_in_file)
-        
-        #print('num_sample_train=', num_sample_train)
-        train_rows = random.sample(rows, num_sample_train)
-        train_emb = p_embs[train_rows] 
-        train_emb_lst.append(train_emb)
-
-    train_all_embs = np.vstack(train_emb_lst)
+    sample_lst = []
+    if sample_dir is not None:
+        sample_lst = train_sample.read_samples(sample_dir)
+    if len(sample_lst) > 0:
+        # sampled while encoding, the embedding files are not read
+        print('using the training samples in [%s]' % sample_dir)
+        train_all_embs = get_reservoir_train_embs(sample_lst, num_train)
+    else:
+        train_all_embs = get_train_embs(emb_file_lst, num_train, num_vecs)
    
     #print('number of traing vectors = %d' % len(train_all_embs))
     
@@ -221,7 +621,10 @@ def create_train(data_file, index_file):
     t2 = time.time()
     print('train time = %d' % (t2 - t1))
     print('wrting trained index to [%s]' % index_file)
-    faiss.write_index(index, index_file) 
+    # an existing trained index is reused when resuming, so only a complete file gets the name
+    tmp_index_file = index_file + '.tmp'
+    faiss.write_index(index, tmp_index_file)
+    os.replace(tmp_index_file, index_file)
 
 def main(args):
     data_dir = os.path.join(args.work_dir, 'index')
@@ -230,19 +633,33 @@ def main(args):
 
     index_out_dir = os.path.join(data_dir, 'on_disk_index_%s_%s' % (args.dataset, args.experiment))
     if os.path.exists(index_out_dir):
-        msg_text = 'Index directory (%s) already exists' % index_out_dir
-        msg_info = {
-            'state':False,
-            'msg':msg_text
-        }
-        return msg_info
-         
-    os.mkdir(index_out_dir)
+        if read_ckpt(index_out_dir) is None:
+            msg_text = 'Index directory (%s) already exists' % index_out_dir
+            msg_info = {
+                'state':False,
+                'msg':msg_text
+            }
+            return msg_info
+        print('Resuming index (%s)' % index_out_dir)
+    else:
+        os.mkdir(index_out_dir)
+        # the checkpoint marks the index as in progress
+        write_ckpt(index_out_dir, {'blocks':[]})
     dataset_dir = os.path.join(args.work_dir, 'open_table_discovery/table2txt/dataset/')
     exptr_dir = os.path.join(dataset_dir, args.dataset, args.experiment, 'emb')
     data_file = os.path.join(exptr_dir, args.emb_file)
     trained_index_file = os.path.join(index_out_dir, 'trained.index')
-    create_train(data_file, trained_index_file)
+    if (args.trained_index is not None) and (not os.path.exists(trained_index_file)):
+        # reuse the quantizer trained on another dataset with the same encoder
+        emb_file_lst = glob.glob(data_file)
+        emb_file_lst.sort()
+        check_trained_index(args.trained_index, emb_file_lst)
+        print('using the trained index [%s]' % args.trained_index)
+        shutil.copyfile(args.trained_index, trained_index_file + '.tmp')
+        os.replace(trained_index_file + '.tmp', trained_index_file)
+        write_index_plan(index_out_dir, {'trained_index':args.trained_index})
+    sample_dir = os.path.join(exptr_dir, train_sample.Sample_Dir_Name)
+    create_train(data_file, trained_index_file, sample_dir=sample_dir, plan_config=args.index_plan)
     t1 = time.time()
     index_data(trained_index_file, data_file, index_out_dir)
     t2 = time.time()
@@ -260,7 +677,11 @@ def get_args():
     parser.add_argument('--dataset', type=str)
     parser.add_argument('--experiment', type=str)
     parser.add_argument('--emb_file', type=str)
+    parser.add_argument('--trained_index', type=str, default=None, help='trained index of another dataset to reuse')
+    parser.add_argument('--index_plan', type=str, default=None, help='json of the index plan items to override')
     args = parser.parse_args()
+    if args.index_plan is not None:
+        args.index_plan = json.loads(args.index_plan)
     return args
 
 if __name__ == '__main__':
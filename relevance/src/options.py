@@ -98,6 +98,8 @@ class Options():
         self.parser.add_argument('--eval_in_train', type=int, default=1)
         self.parser.add_argument('--multi_model_eval', type=int, default=0)
         self.parser.add_argument('--multi_model_dir', type=str)
+        self.parser.add_argument('--fid_feature_cache', type=int, default=0, 
+                        help='run FiD once and train/evaluate from the stored features')
 
         # dataset parameters
         self.parser.add_argument("--per_gpu_batch_size", default=1, type=int, 
@@ -0,0 +1,292 @@
+import os
+import json
+import argparse
+import numpy as np
+from tqdm import tqdm
+
+Store_Dir_Name = 'passage_store'
+Meta_File = 'meta.json'
+Table_File = 'tables.json'
+Text_File = 'text.bin'
+Offset_File = 'offsets.bin'
+Tag_Columns = ['table_id', 'row', 'sub_col', 'obj_col']
+Null_Code = -1
+Write_Chunk_Size = 100000
+
+def get_store_dir(index_dir):
+    return os.path.join(index_dir, Store_Dir_Name)
+
+def exists_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, Meta_File))
+
+def encode_col(col):
+    if col is None or col == 'None':
+        return Null_Code
+    return int(col)
+
+def decode_col(code):
+    if code == Null_Code:
+        return None
+    return int(code)
+
+class PassageStoreWriter:
+    """
+    Write passages into the columnar store, a packed UTF-8 text blob with an offsets array
+    and int32 tag columns. Table ids are dictionary-encoded into table_id codes.
+    With append=True, passages are added after the ones already in the store.
+    """
+    def __init__(self, store_dir, append=False):
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.table_lst = []
+        self.table_code_dict = {}
+        self.num_passages = 0
+        self.text_size = 0
+        self.p_id_start = None
+        file_mode = 'wb'
+        if append:
+            self.load_meta()
+            # bytes written after the last close belong to an interrupted append
+            truncate_store(store_dir, self.num_passages)
+            file_mode = 'ab'
+        self.f_text = open(os.path.join(store_dir, Text_File), file_mode)
+        self.f_offset = open(os.path.join(store_dir, Offset_File), file_mode)
+        self.f_col_dict = {}
+        for col_name in Tag_Columns:
+            self.f_col_dict[col_name] = open(os.path.join(store_dir, col_name + '.bin'), file_mode)
+        # the passages are buffered and each column is written once per chunk
+        self.text_buffer = []
+        self.offset_buffer = []
+        self.col_buffer_dict = {col_name:[] for col_name in Tag_Columns}
+        if not append:
+            self.offset_buffer.append(0)
+
+    def load_meta(self):
+        with open(os.path.join(self.store_dir, Meta_File)) as f:
+            meta_info = json.load(f)
+        self.num_passages = meta_info['num_passages']
+        self.text_size = meta_info['text_size']
+        self.p_id_start = meta_info['p_id_start']
+        with open(os.path.join(self.store_dir, Table_File)) as f:
+            self.table_lst = json.load(f)
+        for table_code, table_id in enumerate(self.table_lst):
+            self.table_code_dict[table_id] = table_code
+
+    def get_table_code(self, table_id):
+        table_code = self.table_code_dict.get(table_id, None)
+        if table_code is None:
+            table_code = len(self.table_lst)
+            self.table_code_dict[table_id] = table_code
+            self.table_lst.append(table_id)
+        return table_code
+
+    def add(self, item):
+        p_id = int(item['p_id'])
+        if self.p_id_start is None:
+            self.p_id_start = p_id
+        if p_id != self.p_id_start + self.num_passages:
+            raise ValueError('p_id (%d) is not contiguous, expected (%d)' %
+                             (p_id, self.p_id_start + self.num_passages))
+        text_bytes = item['passage'].encode('utf-8')
+        self.text_buffer.append(text_bytes)
+        self.text_size += len(text_bytes)
+        self.offset_buffer.append(self.text_size)
+
+        tag = item['tag']
+        col_values = [
+            self.get_table_code(tag['table_id']),
+            encode_col(tag['row']),
+            encode_col(tag['sub_col']),
+            encode_col(tag['obj_col'])
+        ]
+        for col_name, col_value in zip(Tag_Columns, col_values):
+            self.col_buffer_dict[col_name].append(col_value)
+        self.num_passages += 1
+        if len(self.text_buffer) >= Write_Chunk_Size:
+            self.flush()
+
+    def flush(self):
+        self.f_text.write(b''.join(self.text_buffer))
+        self.f_offset.write(np.array(self.offset_buffer, dtype=np.int64).tobytes())
+        for col_name in Tag_Columns:
+            col_buffer = self.col_buffer_dict[col_name]
+            self.f_col_dict[col_name].write(np.array(col_buffer, dtype=np.int32).tobytes())
+            self.col_buffer_dict[col_name] = []
+        self.text_buffer = []
+        self.offset_buffer = []
+
+    def close(self):
+        self.flush()
+        self.f_text.close()
+        self.f_offset.close()
+        for col_name in self.f_col_dict:
+            self.f_col_dict[col_name].close()
+        write_json(os.path.join(self.store_dir, Table_File), self.table_lst)
+        meta_info = {
+            'num_passages':self.num_passages,
+            'p_id_start':self.p_id_start if self.p_id_start is not None else 1,
+            'text_size':self.text_size,
+        }
+        write_json(os.path.join(self.store_dir, Meta_File), meta_info)
+
+def write_json(out_file, data):
+    tmp_file = out_file + '.tmp'
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(data))
+    os.replace(tmp_file, out_file)
+
+def read_meta(store_dir):
+    with open(os.path.join(store_dir, Meta_File)) as f:
+        meta_info = json.load(f)
+    return meta_info
+
+def truncate_store(store_dir, num_passages):
+    """
+    Cut the store back to its first num_passages passages, used to undo an interrupted
+    or unfinished append. The table codes of the removed passages stay in tables.json.
+    """
+    meta_info = read_meta(store_dir)
+    if num_passages > meta_info['num_passages']:
+        raise ValueError('store (%s) has %d passages, can not truncate to %d' %
+                         (store_dir, meta_info['num_passages'], num_passages))
+    offset_file = os.path.join(store_dir, Offset_File)
+    with open(offset_file, 'rb') as f:
+        f.seek(num_passages * 8)
+        text_size = int(np.frombuffer(f.read(8), dtype=np.int64)[0])
+    os.truncate(os.path.join(store_dir, Text_File), text_size)
+    os.truncate(offset_file, (num_passages + 1) * 8)
+    for col_name in Tag_Columns:
+        os.truncate(os.path.join(store_dir, col_name + '.bin'), num_passages * 4)
+    if num_passages < meta_info['num_passages']:
+        meta_info['num_passages'] = num_passages
+        meta_info['text_size'] = text_size
+        write_json(os.path.join(store_dir, Meta_File), meta_info)
+
+def build_store(passage_file, store_dir):
+    print('building passage store (%s)' % store_dir)
+    writer = PassageStoreWriter(store_dir)
+    with open(passage_file) as f:
+        for line in tqdm(f):
+            item = json.loads(line)
+            writer.add(item)
+    writer.close()
+    return writer.num_passages
+
+def append_store(passage_file, store_dir):
+    print('appending passages to store (%s)' % store_dir)
+    writer = PassageStoreWriter(store_dir, append=True)
+    num_before = writer.num_passages
+    with open(passage_file) as f:
+        for line in tqdm(f):
+            item = json.loads(line)
+            writer.add(item)
+    writer.close()
+    return writer.num_passages - num_before
+
+def get_num_passages(store_dir):
+    return read_meta(store_dir)['num_passages']
+
+def get_next_p_id(store_dir):
+    meta_info = read_meta(store_dir)
+    return meta_info['p_id_start'] + meta_info['num_passages']
+
+def tombstone_tables(store_dir, table_id_lst, chunk_size=10000000):
+    """
+    Mark the passages of the tables as removed by setting their table_id code to Null_Code.
+    The vectors stay in the index and are filtered out at search time.
+    """
+    with open(os.path.join(store_dir, Table_File)) as f:
+        table_lst = json.load(f)
+    table_id_set = set(table_id_lst)
+    codes = np.array([code for code, table_id in enumerate(table_lst) if table_id in table_id_set], dtype=np.int32)
+    with open(os.path.join(store_dir, Meta_File)) as f:
+        meta_info = json.load(f)
+    N = meta_info['num_passages']
+    if len(codes) == 0 or N == 0:
+        return 0
+    col_file = os.path.join(store_dir, 'table_id.bin')
+    table_col = np.memmap(col_file, dtype=np.int32, mode='r+', shape=(N,))
+    num_removed = 0
+    for pos in range(0, N, chunk_size):
+        chunk = table_col[pos:(pos+chunk_size)]
+        removed_pos = np.isin(chunk, codes)
+        num_chunk_removed = int(removed_pos.sum())
+        if num_chunk_removed > 0:
+            chunk[removed_pos] = Null_Code
+            num_removed += num_chunk_removed
+    table_col.flush()
+    del table_col
+    return num_removed
+
+def open_memmap(data_file, dtype, size):
+    if size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(data_file, dtype=dtype, mode='r', shape=(size,))
+
+class PassageStore:
+    """
+    Read-only view of the columnar passage store, all columns are memory-mapped
+    and looked up by p_id in O(1).
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, Meta_File)) as f:
+            meta_info = json.load(f)
+        self.num_passages = meta_info['num_passages']
+        self.p_id_start = meta_info['p_id_start']
+        with open(os.path.join(store_dir, Table_File)) as f:
+            self.table_arr = np.array(json.load(f), dtype=object)
+
+        N = self.num_passages
+        self.text = open_memmap(os.path.join(store_dir, Text_File), np.uint8, meta_info['text_size'])
+        self.offsets = open_memmap(os.path.join(store_dir, Offset_File), np.int64, N + 1)
+        self.col_dict = {}
+        for col_name in Tag_Columns:
+            col_file = os.path.join(store_dir, col_name + '.bin')
+            self.col_dict[col_name] = open_memmap(col_file, np.int32, N)
+
+    def __len__(self):
+        return self.num_passages
+
+    def get_rows(self, p_ids):
+        rows = np.asarray(p_ids, dtype=np.int64) - self.p_id_start
+        if len(rows) > 0 and (rows.min() < 0 or rows.max() >= self.num_passages):
+            raise KeyError('p_id out of range')
+        return rows
+
+    def get_table_codes(self, p_ids):
+        return self.col_dict['table_id'][self.get_rows(p_ids)]
+
+    def is_live(self, p_ids):
+        return self.get_table_codes(p_ids) != Null_Code
+
+    def get_table_ids(self, p_ids):
+        return self.table_arr[self.get_table_codes(p_ids)]
+
+    def get_passage(self, p_id):
+        row = int(self.get_rows([p_id])[0])
+        text = bytes(self.text[self.offsets[row]:self.offsets[row + 1]]).decode('utf-8')
+        tag = {
+            'table_id':self.table_arr[self.col_dict['table_id'][row]],
+            'row':decode_col(self.col_dict['row'][row]),
+            'sub_col':decode_col(self.col_dict['sub_col'][row]),
+            'obj_col':decode_col(self.col_dict['obj_col'][row]),
+        }
+        passage_info = {
+            'p_id':int(p_id),
+            'passage':text,
+            'tag':tag
+        }
+        return passage_info
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--passage_file', type=str, required=True, help='passages.jsonl in the index directory')
+    args = parser.parse_args()
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    store_dir = get_store_dir(os.path.dirname(os.path.abspath(args.passage_file)))
+    build_store(args.passage_file, store_dir)
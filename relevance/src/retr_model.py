@@ -15,11 +15,11 @@ class FusionRetrModelBase(nn.Module):
         self.feat_dropout = nn.Dropout()
         self.feat_l2 = self.create_linear_layer(D, 1)
    
-    def feature_fnt(self, input_x, sample=False, calculate_log_probs=False):
-        output_x_1 = self.feat_l1(input_x, sample=sample, calculate_log_probs=calculate_log_probs)
+    def feature_fnt(self, input_x, sample=False, calculate_log_probs=False, **sample_args):
+        output_x_1 = self.feat_l1(input_x, sample=sample, calculate_log_probs=calculate_log_probs, **sample_args)
         output_x_2 = self.feat_relu(output_x_1)
         output_x_3 = self.feat_dropout(output_x_2)
-        output = self.feat_l2(output_x_3, sample=sample, calculate_log_probs=calculate_log_probs)
+        output = self.feat_l2(output_x_3, sample=sample, calculate_log_probs=calculate_log_probs, **sample_args)
         return output 
     
     def create_linear_layer(self, in_features, out_features):
@@ -29,72 +29,36 @@ class FusionRetrModelBase(nn.Module):
                               sample=False, calculate_log_probs=False, opts=None):
         batch_passage_states = self.passage_fnt(batch_input_states, 
                                                 sample=sample, calculate_log_probs=calculate_log_probs)
-        bsz, num_layers, _, num_feature_1 = batch_passage_states.shape
         batch_p_table_states = self.table_fnt(batch_input_states, 
                                               sample=sample, calculate_log_probs=calculate_log_probs) 
-        _, _, _, num_feature_2 = batch_p_table_states.shape
-         
-        item_passage_feature_lst = []
-        for idx, item in enumerate(batch_data):
-            num_passages = len(item['passages'])
-            passage_states = batch_passage_states[idx].view(num_layers, num_passages, -1, num_feature_1)
-            p_table_states = batch_p_table_states[idx].view(num_layers, num_passages, -1, num_feature_2)
-            tag_lst = item['tags']
-            table_feature_dict = {}
-            aggr_feature_dict = {}
-            p_table_lst = []
-            for passage_idx, tag in enumerate(tag_lst):
-                table_id = tag['table_id']
-                p_table_lst.append(table_id)
-                if table_id not in table_feature_dict:
-                    table_feature_dict[table_id] = []
-                
-                p_table_feature = p_table_states[:, passage_idx:(passage_idx+1), :, :]
-                table_feature_lst = table_feature_dict[table_id]
-                table_feature_lst.append(p_table_feature)
-            
-            gold_table_id_lst = item['table_id_lst'] 
-            for p_table_id in table_feature_dict:
-                p_table_feature_lst = table_feature_dict[p_table_id]
-                table_features = torch.cat(p_table_feature_lst, dim=1)
-                table_aggr_feature = table_features.max(dim=1, keepdim=True)[0]
-                aggr_feature_dict[p_table_id] = table_aggr_feature
-                
-                if opts is not None:
-                    table_reg_score = self.compute_reg_score(table_features)
-                    reg_score_lst = opts.get('reg_score', None)
-                    if reg_score_lst is None:
-                        opts['reg_score'] = []
-                    reg_score_lst = opts['reg_score']
-                    reg_score_lst.append(table_reg_score)
-
-            p_aggr_feature_lst = []
-            for table_id in p_table_lst:
-                aggr_feature = aggr_feature_dict[table_id]
-                p_aggr_feature_lst.append(aggr_feature)
-            p_aggr_features = torch.cat(p_aggr_feature_lst, dim=1) 
-
-            item_passage_feature = torch.cat([passage_states, p_aggr_features], dim=-1)
-            _, _, _, num_aggr_features = item_passage_feature.shape
-            item_passage_feature = item_passage_feature.view(num_layers, -1, num_aggr_features)
-            item_passage_feature_lst.append(item_passage_feature.unsqueeze(0))
-       
-        batch_passage_features = torch.cat(item_passage_feature_lst, dim=0)
-        return batch_passage_features 
-
-    def compute_reg_score(self, table_features):
-        n_layer, n_passages, n_tokens, n_feature = table_features.shape
-        states = table_features.mean(dim=(0,2))
-        scores = torch.mm(states, states.t())
-        reg_score = torch.triu(scores, diagonal=1).mean() 
-        return reg_score
+        return self.aggr_passage_states(batch_data, batch_passage_states, batch_p_table_states, opts=opts)
 
-    def forward(self, batch_data, fusion_scores, fusion_states, passage_masks, 
-                sample=False, calculate_log_probs=False, opts=None):
+    def aggr_passage_states(self, batch_data, batch_passage_states, batch_p_table_states, opts=None, num_samples=1):
+        """
+        The states are (bsz, num_layers, num_passages * num_tokens, num_features),
+        with num_samples weight samples folded into num_layers (sample major).
+        """
+        bsz, num_layers, _, num_feature_1 = batch_passage_states.shape
+        _, _, _, num_feature_2 = batch_p_table_states.shape
+        num_passages = len(batch_data[0]['passages'])
+        passage_states = batch_passage_states.view(bsz, num_layers, num_passages, -1, num_feature_1)
+        p_table_states = batch_p_table_states.view(bsz, num_layers, num_passages, -1, num_feature_2)
+        num_tokens = p_table_states.size(3)
+        flat_table_states = p_table_states.transpose(0, 1).reshape(num_layers, bsz * num_passages, 
+                                                                   num_tokens, num_feature_2)
+        group_idx_lst, num_group_lst = get_table_groups(batch_data)
+        table_aggr_states, group_idxes = aggr_table_states(flat_table_states, group_idx_lst, 
+                                                           sum(num_group_lst), opts=opts, 
+                                                           num_samples=num_samples)
+        # each passage gets the aggregated states of its table
+        p_aggr_features = table_aggr_states.index_select(1, group_idxes)
+        p_aggr_features = p_aggr_features.view(num_layers, bsz, num_passages, num_tokens, num_feature_2).transpose(0, 1)
         
-        if self.training:
-            assert(opts is not None)
+        batch_passage_features = torch.cat([passage_states, p_aggr_features], dim=-1)
+        batch_passage_features = batch_passage_features.view(bsz, num_layers, num_passages * num_tokens, -1)
+        return batch_passage_features 
 
+    def get_input_states(self, fusion_states):
         answer_states = fusion_states['answer_states']
         answer_states = answer_states[:, -1:, :, :]
         bsz, n_layers, _, emb_size = answer_states.size()
@@ -105,7 +69,16 @@ class FusionRetrModelBase(nn.Module):
         answer_states = answer_states.expand(bsz, n_layers, n_tokens, emb_size)
         input_states = [answer_states, query_passage_states, answer_states * query_passage_states]
         input_states = torch.cat(input_states, dim=-1)
-       
+        return input_states
+
+    def forward(self, batch_data, fusion_scores, fusion_states, passage_masks, 
+                sample=False, calculate_log_probs=False, opts=None):
+        
+        if self.training:
+            assert(opts is not None)
+
+        input_states = self.get_input_states(fusion_states)
+        n_layers = input_states.size(1)
         p_aggr_features = self.get_table_aggr_states(batch_data, input_states, 
                                                      sample=sample, calculate_log_probs=calculate_log_probs, opts=opts)
         batch_scores = self.feature_fnt(p_aggr_features, 
@@ -122,5 +95,97 @@ class FusionRetrModelBase(nn.Module):
             passage_scores = item_adapt_scores 
             batch_passage_scores.append(passage_scores)
                  
-        return batch_passage_scores 
-         
+        return batch_passage_scores
+
+def get_table_groups(batch_data):
+    """
+    Map the table of each passage to a group index, the tables of an item are numbered
+    in the order of first occurrence, after the tables of the items before it.
+    Return the group index of each of the bsz * num_passages passages and the number of tables per item.
+    """
+    group_idx_lst = []
+    num_group_lst = []
+    num_groups = 0
+    for item in batch_data:
+        group_dict = {}
+        for tag in item['tags']:
+            table_id = tag['table_id']
+            if table_id not in group_dict:
+                group_dict[table_id] = num_groups + len(group_dict)
+            group_idx_lst.append(group_dict[table_id])
+        num_group_lst.append(len(group_dict))
+        num_groups += len(group_dict)
+    return group_idx_lst, num_group_lst
+
+def aggr_table_states(flat_table_states, group_idx_lst, num_groups, opts=None, num_samples=1):
+    """
+    Max of the passage states of each table, flat_table_states is 
+    (num_layers, bsz * num_passages, num_tokens, num_features).
+    """
+    num_layers, _, num_tokens, num_features = flat_table_states.shape
+    group_idxes = torch.tensor(group_idx_lst, dtype=torch.long, device=flat_table_states.device)
+    scatter_idxes = group_idxes.view(1, -1, 1, 1).expand_as(flat_table_states)
+    table_aggr_states = flat_table_states.new_zeros(num_layers, num_groups, num_tokens, num_features)
+    table_aggr_states = table_aggr_states.scatter_reduce(1, scatter_idxes, flat_table_states, 
+                                                         reduce='amax', include_self=False)
+    if opts is not None:
+        member_lst = [[] for _ in range(num_groups)]
+        for passage_idx, group_idx in enumerate(group_idx_lst):
+            member_lst[group_idx].append(passage_idx)
+        reg_score_lst = opts.get('reg_score', None)
+        if reg_score_lst is None:
+            opts['reg_score'] = []
+        reg_score_lst = opts['reg_score']
+        # one score per table for each weight sample
+        sample_layers = num_layers // num_samples
+        for sample_idx in range(num_samples):
+            sample_states = flat_table_states[(sample_idx * sample_layers):((sample_idx + 1) * sample_layers)]
+            for members in member_lst:
+                member_idxes = torch.tensor(members, dtype=torch.long, device=flat_table_states.device)
+                table_features = sample_states.index_select(1, member_idxes)
+                reg_score_lst.append(compute_reg_score(table_features))
+    return table_aggr_states, group_idxes
+
+def compute_reg_score(table_features):
+    n_layer, n_passages, n_tokens, n_feature = table_features.shape
+    states = table_features.mean(dim=(0,2))
+    scores = torch.mm(states, states.t())
+    reg_score = torch.triu(scores, diagonal=1).mean() 
+    return reg_score
+
+def loop_aggr_table_states(batch_data, flat_table_states, opts=None):
+    """
+    The per-table loop replaced by aggr_table_states, kept to check that both give the same states and reg scores.
+    """
+    aggr_state_lst = []
+    passage_offset = 0
+    for item in batch_data:
+        table_feature_dict = {}
+        for passage_idx, tag in enumerate(item['tags']):
+            pos = passage_offset + passage_idx
+            table_feature_dict.setdefault(tag['table_id'], []).append(flat_table_states[:, pos:(pos + 1)])
+        for table_feature_lst in table_feature_dict.values():
+            table_features = torch.cat(table_feature_lst, dim=1)
+            aggr_state_lst.append(table_features.max(dim=1, keepdim=True)[0])
+            if opts is not None:
+                opts.setdefault('reg_score', []).append(compute_reg_score(table_features))
+        passage_offset += len(item['tags'])
+    return torch.cat(aggr_state_lst, dim=1)
+
+def check_aggr_table_states(bsz=3, num_passages=20, num_tables=6, num_layers=2, num_tokens=5, num_features=8):
+    batch_data = []
+    for _ in range(bsz):
+        table_idxes = torch.randint(num_tables, (num_passages,)).tolist()
+        batch_data.append({'tags':[{'table_id':'table_%d' % table_idx} for table_idx in table_idxes]})
+    flat_table_states = torch.randn(num_layers, bsz * num_passages, num_tokens, num_features)
+    group_idx_lst, num_group_lst = get_table_groups(batch_data)
+    opts = {}
+    table_aggr_states, _ = aggr_table_states(flat_table_states, group_idx_lst, sum(num_group_lst), opts=opts)
+    loop_opts = {}
+    loop_aggr_states = loop_aggr_table_states(batch_data, flat_table_states, opts=loop_opts)
+    assert torch.equal(table_aggr_states, loop_aggr_states)
+    assert torch.equal(torch.stack(opts['reg_score']), torch.stack(loop_opts['reg_score']))
+    print('aggr_table_states is identical to the per-table loop')
+
+if __name__ == '__main__':
+    check_aggr_table_states()
@@ -2,6 +2,10 @@ from src.retr_model import FusionRetrModelBase
 from src.bnn.bayesian_linear import BayesianLinear
 import torch.nn
 
+# input state elements (bsz * n_layers * n_tokens * 3D) times samples evaluated together,
+# the activations of a chunk are several times this
+Max_Chunk_Elements = 2 ** 27
+
 class RetrModelBNN(FusionRetrModelBase):
     def set_prior(self, prior):
         self.passage_fnt.set_prior(prior['passage_fnt'] if prior is not None else None)
@@ -28,22 +32,59 @@ class RetrModelBNN(FusionRetrModelBase):
 
     def sample_forward(self, batch_data, fusion_scores, fusion_states, passage_masks, 
                       sample=False, calculate_log_probs=False, opts=None, num_samples=1):
-        outputs = []
-        log_priors = torch.zeros(num_samples)
-        log_variational_posteriors = torch.zeros(num_samples)
-        for i in range(num_samples):
-            output_item = self(batch_data, fusion_scores, fusion_states, passage_masks, 
-                                 sample=True, opts=opts)
-            output_item = torch.stack(output_item).unsqueeze(0)
-            outputs.append(output_item)
-            log_priors[i] = self.log_prior()
-            log_variational_posteriors[i] = self.log_variational_posterior()
+        # sample is only kept for the same signature as RetrModelMLE, the weights are always sampled here
+        sample_scores = self.batch_sample_forward(batch_data, fusion_states, passage_masks, num_samples,
+                                                  calculate_log_probs=calculate_log_probs, opts=opts)
+        outputs = sample_scores.mean(dim=0)
+        # the layers keep the means over the samples
+        opts['log_prior'] = self.log_prior()
+        opts['log_variational_posterior'] = self.log_variational_posterior()
+        return outputs 
+
+    def batch_sample_forward(self, batch_data, fusion_states, passage_masks, num_samples, 
+                             include_mean=False, calculate_log_probs=False, opts=None,
+                             max_chunk_elements=Max_Chunk_Elements):
+        """
+        Evaluate num_samples weight samples (and the mean weights as the last one if include_mean),
+        the input states are computed once and the samples are evaluated in chunks, each chunk with
+        at most max_chunk_elements input state elements over its samples.
+        Return the passage scores, (num_samples [+ 1], bsz, num_passages).
+        """
+        if self.training:
+            assert(opts is not None)
+        input_states = self.get_input_states(fusion_states)
+        total_samples = num_samples + (1 if include_mean else 0)
+        chunk_size = max(1, max_chunk_elements // input_states.numel())
+        if self.training or calculate_log_probs:
+            # the layers keep the log probs of the last call only
+            chunk_size = total_samples
+        chunk_scores = []
+        for pos in range(0, total_samples, chunk_size):
+            sample_args = {
+                'num_samples':max(0, min(chunk_size, num_samples - pos)),
+                'include_mean':include_mean and (pos + chunk_size >= total_samples),
+                'calculate_log_probs':calculate_log_probs
+            }
+            chunk_scores.append(self.sample_chunk_forward(batch_data, input_states, passage_masks, 
+                                                          sample_args, opts=opts))
+        return torch.cat(chunk_scores, dim=0)
+
+    def sample_chunk_forward(self, batch_data, input_states, passage_masks, sample_args, opts=None):
+        bsz, n_layers, n_tokens, _ = input_states.size()
+        # (S, bsz, n_layers, n_tokens, num_features)
+        batch_passage_states = self.passage_fnt(input_states, **sample_args)
+        batch_p_table_states = self.table_fnt(input_states, **sample_args)
+        S = batch_passage_states.size(0)
         
-        outputs = torch.cat(outputs, dim=0).mean(dim=0)
-        log_prior = log_priors.mean()
-        log_variational_posterior = log_variational_posteriors.mean()
+        def fold_samples(states):
+            return states.transpose(0, 1).reshape(bsz, S * n_layers, n_tokens, states.size(-1))
         
-        opts['log_prior'] = log_prior
-        opts['log_variational_posterior'] = log_variational_posterior
-        return outputs 
+        p_aggr_features = self.aggr_passage_states(batch_data, fold_samples(batch_passage_states),
+                                                   fold_samples(batch_p_table_states), opts=opts, num_samples=S)
+        p_aggr_features = p_aggr_features.view(bsz, S, n_layers, n_tokens, -1).transpose(0, 1)
+        batch_scores = self.feature_fnt(p_aggr_features, sampled_input=True, **sample_args).squeeze(-1)
         
+        n_passages = len(batch_data[0]['passages'])
+        batch_scores = batch_scores.view(S, bsz, n_layers, n_passages, -1)
+        masked_scores = batch_scores * passage_masks[None, :, None, :, :]
+        return masked_scores.sum(dim=[2, 4])
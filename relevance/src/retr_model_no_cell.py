@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from src.retr_model import get_table_groups, aggr_table_states
 
 class FusionRetrModelBase(nn.Module):
     def __init__(self):
@@ -27,77 +28,29 @@ class FusionRetrModelBase(nn.Module):
       
     def get_table_aggr_states(self, batch_data, batch_input_states, 
                               sample=False, calculate_log_probs=False, opts=None):
-        
-        #import pdb; pdb.set_trace()
-
-        #batch_passage_states = self.passage_fnt(batch_input_states, 
-        #                                        sample=sample, calculate_log_probs=calculate_log_probs)
-        #bsz, num_layers, _, num_feature_1 = batch_passage_states.shape
         batch_p_table_states = self.table_fnt(batch_input_states, 
                                               sample=sample, calculate_log_probs=calculate_log_probs) 
         bsz, num_layers, _, num_feature_2 = batch_p_table_states.shape
-         
+        
+        num_passages = len(batch_data[0]['passages'])
+        p_table_states = batch_p_table_states.view(bsz, num_layers, num_passages, -1, num_feature_2)
+        num_tokens = p_table_states.size(3)
+        flat_table_states = p_table_states.transpose(0, 1).reshape(num_layers, bsz * num_passages, 
+                                                                   num_tokens, num_feature_2)
+        group_idx_lst, num_group_lst = get_table_groups(batch_data)
+        table_aggr_states, _ = aggr_table_states(flat_table_states, group_idx_lst, 
+                                                 sum(num_group_lst), opts=opts)
+        
         item_passage_feature_lst = []
         batch_table_lst = []
-        for idx, item in enumerate(batch_data):
-            num_passages = len(item['passages'])
-            #passage_states = batch_passage_states[idx].view(num_layers, num_passages, -1, num_feature_1)
-            p_table_states = batch_p_table_states[idx].view(num_layers, num_passages, -1, num_feature_2)
-            tag_lst = item['tags']
-            table_feature_dict = {}
-            aggr_feature_dict = {}
-            p_table_lst = []
-            for passage_idx, tag in enumerate(tag_lst):
-                table_id = tag['table_id']
-                #p_table_lst.append(table_id)
-                if table_id not in table_feature_dict:
-                    table_feature_dict[table_id] = []
-                    p_table_lst.append(table_id)
-
-                p_table_feature = p_table_states[:, passage_idx:(passage_idx+1), :, :]
-                table_feature_lst = table_feature_dict[table_id]
-                table_feature_lst.append(p_table_feature)
-            
-            gold_table_id_lst = item['table_id_lst'] 
-            for p_table_id in table_feature_dict:
-                p_table_feature_lst = table_feature_dict[p_table_id]
-                table_features = torch.cat(p_table_feature_lst, dim=1)
-                table_aggr_feature = table_features.max(dim=1, keepdim=True)[0]
-                #import pdb; pdb.set_trace()
-                aggr_feature_dict[p_table_id] = table_aggr_feature
-                
-                if opts is not None:
-                    table_reg_score = self.compute_reg_score(table_features)
-                    reg_score_lst = opts.get('reg_score', None)
-                    if reg_score_lst is None:
-                        opts['reg_score'] = []
-                    reg_score_lst = opts['reg_score']
-                    reg_score_lst.append(table_reg_score)
-
-            #import pdb; pdb.set_trace()
-            p_aggr_feature_lst = []
-            for table_id in p_table_lst:
-                aggr_feature = aggr_feature_dict[table_id]
-                p_aggr_feature_lst.append(aggr_feature)
-            p_aggr_features = torch.cat(p_aggr_feature_lst, dim=1) 
-
+        item_aggr_states_lst = torch.split(table_aggr_states, num_group_lst, dim=1)
+        for item, item_aggr_states in zip(batch_data, item_aggr_states_lst):
+            p_table_lst = list(dict.fromkeys([tag['table_id'] for tag in item['tags']]))
             batch_table_lst.append(p_table_lst)
-            item_passage_feature = p_aggr_features #torch.cat([passage_states, p_aggr_features], dim=-1)
-            _, _, _, num_aggr_features = item_passage_feature.shape
-            item_passage_feature = item_passage_feature.view(num_layers, -1, num_aggr_features)
+            item_passage_feature = item_aggr_states.reshape(num_layers, -1, num_feature_2)
             item_passage_feature_lst.append(item_passage_feature.unsqueeze(0))
-      
-        #import pdb; pdb.set_trace() 
-        #batch_passage_features = torch.cat(item_passage_feature_lst, dim=0)
         return item_passage_feature_lst, batch_table_lst 
 
-    def compute_reg_score(self, table_features):
-        n_layer, n_passages, n_tokens, n_feature = table_features.shape
-        states = table_features.mean(dim=(0,2))
-        scores = torch.mm(states, states.t())
-        reg_score = torch.triu(scores, diagonal=1).mean() 
-        return reg_score
-
     def forward(self, batch_data, fusion_scores, fusion_states, passage_masks, 
                 sample=False, calculate_log_probs=False, opts=None):
         
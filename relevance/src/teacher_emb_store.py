@@ -0,0 +1,157 @@
+import os
+import json
+import numpy as np
+
+# Teacher embeddings of the passages in the index directory, row i is the passage with p_id = p_id_start + i.
+# float16 rows are stored as is, int8 rows are quantized with one float32 scale per row.
+Store_Dir_Name = 'teacher_emb'
+Meta_File = 'meta.json'
+Emb_File = 'embs.bin'
+Scale_File = 'scales.bin'
+Emb_Dtypes = ['float16', 'int8']
+
+def get_store_dir(index_dir):
+    return os.path.join(index_dir, Store_Dir_Name)
+
+def exists_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, Meta_File))
+
+def quantize(embs):
+    scales = np.abs(embs).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(embs / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class TeacherEmbStoreWriter:
+    """
+    Write teacher embeddings in p_id order, the p_ids must be contiguous.
+    With append=True, embeddings are added after the ones already in the store.
+    """
+    def __init__(self, store_dir, emb_dtype='float16', append=False):
+        if emb_dtype not in Emb_Dtypes:
+            raise ValueError('teacher embedding dtype (%s) not supported' % emb_dtype)
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.store_dir = store_dir
+        self.emb_dtype = emb_dtype
+        self.num_passages = 0
+        self.p_id_start = None
+        self.dim = None
+        file_mode = 'wb'
+        if append:
+            self.load_meta()
+            # rows written after the last close belong to an interrupted append
+            truncate_store(store_dir, self.num_passages)
+            file_mode = 'ab'
+        self.f_emb = open(os.path.join(store_dir, Emb_File), file_mode)
+        self.f_scale = open(os.path.join(store_dir, Scale_File), file_mode)
+
+    def load_meta(self):
+        with open(os.path.join(self.store_dir, Meta_File)) as f:
+            meta_info = json.load(f)
+        self.num_passages = meta_info['num_passages']
+        self.p_id_start = meta_info['p_id_start']
+        self.dim = meta_info['dim']
+        self.emb_dtype = meta_info['emb_dtype']
+
+    def get_next_p_id(self):
+        if self.p_id_start is None:
+            return None
+        return self.p_id_start + self.num_passages
+
+    def add(self, p_ids, embs):
+        if len(p_ids) == 0:
+            return
+        if self.p_id_start is None:
+            self.p_id_start = int(p_ids[0])
+        expected_p_ids = self.p_id_start + self.num_passages + np.arange(len(p_ids))
+        if not np.array_equal(np.asarray(p_ids, dtype=np.int64), expected_p_ids):
+            raise ValueError('p_ids are not contiguous, expected from (%d)' % expected_p_ids[0])
+        if self.dim is None:
+            self.dim = embs.shape[1]
+        assert(embs.shape[1] == self.dim)
+        if self.emb_dtype == 'int8':
+            codes, scales = quantize(embs.astype(np.float32))
+            self.f_emb.write(codes.tobytes())
+            self.f_scale.write(scales.tobytes())
+        else:
+            self.f_emb.write(embs.astype(np.float16).tobytes())
+        self.num_passages += len(p_ids)
+
+    def close(self):
+        self.f_emb.close()
+        self.f_scale.close()
+        meta_info = {
+            'num_passages':self.num_passages,
+            'p_id_start':self.p_id_start if self.p_id_start is not None else 1,
+            'dim':self.dim,
+            'emb_dtype':self.emb_dtype
+        }
+        write_meta(self.store_dir, meta_info)
+
+def write_meta(store_dir, meta_info):
+    tmp_file = os.path.join(store_dir, Meta_File + '.tmp')
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(meta_info))
+    os.replace(tmp_file, os.path.join(store_dir, Meta_File))
+
+def get_num_passages(store_dir):
+    with open(os.path.join(store_dir, Meta_File)) as f:
+        meta_info = json.load(f)
+    return meta_info['num_passages']
+
+def truncate_store(store_dir, num_passages):
+    """
+    Cut the store back to the embeddings of its first num_passages passages.
+    """
+    with open(os.path.join(store_dir, Meta_File)) as f:
+        meta_info = json.load(f)
+    if num_passages > meta_info['num_passages']:
+        raise ValueError('store (%s) has %d passages, can not truncate to %d' %
+                         (store_dir, meta_info['num_passages'], num_passages))
+    dim = meta_info['dim'] if meta_info['dim'] is not None else 0
+    row_size = dim * np.dtype(meta_info['emb_dtype']).itemsize
+    scale_size = 4 if meta_info['emb_dtype'] == 'int8' else 0
+    os.truncate(os.path.join(store_dir, Emb_File), num_passages * row_size)
+    os.truncate(os.path.join(store_dir, Scale_File), num_passages * scale_size)
+    if num_passages < meta_info['num_passages']:
+        meta_info['num_passages'] = num_passages
+        write_meta(store_dir, meta_info)
+
+class TeacherEmbStore:
+    """
+    Read-only view of the teacher embeddings, memory-mapped and looked up by p_id.
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, Meta_File)) as f:
+            meta_info = json.load(f)
+        self.num_passages = meta_info['num_passages']
+        self.p_id_start = meta_info['p_id_start']
+        self.dim = meta_info['dim']
+        self.emb_dtype = meta_info['emb_dtype']
+        self.embs = None
+        self.scales = None
+        if self.num_passages > 0:
+            N = self.num_passages
+            self.embs = np.memmap(os.path.join(store_dir, Emb_File), dtype=np.dtype(self.emb_dtype),
+                                  mode='r', shape=(N, self.dim))
+            if self.emb_dtype == 'int8':
+                self.scales = np.memmap(os.path.join(store_dir, Scale_File), dtype=np.float32, mode='r', shape=(N,))
+
+    def __len__(self):
+        return self.num_passages
+
+    def get_embs(self, p_ids):
+        """
+        Return a mask of the p_ids found in the store and their float32 embeddings.
+        """
+        rows = np.asarray(p_ids, dtype=np.int64) - self.p_id_start
+        found_pos = (rows >= 0) & (rows < self.num_passages)
+        found_rows = rows[found_pos]
+        if len(found_rows) == 0:
+            return found_pos, np.zeros((0, self.dim), dtype=np.float32)
+        embs = self.embs[found_rows].astype(np.float32)
+        if self.scales is not None:
+            embs *= self.scales[found_rows][:, None]
+        return found_pos, embs
@@ -0,0 +1,113 @@
+import os
+import json
+import glob
+import numpy as np
+
+# A reservoir of embeddings sampled while encoding, used to train the index without reading
+# the embedding files again. Each reservoir is <name>.bin (capacity x dim matrix) and <name>.json.
+Sample_Dir_Name = 'train_sample'
+Default_Sample_Size = 4096 * 1024
+
+def get_sample_dir(output_path):
+    return os.path.join(os.path.dirname(output_path), Sample_Dir_Name)
+
+class ReservoirSample:
+    """
+    Uniform sample of at most capacity rows over all the rows added (Algorithm R),
+    the sampled rows are kept in a memory-mapped file, which grows with the rows until capacity.
+    """
+    def __init__(self, sample_dir, name, capacity, seed=None):
+        if not os.path.isdir(sample_dir):
+            os.makedirs(sample_dir)
+        self.data_file = os.path.join(sample_dir, name + '.bin')
+        self.meta_file = os.path.join(sample_dir, name + '.json')
+        self.capacity = capacity
+        self.num_seen = 0
+        self.dim = None
+        self.dtype = None
+        self.embs = None
+        self.num_rows = 0
+        self.rng = np.random.default_rng(seed)
+        if os.path.isfile(self.meta_file):
+            self.load()
+
+    def load(self):
+        with open(self.meta_file) as f:
+            meta_info = json.load(f)
+        self.capacity = meta_info['capacity']
+        self.num_seen = meta_info['num_seen']
+        self.dim = meta_info['dim']
+        self.dtype = np.dtype(meta_info['dtype'])
+        self.num_rows = meta_info.get('num_rows', self.capacity)
+        if 'rng_state' in meta_info:
+            self.rng.bit_generator.state = meta_info['rng_state']
+        self.embs = np.memmap(self.data_file, dtype=self.dtype, mode='r+', shape=(self.num_rows, self.dim))
+
+    def create(self, dim, dtype):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        with open(self.data_file, 'wb'):
+            pass
+
+    def grow(self, num_rows):
+        """
+        Extend the file to at least num_rows rows (doubling, at most capacity).
+        """
+        if num_rows <= self.num_rows:
+            return
+        num_rows = min(self.capacity, max(num_rows, 2 * self.num_rows))
+        if self.embs is not None:
+            self.embs.flush()
+            self.embs = None
+        with open(self.data_file, 'r+b') as f:
+            f.truncate(num_rows * self.dim * self.dtype.itemsize)
+        self.num_rows = num_rows
+        self.embs = np.memmap(self.data_file, dtype=self.dtype, mode='r+', shape=(self.num_rows, self.dim))
+
+    def add(self, embs):
+        if self.capacity <= 0 or len(embs) == 0:
+            return
+        if self.dim is None:
+            self.create(embs.shape[1], embs.dtype)
+        self.grow(min(self.num_seen + len(embs), self.capacity))
+        row_idxes = self.num_seen + np.arange(len(embs))
+        slots = row_idxes.copy()
+        full_pos = row_idxes >= self.capacity
+        # row i replaces a random slot with probability capacity / (i + 1)
+        slots[full_pos] = self.rng.integers(0, row_idxes[full_pos] + 1)
+        kept_pos = slots < self.capacity
+        self.embs[slots[kept_pos]] = embs[kept_pos]
+        self.num_seen += len(embs)
+
+    def save(self):
+        if self.embs is None:
+            return
+        self.embs.flush()
+        meta_info = {
+            'capacity':self.capacity,
+            'num_seen':self.num_seen,
+            'dim':self.dim,
+            'dtype':self.dtype.name,
+            'num_rows':self.num_rows,
+            'rng_state':self.rng.bit_generator.state
+        }
+        tmp_file = self.meta_file + '.tmp'
+        with open(tmp_file, 'w') as f_o:
+            f_o.write(json.dumps(meta_info))
+        os.replace(tmp_file, self.meta_file)
+
+    def get_rows(self):
+        return self.embs[:min(self.num_seen, self.capacity)]
+
+def read_samples(sample_dir):
+    """
+    Return the saved reservoirs in the directory as a list of (rows, num_seen).
+    """
+    sample_lst = []
+    meta_file_lst = glob.glob(os.path.join(sample_dir, '*.json'))
+    meta_file_lst.sort()
+    for meta_file in meta_file_lst:
+        name = os.path.basename(meta_file)[:-len('.json')]
+        sample = ReservoirSample(sample_dir, name, 0)
+        sample_lst.append((sample.get_rows(), sample.num_seen))
+    return sample_lst
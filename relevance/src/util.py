@@ -16,6 +16,7 @@ import csv
 from tqdm import tqdm
 from .model import RetrieverConfig, Retriever
 from .student_retriever import StudentRetriever 
+from . import line_index
 
 logger = logging.getLogger(__name__)
 
@@ -253,10 +254,4 @@ def read_passage(path):
             yield text
 
 def count_passages(path):
-    if not os.path.exists(path):
-        return 0
-    count = 0
-    with open(path) as fin:
-        for _ in tqdm(fin):
-            count+=1
-    return count
+    return line_index.count_lines(path)
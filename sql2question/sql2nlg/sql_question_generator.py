@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sys
+from typing import List
+
+import torch
+from transformers import AutoTokenizer, T5ForConditionalGeneration
+
+from table2question.sql_data import SqlQuery
+
+T5_Prefix = 'translate Graph to English: '
+
+
+class SqlQuestionGenerator:
+    """
+    The sql2nlg T5 model loaded once from the Lightning checkpoint, translating sql texts to questions in memory.
+    The sqls are sorted by length and batched by a token budget (tokens x beams), so short sqls share
+    large batches without padding to the long ones.
+    """
+
+    def __init__(
+        self,
+        checkpoint,
+        model_name="t5-base",
+        device="cuda",
+        num_beams=3,
+        max_source_length=384,
+        max_gen_length=384,
+        max_batch_size=64,
+        max_batch_tokens=16384,
+    ):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.tokenizer.add_special_tokens({"additional_special_tokens": SqlQuery.get_meta_tags()})
+        self.model = T5ForConditionalGeneration.from_pretrained(model_name)
+        self.model.resize_token_embeddings(len(self.tokenizer))
+        # the Lightning module keeps the transformer as self.model
+        state_dict = torch.load(checkpoint, map_location="cpu")["state_dict"]
+        model_state_dict = {k[len("model."):]: v for k, v in state_dict.items() if k.startswith("model.")}
+        self.model.load_state_dict(model_state_dict)
+        self.model.to(device)
+        self.model.eval()
+        self.device = device
+        self.prefix = T5_Prefix if "t5" in model_name else ""
+        self.num_beams = num_beams
+        self.max_source_length = max_source_length
+        self.max_gen_length = max_gen_length
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+    def get_batches(self, source_ids: List[List[int]], num_beams: int) -> List[List[int]]:
+        """Group the sql indexes longest first, the first item of a batch sets its length."""
+        sorted_idxes = sorted(range(len(source_ids)), key=lambda idx: len(source_ids[idx]), reverse=True)
+        batches = []
+        batch = []
+        for idx in sorted_idxes:
+            if len(batch) > 0:
+                batch_len = len(source_ids[batch[0]])
+                num_tokens = (len(batch) + 1) * batch_len * num_beams
+                if (len(batch) >= self.max_batch_size) or (num_tokens > self.max_batch_tokens):
+                    batches.append(batch)
+                    batch = []
+            batch.append(idx)
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def pad_batch(self, batch_ids: List[List[int]]):
+        max_len = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full((len(batch_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        for idx, ids in enumerate(batch_ids):
+            input_ids[idx, : len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[idx, : len(ids)] = 1
+        return input_ids.to(self.device), attention_mask.to(self.device)
+
+    def generate(self, sql_lst: List[str], num_beams=None) -> List[str]:
+        """Return the question of each sql text, in the order of sql_lst."""
+        if len(sql_lst) == 0:
+            return []
+        num_beams = self.num_beams if num_beams is None else num_beams
+        source_lst = [self.prefix + sql.rstrip("\n") for sql in sql_lst]
+        source_ids = self.tokenizer(source_lst, max_length=self.max_source_length, truncation=True)["input_ids"]
+        question_lst = [None] * len(sql_lst)
+        with torch.no_grad():
+            for batch in self.get_batches(source_ids, num_beams):
+                input_ids, attention_mask = self.pad_batch([source_ids[idx] for idx in batch])
+                generated_ids = self.model.generate(
+                    input_ids,
+                    attention_mask=attention_mask,
+                    use_cache=True,
+                    num_beams=num_beams,
+                    max_length=self.max_gen_length,
+                    length_penalty=1.0,
+                )
+                gen_text = self.tokenizer.batch_decode(
+                    generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True
+                )
+                for idx, text in zip(batch, gen_text):
+                    question_lst[idx] = text.strip()
+        return question_lst
+
+
+def serve(generator, f_in, f_out):
+    """
+    One json request per line, {"sql_lst": [...], "num_beams": optional},
+    answered by one json line, {"state": true, "questions": [...]} or {"state": false, "msg": ...}.
+    """
+    for line in f_in:
+        if line.strip() == "":
+            continue
+        try:
+            request = json.loads(line)
+            questions = generator.generate(request["sql_lst"], num_beams=request.get("num_beams", None))
+            response = {"state": True, "questions": questions}
+        except Exception as e:
+            response = {"state": False, "msg": "%s: %s" % (type(e).__name__, str(e))}
+        f_out.write(json.dumps(response) + "\n")
+        f_out.flush()
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--model_name", type=str, default="t5-base")
+    parser.add_argument("--num_beams", type=int, default=3)
+    parser.add_argument("--max_source_length", type=int, default=384)
+    parser.add_argument("--max_gen_length", type=int, default=384)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--max_batch_tokens", type=int, default=16384, help="sum of (source tokens x beams) in a batch")
+    parser.add_argument("--source_file", type=str, help="translate the sqls in the file instead of serving requests")
+    parser.add_argument("--out_file", type=str)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    # the responses are written to stdout, so anything printed by the libraries goes to stderr
+    f_out = sys.stdout
+    sys.stdout = sys.stderr
+    generator = SqlQuestionGenerator(
+        args.checkpoint,
+        model_name=args.model_name,
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        num_beams=args.num_beams,
+        max_source_length=args.max_source_length,
+        max_gen_length=args.max_gen_length,
+        max_batch_size=args.max_batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+    )
+    if args.source_file is None:
+        serve(generator, sys.stdin, f_out)
+        return
+    with open(args.source_file) as f:
+        sql_lst = [line.rstrip("\n") for line in f]
+    questions = generator.generate(sql_lst)
+    with open(args.out_file, "w") as f_o:
+        f_o.writelines(q + "\n" for q in questions)
+
+
+if __name__ == "__main__":
+    main()
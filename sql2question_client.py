@@ -0,0 +1,66 @@
+import os
+import json
+import subprocess
+import threading
+
+class Sql2QuestionClient:
+    '''
+    Translate sqls to questions with a generator process that loads the sql2nlg checkpoint once
+    and is kept running across the data iterations. The generator runs in the sql2question
+    virtual environment (its own transformers and torch versions), the requests and responses
+    are json lines over its stdin/stdout. The process is started by the first request.
+    '''
+    def __init__(self, work_dir, gpu_id, num_beams, max_batch_size, max_batch_tokens):
+        self.work_dir = work_dir
+        self.gpu_id = gpu_id
+        self.num_beams = num_beams
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def get_cmd(self):
+        checkpoint = os.path.join(self.work_dir, 'models/sql2nlg-t5-base_2022_01_21.ckpt')
+        cmd = 'cd %s/open_table_discovery/sql2question ;' % self.work_dir + \
+              ' . %s/pyenv/sql2question/bin/activate ;' % self.work_dir + \
+              ' CUDA_VISIBLE_DEVICES=%d exec python sql2nlg/sql_question_generator.py' % self.gpu_id + \
+              ' --checkpoint %s --num_beams %d' % (checkpoint, self.num_beams) + \
+              ' --max_batch_size %d --max_batch_tokens %d' % (self.max_batch_size, self.max_batch_tokens)
+        return cmd
+
+    def start(self):
+        self.proc = subprocess.Popen(['bash', '-c', self.get_cmd()], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+    def generate(self, sql_lst):
+        with self.lock:
+            if (self.proc is None) or (self.proc.poll() is not None):
+                self.start()
+            request = {'sql_lst':sql_lst}
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+            line = self.proc.stdout.readline()
+        if line == '':
+            raise ValueError('sql2question generator exited with code (%s)' % str(self.proc.poll()))
+        response = json.loads(line)
+        if not response['state']:
+            raise ValueError('sql2question generator failed, %s' % response['msg'])
+        return response['questions']
+
+    def close(self):
+        with self.lock:
+            if (self.proc is None) or (self.proc.poll() is not None):
+                return
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc = None
+
+def create_client(work_dir, config):
+    if not int(config['sql2question_server']):
+        return None
+    client = Sql2QuestionClient(work_dir,
+                                int(config['prep_cuda']),
+                                int(config['sql2question_beams']),
+                                int(config['sql2question_batch_size']),
+                                int(config['sql2question_batch_tokens']))
+    return client
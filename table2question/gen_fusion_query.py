@@ -2,6 +2,7 @@ import json
 import os
 import argparse
 from tqdm import tqdm
+from src import line_index
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -122,7 +123,7 @@ def main(args):
         print(err_msg)
         return 
      
-    f_o_query = open(out_query_file, 'w') 
+    f_o_query = line_index.LineOffsetFile(out_query_file) 
     meta_data = read_meta(meta_file)
     q_data = read_questions(q_file)
    
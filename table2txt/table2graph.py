@@ -6,9 +6,8 @@ import numpy as np
 import random
 from multiprocessing import Pool as ProcessPool
 from table2txt.graph_strategy.strategy_constructor import get_strategy
-import shutil
 import copy
-import uuid
+from src import line_index
 
 def count_batchs(data_file, batch_size, chunk_size):
     num_batch = 0
@@ -43,24 +42,46 @@ def chunk_tables(table, chunk_size):
             sub_table['rows'] = row_data[offset:(offset+chunk_size)]
             yield sub_table
 
-def init_worker(strategy_name):
+def init_worker(strategy_name, passage_maxlength=None):
     global g_strategy
     g_strategy = get_strategy(strategy_name) 
+    # the triples are also tokenized in the workers when they are encoded as a stream
+    global g_tokenizer, g_passage_maxlength
+    g_tokenizer = None
+    g_passage_maxlength = passage_maxlength
+    if passage_maxlength is not None:
+        # only the fused mode needs the encoder module (and torch/transformers)
+        import generate_passage_embeddings as passage_encoder
+        g_tokenizer = passage_encoder.get_text_tokenizer()
 
 def process_table(arg_info):
+    """
+    Return the serialized triples of the table and, in streaming mode, their tokens.
+    p_ids are assigned by the writer.
+    """
     table = arg_info['table']
     table['show_progress'] = (arg_info['task_idx'] == 0)
-    out_part_dir = arg_info['out_part_dir']
-    file_name = 'triple_%s.jsonl' % str(uuid.uuid4())
-    out_file = os.path.join(out_part_dir, file_name)
-    with open(out_file, 'w') as f_o: 
-        for graph_info in g_strategy.generate(table):
-            row_offset = graph_info['row']
-            graph_info['row'] = row_offset + table['row_start_offset']
-            write_graphs([graph_info], f_o) 
-    return out_file
-
-def main(args):
+    graph_text_lst = []
+    passage_lst = []
+    for graph_info in g_strategy.generate(table):
+        row_offset = graph_info['row']
+        graph_info['row'] = row_offset + table['row_start_offset']
+        graph_text_lst.append(serialize_graph(graph_info))
+        passage_lst.append(graph_info['graph'])
+    out_info = {
+        'graph_text_lst':graph_text_lst,
+        'tokens':None
+    }
+    if (g_tokenizer is not None) and (len(passage_lst) > 0):
+        import generate_passage_embeddings as passage_encoder
+        out_info['tokens'] = passage_encoder.tokenize_passages(g_tokenizer, passage_lst, g_passage_maxlength)
+    return out_info
+
+def main(args, stream_encoder=None):
+    """
+    Generate the triples of the tables into passages.jsonl. With a stream_encoder,
+    the triples are also passed to it to be encoded while they are generated.
+    """
     table2txt_dir = os.path.join(args.work_dir, 'open_table_discovery/table2txt')
     out_dir = os.path.join(table2txt_dir, 'dataset', args.dataset, args.experiment)
     if not os.path.isdir(out_dir):
@@ -71,25 +92,24 @@ def main(args):
         err_msg = ('(%s) already exists.\n' % out_passage_file)
         print(err_msg)
         return {'state':False}
-    f_o = open(out_passage_file, 'w')
+    f_o = line_index.LineOffsetFile(out_passage_file)
 
     table_file_name = args.table_file
     input_table_file = os.path.join(args.work_dir, 'data', args.dataset, 'tables', table_file_name)
     
     num_batch = count_batchs(input_table_file, args.table_import_batch, args.table_chunk_size)
 
-    out_part_dir = os.path.join(out_dir, 'table_parts')
-    if os.path.isdir(out_part_dir):
-        shutil.rmtree(out_part_dir)
-    os.makedirs(out_part_dir)
-    
-    out_file_lst = []
+    num_triples = 0
+    p_id = args.p_id_start
     multi_process = True
     work_pool = None
+    passage_maxlength = None
+    if stream_encoder is not None:
+        passage_maxlength = stream_encoder.passage_maxlength
     if multi_process:
-        work_pool = ProcessPool(initializer=init_worker, initargs=(args.strategy,))
+        work_pool = ProcessPool(initializer=init_worker, initargs=(args.strategy, passage_maxlength, ))
     else:
-        init_worker(args.strategy)
+        init_worker(args.strategy, passage_maxlength)
     
     for batch_table_lst in tqdm(read_tables(input_table_file, args.table_import_batch, args.table_chunk_size), 
                                 total=num_batch):
@@ -97,21 +117,24 @@ def main(args):
         for task_idx, table in enumerate(batch_table_lst):
             args_info = {
                 'table':table,
-                'out_part_dir':out_part_dir,
                 'task_idx':task_idx
             }
             arg_info_lst.append(args_info)
     
         if multi_process:
-            for out_graph_file in work_pool.imap_unordered(process_table, arg_info_lst):
-                out_file_lst.append(out_graph_file)
+            out_info_iter = work_pool.imap_unordered(process_table, arg_info_lst)
         else:
-            for arg_info in arg_info_lst:
-                out_graph_file = process_table(arg_info)
-                out_file_lst.append(out_graph_file)
+            out_info_iter = (process_table(arg_info) for arg_info in arg_info_lst)
+        for out_info in out_info_iter:
+            num_written = write_graph_texts(out_info['graph_text_lst'], f_o, p_id)
+            if out_info['tokens'] is not None:
+                text_ids, text_mask = out_info['tokens']
+                stream_encoder.add(range(p_id, p_id + num_written), text_ids, text_mask)
+            p_id += num_written
+            num_triples += num_written
    
-    num_triples = merge_graph_files(out_file_lst, f_o) 
-    shutil.rmtree(out_part_dir)
+    if multi_process:
+        work_pool.close()
     f_o.close()
     
     msg_info = {
@@ -123,34 +146,25 @@ def main(args):
 
 g_passage_id = 0
 
-def merge_graph_files(graph_file_list, f_merge):
-    g_p_id = 0
-    for graph_file in tqdm(graph_file_list, desc='merging triples'):
-        with open(graph_file) as f_graph:
-            for line in f_graph:
-                triple_info = json.loads(line)
-                g_p_id += 1
-                triple_info['p_id'] = g_p_id
-                f_merge.write(json.dumps(triple_info) + '\n')
-        os.remove(graph_file)
-    num_total_triples = g_p_id
-    return num_total_triples
-
-def write_graphs(graph_lst, f_o):
-    for graph_info in graph_lst:
-        passage = graph_info['graph']
-        meta_info = {
-            'table_id': graph_info['table_id'],
-            'row': graph_info['row'],
-            'sub_col':graph_info['sub_col'],
-            'obj_col':graph_info['obj_col']
-        }
-        passage_info = {
-            'p_id':None, #update when merging
-            'passage':passage,
-            'tag':meta_info 
-        }
-        f_o.write(json.dumps(passage_info) + '\n')
+def serialize_graph(graph_info):
+    passage = graph_info['graph']
+    meta_info = {
+        'table_id': graph_info['table_id'],
+        'row': graph_info['row'],
+        'sub_col':graph_info['sub_col'],
+        'obj_col':graph_info['obj_col']
+    }
+    passage_info = {
+        'passage':passage,
+        'tag':meta_info 
+    }
+    return json.dumps(passage_info)
+
+def write_graph_texts(graph_text_lst, f_o, p_id_start):
+    # put the p_id in front of the serialized triple instead of parsing it again
+    for offset, graph_text in enumerate(graph_text_lst):
+        f_o.write('{"p_id": %d, %s\n' % (p_id_start + offset, graph_text[1:]))
+    return len(graph_text_lst)
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -162,6 +176,7 @@ def get_args():
     parser.add_argument('--debug', type=int, default=0)
     parser.add_argument('--table_import_batch', type=int)
     parser.add_argument('--table_chunk_size', type=int)
+    parser.add_argument('--p_id_start', type=int, default=1)
     args = parser.parse_args()
     return args
 
@@ -9,8 +9,12 @@ import glob
 import random
 import sys
 from typing import Dict, List
+from src import line_index
 csv.field_size_limit(sys.maxsize)
 
+Manifest_File = 'tables_manifest.json'
+Delta_Table_File = 'tables_delta.jsonl'
+
 def get_out_file(args):
     data_dir = os.path.join(args.work_dir, 'data/%s/tables' % args.dataset)
     if not os.path.isdir(data_dir):
@@ -69,25 +73,45 @@ def read_table(arg_info: Dict):
     
     return table
 
-def main(args):
-    out_file = get_out_file(args)
-    if os.path.exists(out_file):
-        msg_text = '(%s) already exists' % out_file
-        msg_info = {
-            'state':False,
-            'msg':msg_text
-        }
-        return msg_info
+def read_table_info(arg_info: Dict):
+    table = read_table(arg_info)
+    return {'data_file':arg_info['data_file'], 'table':table}
 
-    f_o = open(out_file, 'w')
-    dataset_dir = os.path.join(args.work_dir, 'data', args.dataset)
-    csv_file_pattern = os.path.join(dataset_dir, 'tables_csv', '**', '*.csv')
+def get_csv_dir(args):
+    return os.path.join(args.work_dir, 'data', args.dataset, 'tables_csv')
+
+def list_csv_files(args):
+    csv_file_pattern = os.path.join(get_csv_dir(args), '**', '*.csv')
     csv_file_lst = glob.glob(csv_file_pattern, recursive=True)
-   
-    num_wokers = min(os.cpu_count(), 10) 
-    work_pool = ProcessPool(num_wokers)
+    return csv_file_lst
+
+def get_csv_key(args, csv_file):
+    return os.path.relpath(csv_file, get_csv_dir(args))
+
+def get_csv_stat(csv_file):
+    file_stat = os.stat(csv_file)
+    return {'mtime':file_stat.st_mtime, 'size':file_stat.st_size}
+
+def get_manifest_file(args):
+    return os.path.join(args.work_dir, 'data', args.dataset, 'tables', Manifest_File)
+
+def read_manifest(args):
+    manifest_file = get_manifest_file(args)
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    return manifest
+
+def write_manifest(args, manifest):
+    manifest_file = get_manifest_file(args)
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f_o:
+        f_o.write(json.dumps(manifest))
+    os.replace(tmp_file, manifest_file)
+
+def get_arg_info_lst(args, csv_file_lst):
     arg_info_lst = []
-    
     for csv_file in csv_file_lst:
         meta_file = os.path.splitext(csv_file)[0] + '.meta.json'
         args_info = {
@@ -96,27 +120,137 @@ def main(args):
             'file_name_title':args.file_name_title
         }
         arg_info_lst.append(args_info)
+    return arg_info_lst
 
+def import_tables(args, csv_file_lst, f_o, manifest):
+    num_wokers = min(os.cpu_count(), 10) 
+    work_pool = ProcessPool(num_wokers)
+    arg_info_lst = get_arg_info_lst(args, csv_file_lst)
+    
     multi_process = True
     if multi_process:    
-        for table in tqdm(work_pool.imap_unordered(read_table, arg_info_lst), total=len(arg_info_lst)):
-            if table is None:
-                continue
-            output_table(table, args, f_o)
+        table_info_iter = work_pool.imap_unordered(read_table_info, arg_info_lst)
     else:
-        for arg_info in tqdm(arg_info_lst):
-            table = read_table(arg_info)
-            if table is None:
-                continue
-            output_table(table, args, f_o)
-     
+        table_info_iter = (read_table_info(arg_info) for arg_info in arg_info_lst)
+    
+    num_tables = 0
+    for table_info in tqdm(table_info_iter, total=len(arg_info_lst)):
+        table = table_info['table']
+        csv_file = table_info['data_file']
+        csv_info = get_csv_stat(csv_file)
+        # a rejected csv is recorded too, so it is read again only after it is changed
+        if table is None:
+            csv_info['skipped'] = True
+            manifest[get_csv_key(args, csv_file)] = csv_info
+            continue
+        output_table(table, args, f_o)
+        csv_info['table_id'] = table['tableId']
+        manifest[get_csv_key(args, csv_file)] = csv_info
+        num_tables += 1
+    
+    work_pool.close()
+    return num_tables
+
+def main(args):
+    out_file = get_out_file(args)
+    if os.path.exists(out_file):
+        msg_text = '(%s) already exists' % out_file
+        msg_info = {
+            'state':False,
+            'msg':msg_text
+        }
+        return msg_info
+
+    f_o = line_index.LineOffsetFile(out_file)
+    csv_file_lst = list_csv_files(args)
+    manifest = {}
+    import_tables(args, csv_file_lst, f_o, manifest)
     f_o.close()
+    write_manifest(args, manifest)
+
+    msg_info = {
+        'state':True,
+    }
+    return msg_info
 
+def import_changed(args):
+    """
+    Import only the new and changed csv files since the last import.
+    The changed and new tables are written to tables_delta.jsonl, and the table ids of changed and
+    deleted csv files are returned to be removed from the index. The updated manifest is returned
+    instead of written, tables.jsonl and the manifest are updated by update_tables after the index.
+    """
+    manifest = read_manifest(args)
+    if manifest is None:
+        msg_info = {
+            'state':False,
+            'msg':'(%s) does not exist, index the dataset without incremental mode first.' % get_manifest_file(args)
+        }
+        return msg_info
+    
+    csv_file_lst = list_csv_files(args)
+    csv_key_set = set()
+    updated_csv_lst = []
+    removed_table_ids = []
+    for csv_file in csv_file_lst:
+        csv_key = get_csv_key(args, csv_file)
+        csv_key_set.add(csv_key)
+        csv_info = manifest.get(csv_key, None)
+        if csv_info is None:
+            updated_csv_lst.append(csv_file)
+            continue
+        csv_stat = get_csv_stat(csv_file)
+        if (csv_stat['mtime'] != csv_info['mtime']) or (csv_stat['size'] != csv_info['size']):
+            updated_csv_lst.append(csv_file)
+            if not csv_info.get('skipped', False):
+                removed_table_ids.append(csv_info['table_id'])
+            del manifest[csv_key]
+    
+    for csv_key in list(manifest.keys()):
+        if csv_key not in csv_key_set:
+            if not manifest[csv_key].get('skipped', False):
+                removed_table_ids.append(manifest[csv_key]['table_id'])
+            del manifest[csv_key]
+
+    table_file = get_out_file(args)
+    delta_table_file = os.path.join(os.path.dirname(table_file), Delta_Table_File)
+    with open(delta_table_file, 'w') as f_o:
+        num_tables = import_tables(args, updated_csv_lst, f_o, manifest)
+    
     msg_info = {
         'state':True,
+        'delta_table_file':delta_table_file,
+        'num_tables':num_tables,
+        'removed_table_ids':removed_table_ids,
+        'manifest':manifest
     }
     return msg_info
 
+def update_tables(args, removed_table_ids, delta_table_file, manifest):
+    """
+    Replace the removed and the delta tables in tables.jsonl with the delta tables,
+    then write the manifest. Running it again after an interruption gives the same result.
+    """
+    delta_id_lst = []
+    with open(delta_table_file) as f_delta:
+        for line in f_delta:
+            delta_id_lst.append(json.loads(line)['tableId'])
+    removed_id_set = set(removed_table_ids + delta_id_lst)
+    table_file = get_out_file(args)
+    updated_table_file = table_file + '.updating'
+    with line_index.LineOffsetFile(updated_table_file) as f_o:
+        with open(table_file) as f:
+            for line in tqdm(f):
+                table_id = json.loads(line)['tableId']
+                if table_id not in removed_id_set:
+                    f_o.write(line)
+        with open(delta_table_file) as f_delta:
+            for line in f_delta:
+                f_o.write(line)
+    os.replace(updated_table_file, table_file)
+    os.replace(line_index.get_offset_file(updated_table_file), line_index.get_offset_file(table_file))
+    write_manifest(args, manifest)
+
 def output_table(table, args, f_o):
     if args.table_sample_rows is not None:
         row_data = table['rows']
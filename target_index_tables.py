@@ -27,6 +27,7 @@ from table2txt import table2graph
 import table_from_csv
 import generate_passage_embeddings as passage_encoder
 from src import ondisk_index
+from src import line_index
 import shutil
 import json
 from trainer import read_config
@@ -98,7 +99,8 @@ def get_graph_args(work_dir, dataset, config):
                                     table_file='tables.jsonl',
                                     strategy='RelationGraph',
                                     table_chunk_size=config['table_chunk_size'],
-                                    table_import_batch=config['table_import_batch']
+                                    table_import_batch=config['table_import_batch'],
+                                    p_id_start=1
                                     )
     return graph_args
 
@@ -107,8 +109,10 @@ def get_encoder_args(model_path, config, show_progress=True):
                                       passages=None, 
                                       output_path=None,
                                       output_batch_size=500000,
-                                      shard_id=0,
-                                      num_shards=1,
+                                      shard_id=-1,
+                                      num_shards=config['encode_num_shards'],
+                                      num_tok_workers=config['encode_tok_workers'],
+                                      train_sample_size=config['train_sample_size'],
                                       per_gpu_batch_size=config['encode_batch_size'],
                                       passage_maxlength=200,
                                       model_path=model_path,
@@ -117,12 +121,14 @@ def get_encoder_args(model_path, config, show_progress=True):
                                      )
     return encoder_args
 
-def get_index_args(work_dir, dataset):
+def get_index_args(work_dir, dataset, config):
     emb_file = get_emb_file_pattern(work_dir, dataset)
     index_args = argparse.Namespace(work_dir=work_dir,
                                     dataset=dataset,
                                     experiment='rel_graph',
-                                    emb_file=emb_file
+                                    emb_file=emb_file,
+                                    trained_index=config['trained_index'],
+                                    index_plan=config['index_plan']
                                     )
     return index_args 
 
@@ -258,7 +264,7 @@ def create_index(pipe_state_info, pipe_state_file, args, triple_file):
         raise ValueError('There is no triple embedding files')
     
     print('\nCreating index')
-    index_args = get_index_args(args.work_dir, args.dataset)
+    index_args = get_index_args(args.work_dir, args.dataset, read_config())
     msg_info = ondisk_index.main(index_args)
     if pipe_state_info is not None:
         if not msg_info['state']:
@@ -270,6 +276,9 @@ def create_index(pipe_state_info, pipe_state_file, args, triple_file):
     index_dir = msg_info['index_dir']
     assert(os.path.isdir(index_dir))
     shutil.move(triple_file, index_dir)
+    triple_offset_file = line_index.get_offset_file(triple_file)
+    if os.path.isfile(triple_offset_file):
+        shutil.move(triple_offset_file, index_dir)
 
     for out_emb_file in out_emb_file_lst:
         os.remove(out_emb_file)
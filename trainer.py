@@ -5,20 +5,85 @@ import shutil
 import subprocess
 from tqdm import tqdm
 import uuid
+import functools
+import threading
+import queue
 from table2question import table2sql, gen_fusion_query
 import passage_ondisk_retrieval
 from table2txt.retr_utils import process_train, process_dev
 import finetune_table_retr as model_trainer
+import sql2question_client
 import datetime
 import torch
 from enum import Enum
 from typing import Dict, List
 
+Train_Cuda = 0
+
 class ConfirmOption(Enum):
     UseExisting = 1
     CreateNew = 2
     Exit = 3
 
+class DataPrefetcher:
+    '''
+    Prepare the data of the next iterations in a background thread while the current iteration trains,
+    at most lookahead iterations ahead. The iterations are prepared in order because the sql dict
+    must see the sqls of all the previous iterations. With lookahead 0, the data is prepared in get.
+    '''
+    def __init__(self, prepare_func, lookahead, cuda):
+        self.prepare_func = prepare_func
+        self.cuda = cuda
+        self.stopped = False
+        self.preparing_itr = None
+        self.ready_queue = queue.Queue()
+        self.permits = threading.Semaphore(lookahead)
+        self.worker = None
+        if lookahead > 0:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def run(self):
+        if torch.cuda.is_available():
+            torch.cuda.set_device(self.cuda)
+        train_itr = 0
+        while True:
+            self.permits.acquire()
+            if self.stopped:
+                break
+            self.preparing_itr = train_itr
+            try:
+                result = (self.prepare_func(train_itr), None)
+            except Exception as e:
+                result = (None, e)
+            self.preparing_itr = None
+            self.ready_queue.put((train_itr, result))
+            if result[1] is not None:
+                break
+            train_itr += 1
+
+    def get(self, train_itr):
+        if self.worker is None:
+            return self.prepare_func(train_itr)
+        ready_itr, (data_dir, error) = self.ready_queue.get()
+        assert(ready_itr == train_itr)
+        if error is not None:
+            raise error
+        self.permits.release()
+        return data_dir
+
+    def close(self):
+        if self.worker is None:
+            return
+        # the iteration being prepared is completed so that its data state is consistent
+        self.stopped = True
+        self.permits.release()
+        preparing_itr = self.preparing_itr
+        if preparing_itr is not None:
+            print('waiting for the data preparation of iteration %d to finish, ' % preparing_itr + 
+                  'it is kept for later runs but not trained now')
+        self.worker.join()
+
 def read_config() -> Dict:
     '''
     read the system config file as a dictionary
@@ -126,7 +191,14 @@ def get_retr_args(work_dir, dataset, question_dir, out_retr_dir, config):
     top_n = int(config['retr_top_n'])
     min_tables = int(config['min_tables'])
     max_retr = int(config['max_retr'])
+    n_probe = int(config['n_probe'])
+    min_probe = int(config['min_probe'])
+    retr_time_budget = float(config['retr_time_budget'])
+    collapse_tables = int(config['collapse_tables'])
+    collapse_per_table = int(config['collapse_per_table'])
+    teacher_cache_mb = float(config['teacher_cache_mb'])
     question_maxlength = int(config['question_maxlength'])
+    retr_batch_size = int(config['retr_batch_size'])
     retr_args = argparse.Namespace( 
                                     student_model_path=student_model_path,
                                     teacher_model_path=teacher_model_path,
@@ -138,7 +210,14 @@ def get_retr_args(work_dir, dataset, question_dir, out_retr_dir, config):
                                     n_docs=top_n,
                                     min_tables=min_tables,
                                     max_retr=max_retr,
+                                    n_probe=n_probe,
+                                    min_probe=min_probe,
+                                    retr_time_budget=retr_time_budget,
+                                    collapse_tables=collapse_tables,
+                                    collapse_per_table=collapse_per_table,
+                                    teacher_cache_mb=teacher_cache_mb,
                                     question_maxlength=question_maxlength,
+                                    retr_batch_size=retr_batch_size,
                                     no_fp16=False
                                    )
     return retr_args
@@ -164,7 +243,7 @@ def get_train_args(train_itr, work_dir, dataset, checkpoint_dir,
                                     n_context=int(config['rel_num_train']),
                                     per_gpu_batch_size=int(config['train_batch_size']),
                                     per_gpu_eval_batch_size=int(config['eval_batch_size']),
-                                    cuda=0,
+                                    cuda=Train_Cuda,
                                     debug=config['debug'],
                                     name=checkpoint_name,
                                     checkpoint_dir=checkpoint_dir,
@@ -173,6 +252,7 @@ def get_train_args(train_itr, work_dir, dataset, checkpoint_dir,
                                     patience_datasets=int(config['patience_datasets']),
                                     bnn=int(config['bnn']),
                                     text_maxlength=int(config['text_maxlength']),
+                                    fid_feature_cache=int(config['fid_feature_cache']),
                                     multi_model_eval=0,
                                     prior_model=prior_model,
                                     fusion_retr_model=None,
@@ -188,12 +268,39 @@ def count_lines(data_file):
             count += 1
     return count
 
-def sql2question(mode, sql_dir, work_dir, dataset, train_itr=None):
+def sql2question(mode, sql_dir, work_dir, dataset, train_itr=None, gpu_id=0, generator=None):
     torch.cuda.empty_cache()
     if train_itr is None:
         print('translating %s sql to question' % mode)
     else:
         print('translating data %d sql to question' % train_itr)
+    sql_question_file = os.path.join(sql_dir, 'questions.txt')
+    if os.path.exists(sql_question_file):
+        err_msg = '(%s) already exists, do you want to replace it (y/n)? ' % sql_question_file
+        raise ValueError(err_msg) 
+    
+    if generator is not None:
+        generate_questions(generator, sql_dir, sql_question_file)
+    else:
+        decode_questions(mode, sql_dir, work_dir, dataset, gpu_id, sql_question_file)
+   
+    query_args = get_fusion_query_args(work_dir, dataset, sql_dir) 
+    gen_fusion_query.main(query_args)
+
+def generate_questions(generator, sql_dir, sql_question_file):
+    sql_src_file = os.path.join(sql_dir, 'test_unseen.source')
+    with open(sql_src_file) as f:
+        sql_lst = [line.rstrip('\n') for line in f]
+    question_lst = generator.generate(sql_lst)
+    assert(len(sql_lst) == len(question_lst))
+    with open(sql_question_file, 'w') as f_o:
+        for question in question_lst:
+            f_o.write(question + '\n')
+
+def decode_questions(mode, sql_dir, work_dir, dataset, gpu_id, sql_question_file):
+    '''
+    Translate with the sql2nlg decoding script, which loads the checkpoint for every call.
+    '''
     target_dir = os.path.join(work_dir, 'open_table_discovery', 'sql2question/sql2nlg/data', dataset, 'sql_data')
     if not os.path.isdir(target_dir):
         os.makedirs(target_dir)
@@ -221,7 +328,7 @@ def sql2question(mode, sql_dir, work_dir, dataset, train_itr=None):
     cmd = 'cd %s/open_table_discovery/sql2question ;' % work_dir + \
           ' . %s/pyenv/sql2question/bin/activate ;' % work_dir + \
           ' ./decode_sql2nlg.sh t5-base %s/models/sql2nlg-t5-base_2022_01_21.ckpt' % work_dir + \
-          ' 0 ' + dataset + ' sql_data ' + part_name
+          (' %d ' % gpu_id) + dataset + ' sql_data ' + part_name
     os.system(cmd) 
 
     out_dir = os.path.join(work_dir, 'open_table_discovery', 'sql2question/sql2nlg/outputs/test_model', 
@@ -232,16 +339,8 @@ def sql2question(mode, sql_dir, work_dir, dataset, train_itr=None):
     count_question = count_lines(out_question_file)
     assert(count_sql == count_question)
     
-    sql_question_file = os.path.join(sql_dir, 'questions.txt')
-    if os.path.exists(sql_question_file):
-        err_msg = '(%s) already exists, do you want to replace it (y/n)? ' % sql_question_file
-        raise ValueError(err_msg) 
-    
     shutil.copy(out_question_file, sql_question_file)
     shutil.rmtree(out_dir)
-   
-    query_args = get_fusion_query_args(work_dir, dataset, sql_dir) 
-    gen_fusion_query.main(query_args)
 
 def read_meta(meta_file):
     meta_map = {}
@@ -350,6 +449,7 @@ def main():
     if con_opt == ConfirmOption.Exit:
         return
     config = read_config()
+    question_generator = sql2question_client.create_client(args.work_dir, config)
     sql_dict = None
     stat_info = None
     train_tables = None
@@ -369,7 +469,8 @@ def main():
         table_dict = read_tables(args.work_dir, args.dataset)
          
         dev_sql_dir = os.path.join(sql_data_dir, 'dev')
-        sql2question('dev', dev_sql_dir, args.work_dir, args.dataset)
+        sql2question('dev', dev_sql_dir, args.work_dir, args.dataset, gpu_id=int(config['prep_cuda']),
+                     generator=question_generator)
 
         top_n = int(config['retr_top_n'])
         min_tables = int(config['min_tables'])
@@ -382,37 +483,89 @@ def main():
     checkpoint_dir = os.path.join(args.work_dir, 'open_table_discovery/output', args.dataset, get_train_date_dir())
     assert(not os.path.isdir(checkpoint_dir))
       
-    train_file_lst = [] 
-    prior_model = None
-    best_metric = None
-    
     existing_data_itr = -1
     if data_state != None:
         existing_data_itr = data_state['data_itr'] 
+    prep_info = {
+        'work_dir':args.work_dir,
+        'dataset':args.dataset,
+        'sql_data_dir':sql_data_dir,
+        'config':config,
+        'data_state':data_state,
+        'existing_data_itr':existing_data_itr,
+        'sql_dict':sql_dict,
+        'train_tables':train_tables,
+        'table_dict':table_dict,
+        'stat_info':stat_info,
+        'cuda':int(config['prep_cuda']),
+        'question_generator':question_generator
+    }
+    prefetcher = DataPrefetcher(functools.partial(prepare_train_data, prep_info), 
+                                get_prep_lookahead(config), int(config['prep_cuda']))
+    try:
+        train_args, best_metric = train_data_itrs(args, config, prefetcher, checkpoint_dir, dev_sql_dir)
+    finally:
+        prefetcher.close()
+        if question_generator is not None:
+            question_generator.close()
+    show_best_metric(train_args.checkpoint_dir, best_metric, args.work_dir, args.dataset)
+
+def prepare_train_data(prep_info, train_itr):
+    '''
+    Create the questions and retrieved tables of data iteration train_itr if they do not exist yet
+    and return the directory of the iteration.
+    '''
+    work_dir = prep_info['work_dir']
+    dataset = prep_info['dataset']
+    sql_data_dir = prep_info['sql_data_dir']
+    config = prep_info['config']
+    num_train_queries = int(config['train_incr_size'])
+    assert(num_train_queries > 0)
+     
+    mode = 'train_%d' % train_itr
+    train_sql_dir = os.path.join(sql_data_dir, mode)
+    if train_itr > prep_info['existing_data_itr']: # need to create more questions
+        if prep_info['sql_dict'] is None:
+            prep_info['sql_dict'] = read_sql_dict(prep_info['data_state'], sql_data_dir)
+            prep_info['train_tables'], prep_info['table_dict'] = read_train_tables(sql_data_dir, dataset)         
+            prep_info['stat_info'] = read_stat_info(sql_data_dir)
+            table2sql.init_worker()
+        
+        remove_train_data_dir(train_sql_dir)
+
+        table2sql.generate_queries(train_sql_dir, mode, prep_info['train_tables'], num_train_queries, 
+                                   prep_info['stat_info'], prep_info['sql_dict']) 
+        
+        sql2question(mode, train_sql_dir, work_dir, dataset, train_itr, gpu_id=prep_info['cuda'],
+                     generator=prep_info['question_generator']) 
+        
+        retr_triples(mode, work_dir, dataset, train_sql_dir, prep_info['table_dict'], True, config)
+        
+        update_data_state(work_dir, dataset, train_itr, prep_info['sql_dict'])
+    return train_sql_dir
+
+def get_prep_lookahead(config):
+    '''
+    The data is only prepared ahead on a device other than the training one (cuda 0),
+    the sql2question model and the retrievers would compete with FiD and the relevance model for memory.
+    '''
+    lookahead = int(config['prep_lookahead'])
+    if (lookahead > 0) and (int(config['prep_cuda']) == Train_Cuda):
+        print('prep_cuda is the training device (%d), the data is prepared without look-ahead' % Train_Cuda)
+        lookahead = 0
+    return lookahead
+
+def train_data_itrs(args, config, prefetcher, checkpoint_dir, dev_sql_dir):
+    '''
+    Train on the data iterations in order, the prefetcher prepares the next iterations meanwhile.
+    '''
+    prior_model = None
+    best_metric = None
+    train_args = None
     train_itr = -1
     while True:
         train_itr += 1
-        num_train_queries = int(config['train_incr_size'])
-        assert(num_train_queries > 0)
-         
-        mode = 'train_%d' % train_itr
-        train_sql_dir = os.path.join(sql_data_dir, mode)
-        if train_itr > existing_data_itr: # need to create more questions
-            if sql_dict is None:
-                sql_dict = read_sql_dict(data_state, sql_data_dir)
-                train_tables, table_dict = read_train_tables(sql_data_dir, args.dataset)         
-                stat_info = read_stat_info(sql_data_dir)
-                table2sql.init_worker()
-            
-            remove_train_data_dir(train_sql_dir)
-
-            table2sql.generate_queries(train_sql_dir, mode, train_tables, num_train_queries, stat_info, sql_dict) 
-            
-            sql2question(mode, train_sql_dir, args.work_dir, args.dataset, train_itr) 
-            
-            retr_triples(mode, args.work_dir, args.dataset, train_sql_dir, table_dict, True, config)
-            
-            update_data_state(args.work_dir, args.dataset, train_itr, sql_dict)
+        train_sql_dir = prefetcher.get(train_itr)
       
         if best_metric is None:
             prior_model = None
@@ -441,8 +594,7 @@ def main():
 
         if best_metric['patience_itr'] > config['patience_datasets']:
             break
-
-    show_best_metric(train_args.checkpoint_dir, best_metric, args.work_dir, args.dataset)
+    return train_args, best_metric
 
 def show_best_metric(checkpoint_dir, best_metric, work_dir, dataset):
     p_at_1 = best_metric['p@1'] * 100 / best_metric['N']